@@ -0,0 +1,65 @@
+#!/usr/bin/env python
+"""
+Compares the pure-python and numpy area-aware crop searches used by
+:class:`daguerre.adjustments.Crop`.
+
+Run from the repository root::
+
+    python benchmarks/crop_search.py
+
+"""
+import os
+import sys
+import timeit
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from daguerre.adjustments import Crop  # noqa: E402
+
+
+class BenchArea(object):
+    """Stand-in for :class:`daguerre.models.Area` that needs no database."""
+
+    def __init__(self, x1, y1, x2, y2, priority=3):
+        self.x1, self.y1, self.x2, self.y2 = x1, y1, x2, y2
+        self.priority = priority
+        self.width = x2 - x1
+        self.height = y2 - y1
+        self.area = self.width * self.height
+
+
+CASES = (
+    # (image dims, crop dims, areas)
+    ((800, 600), (700, 500),
+     [BenchArea(100, 100, 300, 300)]),
+    ((1600, 1200), (1400, 1000),
+     [BenchArea(200, 150, 700, 600, priority=1),
+      BenchArea(900, 300, 1300, 800)]),
+    ((4000, 3000), (3600, 2700),
+     [BenchArea(500, 400, 1500, 1400, priority=1),
+      BenchArea(2000, 1000, 3000, 2000),
+      BenchArea(3200, 200, 3900, 900, priority=5)]),
+)
+
+
+def main():
+    crop = Crop()
+    for dims, new_dims, areas in CASES:
+        args = (areas, dims, new_dims)
+        numpy_time = min(timeit.repeat(
+            lambda: crop._get_optimal_offset_numpy(*args),
+            number=1, repeat=3))
+        python_time = min(timeit.repeat(
+            lambda: crop._get_optimal_offset_python(*args),
+            number=1, repeat=1))
+        assert (crop._get_optimal_offset_numpy(*args) ==
+                crop._get_optimal_offset_python(*args))
+        offsets = (dims[0] - new_dims[0] + 1) * (dims[1] - new_dims[1] + 1)
+        print("{0[0]}x{0[1]} -> {1[0]}x{1[1]}, {2} areas, {3} offsets: "
+              "python {4:.3f}s, numpy {5:.4f}s ({6:.0f}x)".format(
+                  dims, new_dims, len(areas), offsets,
+                  python_time, numpy_time, python_time / numpy_time))
+
+
+if __name__ == '__main__':
+    main()
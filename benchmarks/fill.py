@@ -0,0 +1,58 @@
+#!/usr/bin/env python
+"""
+Compares :class:`daguerre.adjustments.Fill` against a separate
+:class:`~daguerre.adjustments.RatioCrop` and
+:class:`~daguerre.adjustments.Fit`, which copies the cropped region out of
+the original before resizing it.
+
+Run from the repository root::
+
+    python benchmarks/fill.py
+
+"""
+import os
+import sys
+import timeit
+import warnings
+
+from PIL import Image
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from django.conf import settings  # noqa: E402
+
+settings.configure(DAGUERRE_OFFSET_CACHE=None)
+
+from daguerre.adjustments import Fill, Fit, RatioCrop  # noqa: E402
+
+
+SIZES = (
+    # (source size, Fill kwargs)
+    ((4000, 3000), {'width': 1200, 'height': 1200}),
+    ((4000, 3000), {'width': 300, 'height': 300}),
+    ((4000, 3000), {'width': 160, 'height': 90}),
+)
+
+
+def separate(image, width, height):
+    ratiocrop = RatioCrop(ratio="{0}:{1}".format(width, height))
+    return Fit(width=width, height=height).adjust(ratiocrop.adjust(image))
+
+
+def main():
+    warnings.simplefilter('ignore', DeprecationWarning)
+    for size, kwargs in SIZES:
+        image = Image.effect_mandelbrot(size, (-2.0, -1.2, 1.0, 1.2), 256)
+        image = image.convert('RGB')
+        fill = Fill(**kwargs)
+        fused = min(timeit.repeat(lambda: fill.adjust(image),
+                                  number=1, repeat=3))
+        unfused = min(timeit.repeat(lambda: separate(image, **kwargs),
+                                    number=1, repeat=3))
+        print("{0[0]}x{0[1]} -> {1[width]}x{1[height]}: "
+              "crop then fit {2:.1f} ms, fill {3:.1f} ms".format(
+                  size, kwargs, unfused * 1000, fused * 1000))
+
+
+if __name__ == '__main__':
+    main()
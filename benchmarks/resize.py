@@ -0,0 +1,59 @@
+#!/usr/bin/env python
+"""
+Compares a single-step downscale against the reducing resize used by
+:class:`daguerre.adjustments.Fit` for several ``reducing_gap`` values.
+
+Run from the repository root::
+
+    python benchmarks/resize.py
+
+"""
+import os
+import sys
+import timeit
+import warnings
+
+from PIL import Image, ImageChops, ImageStat
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from daguerre.utils import resize  # noqa: E402
+
+
+SIZES = (
+    # (source size, target size)
+    ((4000, 3000), (1200, 900)),
+    ((4000, 3000), (400, 300)),
+    ((4000, 3000), (100, 75)),
+)
+GAPS = (None, 4.0, 3.0, 2.0, 1.0)
+
+
+def make_image(size):
+    # A fractal has detail at every scale, which makes resampling
+    # differences visible.
+    image = Image.effect_mandelbrot(size, (-2.0, -1.2, 1.0, 1.2), 256)
+    noise = Image.effect_noise(size, 32)
+    return Image.merge('RGB', (image, noise, ImageChops.invert(image)))
+
+
+def main():
+    warnings.simplefilter('ignore', DeprecationWarning)
+    for size, new_size in SIZES:
+        image = make_image(size)
+        reference = resize(image, new_size, Image.ANTIALIAS)
+        print("{0[0]}x{0[1]} -> {1[0]}x{1[1]}".format(size, new_size))
+        for gap in GAPS:
+            seconds = min(timeit.repeat(
+                lambda: resize(image, new_size, Image.ANTIALIAS, gap),
+                number=1, repeat=3))
+            result = resize(image, new_size, Image.ANTIALIAS, gap)
+            diff = ImageStat.Stat(ImageChops.difference(reference, result))
+            print("  reducing_gap={0!s:<5} {1:7.1f} ms  "
+                  "mean abs diff {2:.3f}/255".format(
+                      gap, seconds * 1000,
+                      sum(diff.mean) / len(diff.mean)))
+
+
+if __name__ == '__main__':
+    main()
@@ -1,6 +1,28 @@
+import math
+
+from django.conf import settings
+from django.core.cache import caches
 from PIL import Image
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
+from daguerre.utils import (exif_aware_resize, exif_aware_size, get_exif_orientation,
+                            make_hash, resize, ORIENTATION_TO_TRANSPOSE)
+
+#: Cache alias used to remember optimal crop offsets. Can be overridden with
+#: the DAGUERRE_OFFSET_CACHE setting; set it to ``None`` to disable caching.
+DEFAULT_OFFSET_CACHE = 'default'
+#: How much larger than the target size an image is kept after the fast
+#: integer reduction which precedes a downscaling resample. Can be overridden
+#: with the DAGUERRE_REDUCING_GAP setting; set it to ``None`` to always
+#: resample the full image in a single step.
+DEFAULT_REDUCING_GAP = 3.0
 
-from daguerre.utils import exif_aware_resize, exif_aware_size
+
+def _get_reducing_gap():
+    return getattr(settings, 'DAGUERRE_REDUCING_GAP', DEFAULT_REDUCING_GAP)
 
 
 class AdjustmentRegistry(object):
@@ -79,6 +101,87 @@ class Adjustment(object):
         """
         raise NotImplementedError
 
+    def get_crop_box(self, dims, areas=None):
+        """
+        If the adjustment only crops the image, returns the
+        ``(x1, y1, x2, y2)`` box it would crop from an image with the given
+        dimensions; otherwise returns ``None``. By default, returns ``None``.
+
+        This lets the crop be combined with the following adjustment (see
+        :meth:`adjust_box`) instead of copying the cropped region first.
+
+        :param dims: ``(width, height)`` tuple of the current image
+                     dimensions.
+        :param areas: iterable of :class:`.Area` instances to be considered in
+                      calculating the box.
+
+        """
+        return None
+
+    def get_areas_key(self, dims, areas=None):
+        """
+        Returns a value which is the same for two iterables of areas if
+        adjusting an image with the given dimensions would give the same
+        result with either, or ``None`` if that can't be told. This lets
+        adjusted images be kept when :class:`Areas <.Area>` change in a way
+        which doesn't affect them. By default, returns the result of
+        :meth:`get_crop_box`.
+
+        :param dims: ``(width, height)`` tuple of the current image
+                     dimensions.
+        :param areas: iterable of :class:`.Area` instances to be considered in
+                      calculating the key.
+
+        """
+        return self.get_crop_box(dims, areas)
+
+    def adjust_box(self, image, box, areas=None):
+        """
+        Returns the same result as :meth:`adjust` for the ``box`` region of
+        the image. By default, crops the region and adjusts it; adjustments
+        which can work on a region directly (such as :class:`.Fit`) override
+        this to avoid the intermediate copy.
+
+        :param image: PIL Image which will be adjusted.
+        :param box: ``(x1, y1, x2, y2)`` tuple of the region to adjust.
+        :param areas: iterable of :class:`.Area` instances to be considered in
+                      performing the adjustment.
+
+        """
+        return self.adjust(image.crop(box), areas=areas)
+
+    def get_draft_size(self, dims, areas=None):
+        """
+        Returns the smallest ``(width, height)`` an image with the given
+        dimensions could be decoded at while still producing the same
+        adjusted dimensions, or ``None`` if the adjustment needs the image at
+        full resolution. By default, returns ``None``.
+
+        Adjustments which return a size must also implement
+        :meth:`adjust_draft`.
+
+        :param dims: ``(width, height)`` tuple of the full image dimensions.
+        :param areas: iterable of :class:`.Area` instances to be considered in
+                      calculating the size.
+
+        """
+        return None
+
+    def adjust_draft(self, image, dims, areas=None):
+        """
+        Like :meth:`adjust`, but ``image`` has been decoded at a reduced
+        scale (for example with :meth:`PIL.Image.Image.draft`). The result
+        must have the same dimensions :meth:`adjust` would give for the full
+        resolution image.
+
+        :param image: Reduced-scale PIL Image which will be adjusted.
+        :param dims: ``(width, height)`` tuple of the full image dimensions.
+        :param areas: iterable of :class:`.Area` instances to be considered in
+                      performing the adjustment.
+
+        """
+        raise NotImplementedError
+
 
 @registry.register
 class Fit(Adjustment):
@@ -128,13 +231,44 @@ class Fit(Adjustment):
         # Choose a resize filter based on whether
         # we're upscaling or downscaling.
         if new_width < image_width:
-            f = Image.ANTIALIAS
-        else:
-            f = Image.BICUBIC
+            return exif_aware_resize(image, (new_width, new_height),
+                                     Image.ANTIALIAS,
+                                     reducing_gap=_get_reducing_gap())
 
-        return exif_aware_resize(image, (new_width, new_height), f)
+        return exif_aware_resize(image, (new_width, new_height),
+                                 Image.BICUBIC)
     adjust.uses_areas = False
 
+    def adjust_box(self, image, box, areas=None):
+        if ORIENTATION_TO_TRANSPOSE.get(get_exif_orientation(image)):
+            # The box is in untransposed coordinates, but the resize happens
+            # after transposing; keep the two steps separate.
+            return self.adjust(image.crop(box), areas=areas)
+
+        box_width, box_height = box[2] - box[0], box[3] - box[1]
+        new_width, new_height = self.calculate((box_width, box_height))
+
+        if (new_width, new_height) == (box_width, box_height):
+            return image.crop(box)
+
+        if new_width < box_width:
+            return resize(image, (new_width, new_height), Image.ANTIALIAS,
+                          box=box, reducing_gap=_get_reducing_gap())
+
+        return resize(image, (new_width, new_height), Image.BICUBIC, box=box)
+
+    def get_draft_size(self, dims, areas=None):
+        new_width, new_height = self.calculate(dims)
+        if new_width >= dims[0]:
+            return None
+        return new_width, new_height
+
+    def adjust_draft(self, image, dims, areas=None):
+        new_width, new_height = self.calculate(dims)
+        return exif_aware_resize(image, (new_width, new_height),
+                                 Image.ANTIALIAS,
+                                 reducing_gap=_get_reducing_gap())
+
 
 @registry.register
 class Crop(Adjustment):
@@ -160,39 +294,154 @@ class Crop(Adjustment):
     calculate.uses_areas = False
 
     def adjust(self, image, areas=None):
-        image_width, image_height = exif_aware_size(image)
-        new_width, new_height = self.calculate((image_width, image_height))
+        dims = exif_aware_size(image)
 
-        if (new_width, new_height) == (image_width, image_height):
+        if self.calculate(dims) == dims:
             return image.copy()
 
+        return image.crop(self.get_crop_box(dims, areas))
+
+    def get_crop_box(self, dims, areas=None):
+        image_width, image_height = dims
+        new_width, new_height = self.calculate(dims)
+
         if not areas:
             x1 = int((image_width - new_width) / 2)
             y1 = int((image_height - new_height) / 2)
         else:
-            min_penalty = None
-            optimal_coords = None
-
-            for x in range(image_width - new_width + 1):
-                for y in range(image_height - new_height + 1):
-                    penalty = 0
-                    for area in areas:
-                        penalty += self._get_penalty(area, x, y,
-                                                     new_width, new_height)
-                        if min_penalty is not None and penalty > min_penalty:
-                            break
-
-                    if min_penalty is None or penalty < min_penalty:
-                        min_penalty = penalty
-                        optimal_coords = [(x, y)]
-                    elif penalty == min_penalty:
-                        optimal_coords.append((x, y))
-            x1, y1 = optimal_coords[0]
+            x1, y1 = self._get_optimal_offset(areas,
+                                              (image_width, image_height),
+                                              (new_width, new_height))
 
         x2 = x1 + new_width
         y2 = y1 + new_height
 
-        return image.crop((x1, y1, x2, y2))
+        return x1, y1, x2, y2
+
+    def _get_optimal_offset(self, areas, dims, new_dims):
+        """
+        Returns the ``(x1, y1)`` offset of the crop which leaves the smallest
+        priority-weighted portion of ``areas`` outside the crop. Ties are
+        broken in favor of the smallest ``x1``, then the smallest ``y1``.
+
+        The result only depends on the dimensions and the areas' geometry,
+        so it is remembered in the DAGUERRE_OFFSET_CACHE cache under a key
+        derived from exactly those values.
+
+        """
+        cache_alias = getattr(settings, 'DAGUERRE_OFFSET_CACHE',
+                              DEFAULT_OFFSET_CACHE)
+        if cache_alias is None:
+            return self._search_optimal_offset(areas, dims, new_dims)
+
+        cache = caches[cache_alias]
+        key = self._get_offset_cache_key(areas, dims, new_dims)
+        offset = cache.get(key)
+        if offset is None:
+            offset = self._search_optimal_offset(areas, dims, new_dims)
+            cache.set(key, offset)
+        return tuple(offset)
+
+    def _get_offset_cache_key(self, areas, dims, new_dims):
+        # Area order is part of the key: it determines the order in which
+        # penalties are summed, and therefore how exact ties are broken.
+        geometry = [(area.x1, area.y1, area.x2, area.y2, area.priority)
+                    for area in areas]
+        return 'daguerre:offset:{0}'.format(
+            make_hash(dims, new_dims, geometry))
+
+    def _search_optimal_offset(self, areas, dims, new_dims):
+        """
+        Searches every possible offset for the one :meth:`_get_optimal_offset`
+        should return. If numpy is installed, all candidate offsets are
+        scored at once; otherwise each offset is checked in turn.
+
+        """
+        if numpy is None:
+            return self._get_optimal_offset_python(areas, dims, new_dims)
+        return self._get_optimal_offset_numpy(areas, dims, new_dims)
+
+    def _get_optimal_offset_python(self, areas, dims, new_dims):
+        image_width, image_height = dims
+        new_width, new_height = new_dims
+        min_penalty = None
+        optimal_coords = None
+
+        for x in range(image_width - new_width + 1):
+            for y in range(image_height - new_height + 1):
+                penalty = 0
+                for area in areas:
+                    penalty += self._get_penalty(area, x, y,
+                                                 new_width, new_height)
+                    if min_penalty is not None and penalty > min_penalty:
+                        break
+
+                if min_penalty is None or penalty < min_penalty:
+                    min_penalty = penalty
+                    optimal_coords = [(x, y)]
+                elif penalty == min_penalty:
+                    optimal_coords.append((x, y))
+        return optimal_coords[0]
+
+    #: Maximum number of candidate offsets scored at once by the numpy
+    #: search. Bounds the size of the temporary arrays for large images.
+    offset_chunk_size = 2 ** 20
+
+    def _get_optimal_offset_numpy(self, areas, dims, new_dims):
+        image_width, image_height = dims
+        new_width, new_height = new_dims
+        xs = numpy.arange(image_width - new_width + 1, dtype=numpy.int64)
+        ys = numpy.arange(image_height - new_height + 1, dtype=numpy.int64)
+
+        # The per-axis terms of _get_penalty only depend on x or on y, so
+        # they're computed once per area and broadcast against each other.
+        axes = [(self._get_axis_overlap(xs, new_width, area.x1, area.x2),
+                 self._get_axis_overlap(ys, new_height, area.y1, area.y2))
+                for area in areas]
+
+        rows = max(1, self.offset_chunk_size // len(ys))
+        min_penalty = None
+        optimal_coords = None
+        for start in range(0, len(xs), rows):
+            stop = start + rows
+            penalty = numpy.zeros((len(xs[start:stop]), len(ys)))
+            # Accumulate in the same order as the pure-python search so that
+            # floating point ties are resolved identically.
+            for area, (x_axis, y_axis) in zip(areas, axes):
+                x_enclosed, x_excluded, x_overlap = (a[start:stop, None]
+                                                     for a in x_axis)
+                y_enclosed, y_excluded, y_overlap = (a[None, :]
+                                                     for a in y_axis)
+                penalty_area = area.area - x_overlap * y_overlap
+                penalty_area = numpy.where(x_excluded | y_excluded,
+                                           area.area, penalty_area)
+                penalty_area = numpy.where(x_enclosed & y_enclosed,
+                                           0, penalty_area)
+                penalty += penalty_area / area.priority
+
+            # argmin returns the first minimum in row-major order, which
+            # matches the x-then-y iteration order of the python search.
+            index = int(penalty.argmin())
+            value = penalty.flat[index]
+            if min_penalty is None or value < min_penalty:
+                min_penalty = value
+                x, y = divmod(index, len(ys))
+                optimal_coords = (int(xs[start + x]), int(ys[y]))
+        return optimal_coords
+
+    def _get_axis_overlap(self, offsets, length, start, end):
+        """
+        Vectorized version of the single-axis checks in :meth:`_get_penalty`
+        for every offset in ``offsets``. Returns ``(enclosed, excluded,
+        overlap)`` arrays.
+
+        """
+        ends = offsets + length
+        enclosed = (start >= offsets) & (end <= ends)
+        excluded = (end < offsets) | (start > ends)
+        overlap = numpy.minimum(numpy.minimum(end - offsets, ends - start),
+                                end - start)
+        return enclosed, excluded, overlap
 
     def _get_penalty(self, area, x1, y1, new_width, new_height):
         x2 = x1 + new_width
@@ -286,6 +535,12 @@ class NamedCrop(Adjustment):
         return image.crop((area.x1, area.y1,
                            area.x2, area.y2))
 
+    def get_crop_box(self, dims, areas=None):
+        for area in areas or ():
+            if area.name == self.kwargs['name']:
+                return area.x1, area.y1, area.x2, area.y2
+        return (0, 0) + tuple(dims)
+
 
 @registry.register
 class Fill(Adjustment):
@@ -336,7 +591,55 @@ class Fill(Adjustment):
             return image.copy()
 
         ratiocrop = RatioCrop(ratio="{0}:{1}".format(new_width, new_height))
-        new_image = ratiocrop.adjust(image, areas=areas)
+        box = ratiocrop.get_crop_box((image_width, image_height), areas)
+
+        fit = Fit(width=new_width, height=new_height)
+        return fit.adjust_box(image, box)
+
+    def get_areas_key(self, dims, areas=None):
+        new_width, new_height = self.calculate(dims)
+        if (new_width, new_height) == tuple(dims):
+            return (0, 0) + tuple(dims)
+        ratiocrop = RatioCrop(ratio="{0}:{1}".format(new_width, new_height))
+        return ratiocrop.get_crop_box(dims, areas)
 
+    def get_draft_size(self, dims, areas=None):
+        new_width, new_height = self.calculate(dims)
+        if (new_width, new_height) == dims:
+            return None
+
+        ratiocrop = RatioCrop(ratio="{0}:{1}".format(new_width, new_height))
+        crop_width, crop_height = ratiocrop.calculate(dims)
+        if new_width >= crop_width:
+            return None
+
+        # The cropped part of the image must still be at least as large as
+        # the requested dimensions.
+        scale = max(float(new_width) / crop_width,
+                    float(new_height) / crop_height)
+        return (int(math.ceil(dims[0] * scale)),
+                int(math.ceil(dims[1] * scale)))
+
+    def adjust_draft(self, image, dims, areas=None):
+        new_width, new_height = self.calculate(dims)
+        ratiocrop = RatioCrop(ratio="{0}:{1}".format(new_width, new_height))
+        crop_dims = ratiocrop.calculate(dims)
         fit = Fit(width=new_width, height=new_height)
-        return fit.adjust(new_image)
+
+        # The crop box is calculated at full resolution (so that areas are
+        # protected exactly as they are by adjust()) and then scaled down
+        # to the decoded image.
+        if exif_aware_size(image) == image.size:
+            full_width, full_height = dims
+        else:
+            full_height, full_width = dims
+        x_scale = float(image.size[0]) / full_width
+        y_scale = float(image.size[1]) / full_height
+        x1, y1, x2, y2 = ratiocrop.get_crop_box(dims, areas)
+        new_image = image.crop((int(round(x1 * x_scale)),
+                                int(round(y1 * y_scale)),
+                                int(round(x2 * x_scale)),
+                                int(round(y2 * y_scale))))
+        return exif_aware_resize(new_image, fit.calculate(crop_dims),
+                                 Image.ANTIALIAS,
+                                 reducing_gap=_get_reducing_gap())
@@ -1,12 +1,18 @@
 import datetime
 import http.client
+import io
 import itertools
+import math
 import ssl
 import struct
+import threading
+import time
 
 from django.conf import settings
+from django.core.cache import caches
 from django.core.files.base import File
 from django.core.files.storage import default_storage
+from django.db import connection
 from django.http import QueryDict
 from django.template import Variable, VariableDoesNotExist, TemplateSyntaxError
 from django.urls import reverse
@@ -17,8 +23,12 @@ except ImportError:
     jingo = None
 
 from daguerre.adjustments import registry, Adjustment
-from daguerre.models import Area, AdjustedImage
-from daguerre.utils import make_hash, save_image, get_image_dimensions, KEEP_FORMATS, DEFAULT_FORMAT
+from daguerre.models import (Area, AdjustedImage, AdjustmentJob,
+                             DEFAULT_QUEUE_OPTIONS, delete_adjusted_files,
+                             get_info_cache, get_info_versions,
+                             get_queue_options, invalidate_info_cache,
+                             lookup_cache, make_info_key)
+from daguerre.utils import make_hash, save_image, get_image_info, exif_aware_size, timed, KEEP_FORMATS, DEFAULT_FORMAT
 
 # If any of the following errors appear during file manipulations, we will
 # treat them as IOErrors.
@@ -34,6 +44,65 @@ else:
                            boto.exception.S3ResponseError)
 
 
+#: Cache alias used to remember the dimensions of original images. Can be
+#: overridden with the DAGUERRE_DIMENSIONS_CACHE setting; by default the
+#: dimensions are read from storage every time.
+DEFAULT_DIMENSIONS_CACHE = None
+
+
+def get_dimensions_cache():
+    alias = getattr(settings, 'DAGUERRE_DIMENSIONS_CACHE',
+                    DEFAULT_DIMENSIONS_CACHE)
+    if alias is None:
+        return None
+    return caches[alias]
+
+
+def make_dimensions_key(storage_path):
+    return 'daguerre:dimensions:{0}'.format(make_hash(storage_path))
+
+
+#: Options for the generation lock; see the DAGUERRE_GENERATION_LOCK setting.
+DEFAULT_LOCK_OPTIONS = {
+    # Cache alias the locks are kept in. It must be shared by every process
+    # which generates adjusted images.
+    'CACHE': 'default',
+    # Seconds after which a lock is assumed to have been abandoned, and
+    # after which waiting requests give up and generate the image anyway.
+    'TIMEOUT': 30,
+    # Seconds between checks for the adjusted image while waiting.
+    'POLL_INTERVAL': 0.1,
+}
+
+
+def get_lock_options():
+    """
+    Returns the options for the generation lock from the
+    DAGUERRE_GENERATION_LOCK setting, or None if concurrent requests for
+    the same adjusted image each generate it (the default).
+
+    """
+    options = getattr(settings, 'DAGUERRE_GENERATION_LOCK', None)
+    if options is None:
+        return None
+    return dict(DEFAULT_LOCK_OPTIONS, **options)
+
+
+def make_lock_key(storage_path, requested):
+    return 'daguerre:lock:{0}'.format(make_hash(storage_path, requested))
+
+
+def probe_image(storage_path):
+    """
+    Reads the ``(width, height, orientation)`` of the original image at
+    ``storage_path`` from storage. Width and height account for Exif
+    orientation. Returns ``(None, None, None)`` if they can't be determined.
+
+    """
+    with default_storage.open(storage_path, 'rb') as im_file:
+        return get_image_info(im_file)
+
+
 def adjust(path_or_iterable, adjustment=None, lookup=None, generate=False, **kwargs):
     if isinstance(path_or_iterable, AdjustmentHelper):
         helper = path_or_iterable
@@ -71,6 +140,10 @@ class AdjustmentHelper(object):
     }
     param_sep = '|'
     adjustment_sep = '>'
+    # When decoding at a reduced scale, decode at least this many times the
+    # size the first adjustment strictly needs, so that the final resample
+    # still has some detail to work with.
+    draft_headroom = 2
 
     def __init__(self, iterable, lookup=None, generate=False):
         # generate: whether iterating over this object should actually
@@ -83,6 +156,9 @@ class AdjustmentHelper(object):
         self.adjusted = {}
         self.adjust_uses_areas = False
         self.calc_uses_areas = False
+        # A GenerationStats to record the cost of generating adjusted
+        # images in, if any.
+        self.stats = None
         self._finalized = False
 
         if lookup is None:
@@ -177,6 +253,30 @@ class AdjustmentHelper(object):
             adj_list.append(adj_cls(**kwargs))
         return adj_list
 
+    @classmethod
+    def areas_change(cls, requested, dims, old_areas, new_areas):
+        """
+        Returns whether the ``requested`` adjustments of an image with
+        dimensions ``dims`` could give a different result with
+        ``new_areas`` than with ``old_areas``.
+
+        """
+        try:
+            adjustments = cls._deserialize_requested(requested)
+        except (KeyError, IndexError, ValueError):
+            return True
+        for adjustment in adjustments:
+            if getattr(adjustment.adjust, 'uses_areas', True):
+                key = adjustment.get_areas_key(dims, old_areas)
+                if (key is None or
+                        key != adjustment.get_areas_key(dims, new_areas)):
+                    return True
+            new_dims = adjustment.calculate(dims, areas=old_areas)
+            if new_dims != adjustment.calculate(dims, areas=new_areas):
+                return True
+            dims = new_dims
+        return False
+
     def get_query_kwargs(self):
         kwargs = {
             'requested': self.requested
@@ -190,11 +290,70 @@ class AdjustmentHelper(object):
     def get_areas(self, storage_path):
         if not hasattr(self, '_areas'):
             self._areas = {}
-            areas = Area.objects.filter(storage_path__in=self.remaining)
+            # storage_path isn't remaining when an adjusted image is
+            # generated directly, for instance when regenerating it.
+            paths = set(self.remaining)
+            paths.add(storage_path)
+            areas = Area.objects.filter(storage_path__in=paths)
             for area in areas:
                 self._areas.setdefault(area.storage_path, []).append(area)
         return self._areas.get(storage_path, [])
 
+    def get_dimensions(self, storage_path):
+        """
+        Returns the ``(width, height)`` of the original image at
+        ``storage_path``. Dimensions are looked up in the
+        DAGUERRE_DIMENSIONS_CACHE cache (in bulk for all remaining paths)
+        and only read from storage on a miss. Returns ``(None, None)`` if
+        they can't be determined; may raise an IOError.
+
+        """
+        cache = get_dimensions_cache()
+        if not hasattr(self, '_dimensions'):
+            self._dimensions = {}
+            self._dimensions_fetched = set(self.remaining)
+            if cache is not None:
+                keys = dict((make_dimensions_key(path), path)
+                            for path in self.remaining)
+                for key, info in cache.get_many(list(keys)).items():
+                    self._dimensions[keys[key]] = info
+        if storage_path not in self._dimensions:
+            info = None
+            key = make_dimensions_key(storage_path)
+            if (cache is not None and
+                    storage_path not in self._dimensions_fetched):
+                info = cache.get(key)
+            if info is None:
+                info = probe_image(storage_path)
+                if cache is not None and info[0] is not None:
+                    cache.set(key, info)
+            self._dimensions[storage_path] = info
+        return tuple(self._dimensions[storage_path][:2])
+
+    def estimate_cost(self, storage_path):
+        """
+        Returns a rough estimate of the work needed to generate this
+        helper's adjustments for ``storage_path``: the number of pixels in
+        the original plus the number produced by each adjustment, as given
+        by their :meth:`~.Adjustment.calculate` methods. Returns None if the
+        original's dimensions can't be determined; may raise an IOError.
+
+        """
+        width, height = self.get_dimensions(storage_path)
+        if width is None:
+            return None
+
+        if self.calc_uses_areas:
+            areas = list(Area.objects.filter(storage_path=storage_path))
+        else:
+            areas = None
+
+        cost = width * height
+        for adjustment in self.adjustments:
+            width, height = adjustment.calculate((width, height), areas=areas)
+            cost += width * height
+        return cost
+
     @classmethod
     def make_security_hash(cls, kwargs):
         keys_sorted = sorted(kwargs.keys())
@@ -240,10 +399,14 @@ class AdjustmentHelper(object):
         return helper
 
     def _adjusted_image_info_dict(self, adjusted_image):
-        try:
-            width, height = adjusted_image.adjusted._get_image_dimensions()
-        except IOERRORS:
-            return AdjustmentInfoDict()
+        width, height = adjusted_image.width, adjusted_image.height
+        if width is None or height is None:
+            # Adjusted before dimensions were stored; read them from the
+            # file instead.
+            try:
+                width, height = adjusted_image.adjusted._get_image_dimensions()
+            except IOERRORS:
+                return AdjustmentInfoDict()
 
         return AdjustmentInfoDict({
             'width': width,
@@ -253,12 +416,11 @@ class AdjustmentHelper(object):
 
     def _path_info_dict(self, storage_path):
         try:
-            with default_storage.open(storage_path, 'rb') as im_file:
-                width, height = get_image_dimensions(im_file)
-        except IOERRORS + (TypeError,):
-            # TypeError will be raised if for any reason storage_path's
-            # dimensions can't be determined. get_image_dimensions will
-            # return None, which can't be split into width and height.
+            width, height = self.get_dimensions(storage_path)
+        except IOERRORS:
+            return AdjustmentInfoDict()
+        if width is None:
+            # storage_path's dimensions couldn't be determined.
             return AdjustmentInfoDict()
 
         if self.calc_uses_areas:
@@ -304,6 +466,30 @@ class AdjustmentHelper(object):
             else:
                 self.adjusted[item] = AdjustmentInfoDict()
 
+        info_cache = get_info_cache()
+        info_keys = {}
+        built = {}
+        if self.remaining and info_cache is not None:
+            # The versions are read before the database, so that anything
+            # changed after that is written under a version which has been
+            # replaced by then.
+            versions = get_info_versions(info_cache, self.remaining)
+            info_keys = dict(
+                (path, make_info_key(path, self.requested, version))
+                for path, version in versions.items())
+            keys = dict((key, path) for path, key in info_keys.items())
+            for key, info_dict in info_cache.get_many(list(keys)).items():
+                # Info dicts with an ajax_url are for adjustments which
+                # haven't been generated yet.
+                if not (self.generate and 'ajax_url' in info_dict):
+                    self._resolve(keys[key], AdjustmentInfoDict(info_dict))
+
+        if self.remaining:
+            cached = lookup_cache.get_many(self.requested, self.remaining)
+            for path, adjusted_image in cached.items():
+                info_dict = self._adjusted_image_info_dict(adjusted_image)
+                built[path] = self._resolve(path, info_dict)
+
         if self.remaining:
             query_kwargs = self.get_query_kwargs()
             adjusted_images = AdjustedImage.objects.filter(**query_kwargs
@@ -312,13 +498,12 @@ class AdjustmentHelper(object):
                 path = adjusted_image.storage_path
                 if path not in self.remaining:
                     continue
+                lookup_cache.add(self.requested, adjusted_image)
                 info_dict = self._adjusted_image_info_dict(adjusted_image)
-                for item in self.remaining[path]:
-                    self.adjusted[item] = info_dict
-                del self.remaining[path]
+                built[path] = self._resolve(path, info_dict)
 
         if self.remaining:
-            for path, items in self.remaining.copy().items():
+            for path in list(self.remaining):
                 if self.generate is True:
                     try:
                         adjusted_image = self._generate(path)
@@ -328,22 +513,105 @@ class AdjustmentHelper(object):
                         info_dict = self._adjusted_image_info_dict(adjusted_image)
                 else:
                     info_dict = self._path_info_dict(path)
-                for item in items:
-                    self.adjusted[item] = info_dict
-                del self.remaining[path]
-
-    def _generate(self, storage_path):
-        # May raise IOError if the file doesn't exist or isn't a valid image.
-
-        # If we're here, we can assume that the adjustment doesn't already
-        # exist. Try to create one from the storage path. Raises IOError if
-        # something goes wrong.
-        kwargs = {
-            'requested': self.requested,
-            'storage_path': storage_path
-        }
-
-        with default_storage.open(storage_path, 'rb') as im_file:
+                built[path] = self._resolve(path, info_dict)
+
+        if info_keys:
+            # Empty info dicts mean something went wrong; don't cache them.
+            entries = dict((info_keys[path], dict(info_dict))
+                           for path, info_dict in built.items() if info_dict)
+            if entries:
+                info_cache.set_many(entries)
+
+    def _resolve(self, path, info_dict):
+        """
+        Assigns ``info_dict`` to all items with the given path and marks the
+        path as done. Returns the info dict.
+
+        """
+        for item in self.remaining.pop(path):
+            self.adjusted[item] = info_dict
+        return info_dict
+
+    def _apply(self, image, adjustments, areas=None):
+        """
+        Applies ``adjustments`` to ``image`` in order. A crop which is
+        followed by another adjustment is passed on to that adjustment as a
+        box, so that (for example) ``crop>fit`` is done with a single
+        resample and no intermediate copy of the cropped region.
+
+        """
+        adjustments = list(adjustments)
+        while adjustments:
+            adjustment = adjustments.pop(0)
+            name = adjustment.__class__.__name__.lower()
+            if adjustments:
+                box = adjustment.get_crop_box(exif_aware_size(image),
+                                              areas=areas)
+                if box is not None:
+                    adjustment = adjustments.pop(0)
+                    name = self.adjustment_sep.join(
+                        (name, adjustment.__class__.__name__.lower()))
+                    with timed(self.stats, name):
+                        image = adjustment.adjust_box(image, box, areas=areas)
+                    continue
+            with timed(self.stats, name):
+                image = adjustment.adjust(image, areas=areas)
+        return image
+
+    def _draft(self, image, areas=None, helpers=None):
+        """
+        Configures ``image`` (which must not be loaded yet) to be decoded at
+        a reduced scale if the first adjustment doesn't need it at full
+        resolution. Only some formats (such as JPEG) support this. If
+        ``helpers`` are given, the image is decoded large enough for all of
+        their first adjustments instead.
+
+        Returns the full-resolution dimensions if the decoded size was
+        reduced; otherwise returns None.
+
+        """
+        dims = exif_aware_size(image)
+        draft_sizes = [helper.adjustments[0].get_draft_size(dims, areas=areas)
+                       for helper in helpers or [self]]
+        if None in draft_sizes:
+            return None
+
+        width, height = (int(math.ceil(max(sizes) * self.draft_headroom))
+                         for sizes in zip(*draft_sizes))
+        if dims != image.size:
+            # The image will be rotated according to its Exif data.
+            width, height = height, width
+
+        size = image.size
+        image.draft(image.mode, (width, height))
+        if image.size == size:
+            return None
+        return dims
+
+    def _read(self, storage_path):
+        """
+        Opens the original image at ``storage_path``. If stats are being
+        recorded, it's read into memory up front, so that waiting for
+        storage isn't counted as decoding.
+
+        """
+        stats = self.stats
+        with timed(stats, 'read'):
+            im_file = default_storage.open(storage_path, 'rb')
+            if stats is not None:
+                with im_file:
+                    content = im_file.read()
+                stats.bytes_read += len(content)
+                im_file = io.BytesIO(content)
+        return im_file
+
+    def _verify(self, im_file):
+        """
+        Returns an image (not loaded yet) for ``im_file``. Raises an IOError
+        if it isn't a valid image.
+
+        """
+        with timed(self.stats, 'decode'):
             im = Image.open(im_file)
             try:
                 im.verify()
@@ -351,17 +619,36 @@ class AdjustmentHelper(object):
                 # Raise an IOError if the image isn't valid.
                 raise IOError
             im_file.seek(0)
-            im = Image.open(im_file)
-            im.load()
-        format = im.format if im.format in KEEP_FORMATS else DEFAULT_FORMAT
-
-        if self.adjust_uses_areas:
-            areas = self.get_areas(storage_path)
-        else:
-            areas = None
-
-        for adjustment in self.adjustments:
-            im = adjustment.adjust(im, areas=areas)
+            return Image.open(im_file)
+
+    def _adjust_image(self, im, draft_dims=None, areas=None):
+        """
+        Applies the adjustments to the loaded image ``im``; ``draft_dims``
+        is the return value of :meth:`_draft`.
+
+        """
+        adjustments = self.adjustments
+        if draft_dims is not None:
+            adjustment = adjustments[0]
+            with timed(self.stats, adjustment.__class__.__name__.lower()):
+                im = adjustment.adjust_draft(im, draft_dims, areas=areas)
+            adjustments = adjustments[1:]
+
+        return self._apply(im, adjustments, areas=areas)
+
+    def _save(self, storage_path, im, format, replace=None):
+        """
+        Saves ``im`` as the adjusted image of ``storage_path`` and returns
+        its :class:`.AdjustedImage`, or the one created in the meantime by
+        someone else. If ``replace`` (an :class:`.AdjustedImage`) is given,
+        it's switched over to the new file instead.
+
+        """
+        kwargs = {
+            'requested': self.requested,
+            'storage_path': storage_path
+        }
+        stats = self.stats
 
         adjusted = AdjustedImage(**kwargs)
         f = adjusted._meta.get_field('adjusted')
@@ -371,14 +658,200 @@ class AdjustmentHelper(object):
         storage_path = f.generate_filename(adjusted, filename)
 
         final_path = save_image(im, storage_path, format=format,
-                                storage=default_storage)
+                                storage=default_storage, stats=stats)
+        if replace is not None:
+            return self._replace(replace, final_path, im.size)
         # Try to handle race conditions gracefully.
         try:
-            adjusted = AdjustedImage.objects.filter(**kwargs
-                                                    ).only('adjusted')[:1][0]
+            adjusted = AdjustedImage.objects.filter(**kwargs).only(
+                'adjusted', 'width', 'height')[:1][0]
         except IndexError:
             adjusted.adjusted = final_path
+            adjusted.width, adjusted.height = im.size
             adjusted.save()
         else:
             default_storage.delete(final_path)
+        if stats is not None:
+            stats.count += 1
+        return adjusted
+
+    def _replace(self, adjusted, path, size):
+        """
+        Switches ``adjusted`` over to the new adjusted image file at
+        ``path`` with a single update, so that it's served until then. If
+        ``adjusted`` was changed, deleted or marked stale again in the
+        meantime, the new file is deleted instead (and ``adjusted`` is left
+        stale). Returns ``adjusted``.
+
+        """
+        old_path = adjusted.adjusted.name
+        width, height = size
+        switched = AdjustedImage.objects.filter(
+            pk=adjusted.pk, adjusted=old_path, revision=adjusted.revision,
+        ).update(adjusted=path, width=width, height=height, stale=False)
+        if not switched:
+            default_storage.delete(path)
+            return adjusted
+        adjusted.adjusted = path
+        adjusted.width, adjusted.height = width, height
+        adjusted.stale = False
+        # update() doesn't send signals.
+        lookup_cache.invalidate(adjusted)
+        invalidate_info_cache([adjusted.storage_path])
+        delete_adjusted_files([old_path])
+        if self.stats is not None:
+            self.stats.count += 1
         return adjusted
+
+    def _generate(self, storage_path, replace=None):
+        """
+        Generates the adjusted image of ``storage_path``. If the generation
+        lock is enabled, only one request generates each adjusted image at
+        a time; the others wait for its :class:`.AdjustedImage`.
+
+        """
+        options = get_lock_options()
+        if options is None or replace is not None:
+            return self._generate_image(storage_path, replace=replace)
+
+        cache = caches[options['CACHE']]
+        key = make_lock_key(storage_path, self.requested)
+        kwargs = {
+            'requested': self.requested,
+            'storage_path': storage_path,
+        }
+        deadline = time.time() + options['TIMEOUT']
+        waited = locked = False
+        while True:
+            locked = cache.add(key, True, options['TIMEOUT'])
+            if waited or not locked:
+                # Someone else is (or was) generating it.
+                adjusted = AdjustedImage.objects.filter(**kwargs).only(
+                    'adjusted', 'width', 'height').first()
+                if adjusted is not None:
+                    if locked:
+                        cache.delete(key)
+                    return adjusted
+            if locked or time.time() >= deadline:
+                # Generate it, giving up on the other request if need be.
+                break
+            waited = True
+            time.sleep(options['POLL_INTERVAL'])
+
+        try:
+            return self._generate_image(storage_path)
+        finally:
+            if locked:
+                cache.delete(key)
+
+    def _generate_image(self, storage_path, replace=None):
+        # May raise IOError if the file doesn't exist or isn't a valid image.
+
+        # If we're here, we can assume that the adjustment doesn't already
+        # exist. Try to create one from the storage path. Raises IOError if
+        # something goes wrong.
+        with self._read(storage_path) as im_file:
+            im = self._verify(im_file)
+
+            if self.adjust_uses_areas:
+                areas = self.get_areas(storage_path)
+            else:
+                areas = None
+
+            with timed(self.stats, 'decode'):
+                draft_dims = self._draft(im, areas=areas)
+                im.load()
+        format = im.format if im.format in KEEP_FORMATS else DEFAULT_FORMAT
+
+        im = self._adjust_image(im, draft_dims, areas=areas)
+        return self._save(storage_path, im, format, replace=replace)
+
+
+def generate_many(storage_path, helpers):
+    """
+    Generates adjusted images of ``storage_path`` for each of ``helpers``,
+    reading and decoding the original only once, at a scale large enough
+    for all of them. Returns a list with the :class:`.AdjustedImage` for
+    each helper, or None where its adjustments failed. May raise an IOError
+    if the original can't be read.
+
+    """
+    first = helpers[0]
+    if any(helper.adjust_uses_areas for helper in helpers):
+        areas = list(Area.objects.filter(storage_path=storage_path))
+    else:
+        areas = None
+
+    with first._read(storage_path) as im_file:
+        im = first._verify(im_file)
+        with timed(first.stats, 'decode'):
+            draft_dims = first._draft(im, areas=areas, helpers=helpers)
+            im.load()
+    format = im.format if im.format in KEEP_FORMATS else DEFAULT_FORMAT
+
+    adjusted_images = []
+    for helper in helpers:
+        try:
+            adjusted = helper._save(
+                storage_path,
+                helper._adjust_image(im, draft_dims, areas=areas),
+                format)
+        except IOERRORS:
+            adjusted = None
+        adjusted_images.append(adjusted)
+    return adjusted_images
+
+
+def regenerate(adjusted_image):
+    """
+    Generates a stale :class:`.AdjustedImage` again, switching it over to
+    the new file once that's ready. ``adjusted_image`` must have been
+    loaded after it was last marked stale; if it's marked stale again
+    while it's being generated, it isn't switched over. May raise an
+    IOError if the original can't be read.
+
+    """
+    helper = AdjustmentHelper([adjusted_image.storage_path])
+    for adjustment in helper._deserialize_requested(adjusted_image.requested):
+        helper.adjust(adjustment)
+    return helper._generate(adjusted_image.storage_path,
+                            replace=adjusted_image)
+
+
+def _regenerate_stale(pks):
+    try:
+        for adjusted_image in AdjustedImage.objects.filter(pk__in=pks,
+                                                           stale=True):
+            try:
+                regenerate(adjusted_image)
+            except IOERRORS:
+                # Keep serving it; it stays stale.
+                pass
+    finally:
+        connection.close()
+
+
+def revalidate(pks, mode):
+    """
+    Regenerates the stale AdjustedImages with the given ``pks``: in a
+    background thread if ``mode`` is ``"thread"``, or by queueing them for
+    ``manage.py daguerre worker`` if it's ``"queue"``.
+
+    """
+    if mode == 'queue':
+        options = get_queue_options() or DEFAULT_QUEUE_OPTIONS
+        for storage_path, requested in AdjustedImage.objects.filter(
+                pk__in=pks).values_list('storage_path', 'requested'):
+            # A worker may already be regenerating it with the old areas.
+            AdjustmentJob.objects.enqueue(
+                storage_path, requested,
+                timeout=options['CLAIM_TIMEOUT'],
+                max_attempts=options['MAX_ATTEMPTS'],
+                requeue=True)
+    elif mode == 'thread':
+        thread = threading.Thread(target=_regenerate_stale, args=(pks,))
+        thread.daemon = True
+        thread.start()
+    else:
+        raise ValueError("DAGUERRE_REVALIDATE must be None, 'thread' or "
+                         "'queue'.")
@@ -0,0 +1,51 @@
+from django.core.management.base import BaseCommand
+from django.db import models
+from django.template.defaultfilters import pluralize
+
+from daguerre.helpers import IOERRORS
+from daguerre.models import AdjustedImage
+
+
+class Command(BaseCommand):
+    def _missing_dimensions(self):
+        """
+        Returns a queryset of AdjustedImages which don't have their
+        dimensions stored yet.
+
+        """
+        return AdjustedImage.objects.filter(
+            models.Q(width__isnull=True) | models.Q(height__isnull=True)
+        ).only('adjusted')
+
+    def handle(self, **options):
+        queryset = self._missing_dimensions()
+        count = queryset.count()
+        if count == 0:
+            self.stdout.write("No adjusted images are missing dimensions.\n")
+        else:
+            self.stdout.write(
+                "Storing dimensions for {0} adjusted image{1}... ".format(
+                    count,
+                    pluralize(count)))
+            self.stdout.flush()
+
+            failed_count = 0
+            for adjusted_image in queryset.iterator():
+                try:
+                    width, height = (
+                        adjusted_image.adjusted._get_image_dimensions())
+                except IOERRORS:
+                    width = height = None
+                if width is None or height is None:
+                    failed_count += 1
+                    continue
+                AdjustedImage.objects.filter(pk=adjusted_image.pk).update(
+                    width=width, height=height)
+            self.stdout.write("Done.\n")
+            if failed_count:
+                self.stdout.write(
+                    "{0} adjusted image{1} couldn't be read.\n".format(
+                        failed_count,
+                        pluralize(failed_count)))
+
+        self.stdout.write("\n")
@@ -1,4 +1,8 @@
+import json
 import os
+import posixpath
+import time
+from concurrent.futures import ThreadPoolExecutor
 
 from django.conf import settings
 from django.core.files.storage import default_storage
@@ -6,36 +10,181 @@ from django.core.management.base import BaseCommand
 from django.db import models
 from django.template.defaultfilters import pluralize
 
-from daguerre.helpers import IOERRORS
+from daguerre.helpers import (IOERRORS, get_dimensions_cache,
+                              make_dimensions_key)
 from daguerre.models import AdjustedImage, Area, DEFAULT_ADJUSTED_IMAGE_PATH
 
 
+THREADS_OPTION_KWARGS = {
+    'type': int,
+    'dest': 'threads',
+    'default': 8,
+    'help': "Check this many storage paths at once.",
+}
+
+MAX_SECONDS_OPTION_KWARGS = {
+    'type': float,
+    'dest': 'max_seconds',
+    'default': None,
+    'help': "Stop after this many seconds. Use with --cursor-file to "
+            "continue from there next time.",
+}
+
+CURSOR_FILE_OPTION_KWARGS = {
+    'dest': 'cursor_file',
+    'default': None,
+    'help': "Record where each pass got to in this file, and continue from "
+            "there.",
+}
+
+
 class Command(BaseCommand):
-    def _delete_queryset(
+    #: How many storage paths are checked at once.
+    threads = 8
+    #: Directories with at least this many paths to check are listed once
+    #: instead of checking each path, if the storage can list directories.
+    listdir_threshold = 10
+    #: How many duplicate adjusted images are deleted, or files looked up,
+    #: at a time.
+    batch_size = 1000
+    #: How many storage paths checked by the old adjustments pass are
+    #: remembered for the old areas pass, at most.
+    known_paths_size = 100000
+    #: When to stop (as a timestamp), if ever.
+    deadline = None
+    #: Where each pass got to, if it's being recorded.
+    cursor = None
+    cursor_file = None
+
+    def add_arguments(self, parser):
+        parser.add_argument('--threads', **THREADS_OPTION_KWARGS)
+        parser.add_argument('--max-seconds', **MAX_SECONDS_OPTION_KWARGS)
+        parser.add_argument('--cursor-file', **CURSOR_FILE_OPTION_KWARGS)
+
+    def _load_cursor(self):
+        try:
+            with open(self.cursor_file) as f:
+                return json.load(f)
+        except (IOError, ValueError):
+            return {}
+
+    def _save_cursor(self):
+        if self.cursor_file is not None:
+            with open(self.cursor_file, 'w') as f:
+                json.dump(self.cursor, f)
+
+    def _advance(self, name, position):
+        """Records that pass ``name`` got as far as ``position``."""
+        if self.cursor is not None:
+            self.cursor[name] = position
+            self._save_cursor()
+
+    def _finish(self, name):
+        """Records that pass ``name`` is done until the next sweep."""
+        if self.cursor is not None:
+            self.cursor.pop(name, None)
+            self.cursor.setdefault('done', []).append(name)
+            self._save_cursor()
+
+    def _is_finished(self, name):
+        return name in (self.cursor or {}).get('done', ())
+
+    def _out_of_time(self):
+        return self.deadline is not None and time.time() >= self.deadline
+
+    def _report(
             self,
-            queryset,
+            model,
+            count,
             reason='reference nonexistant paths',
             reason_plural=None):
-        count = queryset.count()
         if count == 1:
-            name = str(queryset.model._meta.verbose_name)
+            name = str(model._meta.verbose_name)
             reason = reason
         else:
-            name = str(queryset.model._meta.verbose_name_plural)
+            name = str(model._meta.verbose_name_plural)
             reason = reason_plural or reason
         if count == 0:
             self.stdout.write(u"No {0} {1}.\n".format(name, reason))
         else:
-            self.stdout.write(u"Deleting {0} {1} which {2}... ".format(
+            self.stdout.write(u"Deleted {0} {1} which {2}.\n".format(
                 count, name, reason))
-            self.stdout.flush()
+
+    def _delete_queryset(self, queryset):
+        count = queryset.count()
+        if count:
             queryset.delete()
-            self.stdout.write("Done.\n")
+        return count
+
+    def _iter_values(self, name, queryset, field):
+        """
+        Yields lists of the distinct values of ``field`` in ``queryset``, in
+        order and ``self.batch_size`` at a time, starting after where pass
+        ``name`` got to. Stops early if time runs out.
 
-    def _walk(self, dirpath, topdown=True):
+        """
+        values = queryset.order_by(field).values_list(
+            field, flat=True).distinct()
+        after = (self.cursor or {}).get(name)
+        while not self._out_of_time():
+            if after is not None:
+                batch = values.filter(**{field + '__gt': after})
+            else:
+                batch = values
+            batch = list(batch[:self.batch_size])
+            if not batch:
+                break
+            yield batch
+            after = batch[-1]
+            self._advance(name, after)
+
+    def _run(
+            self,
+            name,
+            model,
+            field,
+            find,
+            reason='reference nonexistant paths',
+            reason_plural=None,
+            delete=None):
+        """
+        Runs pass ``name``: deletes whatever ``find`` returns for each batch
+        of distinct ``field`` values of ``model``. Returns whether the pass
+        is done.
+
+        """
+        if self._is_finished(name):
+            return True
+        if self._out_of_time():
+            return False
+        delete = delete or self._delete_queryset
+        count = 0
+        for values in self._iter_values(name, model.objects.all(), field):
+            count += delete(find(values))
+        self._report(model, count, reason, reason_plural)
+        if self._out_of_time():
+            return False
+        self._finish(name)
+        return True
+
+    def _walked(self, dirpath, after):
+        """
+        Returns whether a bottom-up walk in sorted order has already
+        walked ``dirpath`` (and everything in it) by the time it reaches
+        ``after``.
+
+        """
+        path, after = dirpath.split('/'), after.split('/')
+        if path[:len(after)] == after:
+            # Inside after.
+            return True
+        return path < after and after[:len(path)] != path
+
+    def _walk(self, dirpath, topdown=True, after=None):
         """
         Recursively walks the dir with default_storage.
-        Yields (dirpath, dirnames, filenames) tuples.
+        Yields (dirpath, dirnames, filenames) tuples. If ``after`` is given,
+        the bottom-up walk continues from there.
         """
         try:
             dirnames, filenames = default_storage.listdir(dirpath)
@@ -43,137 +192,295 @@ class Command(BaseCommand):
             # default_storage can't listdir, or dir doesn't exist
             # (local filesystem.)
             dirnames, filenames = [], []
+        dirnames = sorted(dirnames)
 
         if topdown:
             yield dirpath, dirnames, filenames
 
         for dirname in dirnames:
-            for value in self._walk(os.path.join(dirpath, dirname), topdown):
+            subpath = os.path.join(dirpath, dirname)
+            if after is not None and self._walked(subpath, after):
+                continue
+            for value in self._walk(subpath, topdown, after):
                 yield value
 
         if not topdown:
             yield dirpath, dirnames, filenames
 
-    def _old_adjustments(self):
+    def _check(self, task):
+        """
+        Takes a ``(dirname, paths)`` tuple and returns a dict mapping each
+        path to whether it exists. If ``dirname`` is given, it is listed
+        once instead of checking each path.
+
+        """
+        dirname, paths = task
+        if dirname is not None:
+            try:
+                filenames = set(default_storage.listdir(dirname)[1])
+            except (NotImplementedError, OSError):
+                # Fall back to checking each path.
+                pass
+            else:
+                return dict((path, posixpath.basename(path) in filenames)
+                            for path in paths)
+        return dict((path, default_storage.exists(path)) for path in paths)
+
+    def _missing_paths(self, paths, known=None):
+        """
+        Returns a list of those ``paths`` which don't exist in storage.
+        Paths are checked ``self.threads`` at a time, except for those in
+        ``known``, a dict mapping paths which have already been checked to
+        whether they exist.
+
+        """
+        known = known or {}
+        paths = list(paths)
+        by_dir = {}
+        for path in paths:
+            if path not in known:
+                by_dir.setdefault(posixpath.dirname(path), []).append(path)
+        tasks = []
+        for dirname, dir_paths in by_dir.items():
+            if len(dir_paths) >= self.listdir_threshold:
+                tasks.append((dirname, dir_paths))
+            else:
+                tasks.extend((None, [path]) for path in dir_paths)
+        exists = {}
+        if tasks:
+            with ThreadPoolExecutor(max(self.threads, 1)) as executor:
+                for checked in executor.map(self._check, tasks):
+                    exists.update(checked)
+        return [path for path in paths
+                if not exists.get(path, known.get(path))]
+
+    def _remember_paths(self, paths, missing):
+        """
+        Remembers whether each of the storage ``paths`` exists, up to
+        ``self.known_paths_size`` of them, so that the old areas pass
+        doesn't check them again.
+
+        """
+        if not hasattr(self, '_known_paths'):
+            self._known_paths = {}
+        missing = set(missing)
+        room = self.known_paths_size - len(self._known_paths)
+        for path in paths[:max(room, 0)]:
+            self._known_paths[path] = path not in missing
+
+    def _forget_dimensions(self, paths):
+        """
+        Drops the cached dimensions of the originals at ``paths``, which no
+        longer exist, so that a new original saved under the same name
+        isn't given their dimensions.
+
+        """
+        cache = get_dimensions_cache()
+        if cache is not None and paths:
+            cache.delete_many([make_dimensions_key(path) for path in paths])
+
+    def _old_adjustments(self, paths=None):
         """
         Returns a queryset of AdjustedImages whose storage_paths no longer
-        exist in storage.
+        exist in storage. If ``paths`` is given, only those storage paths
+        are checked.
 
         """
-        paths = AdjustedImage.objects.values_list(
-            'storage_path', flat=True).distinct()
-        missing = [
-            path for path in paths
-            if not default_storage.exists(path)
-        ]
+        if paths is None:
+            paths = AdjustedImage.objects.values_list(
+                'storage_path', flat=True).distinct()
+        paths = list(paths)
+        missing = self._missing_paths(paths)
+        self._remember_paths(paths, missing)
+        self._forget_dimensions(missing)
         return AdjustedImage.objects.filter(storage_path__in=missing)
 
-    def _old_areas(self):
+    def _old_areas(self, paths=None):
         """
         Returns a queryset of Areas whose storage_paths no longer exist in
-        storage.
+        storage. If ``paths`` is given, only those storage paths are checked.
 
         """
-        paths = Area.objects.values_list(
-            'storage_path', flat=True).distinct()
-        missing = [
-            path for path in paths
-            if not default_storage.exists(path)
-        ]
+        if paths is None:
+            paths = Area.objects.values_list(
+                'storage_path', flat=True).distinct()
+        paths = list(paths)
+        known = getattr(self, '_known_paths', {})
+        missing = self._missing_paths(paths, known)
+        # Each storage path only comes up once in this pass.
+        for path in paths:
+            known.pop(path, None)
+        self._forget_dimensions(missing)
         return Area.objects.filter(storage_path__in=missing)
 
-    def _missing_adjustments(self):
+    def _missing_adjustments(self, paths=None):
         """
         Returns a queryset of AdjustedImages whose adjusted image files no
-        longer exist in storage.
+        longer exist in storage. If ``paths`` is given, only those adjusted
+        image files are checked.
 
         """
-        paths = AdjustedImage.objects.values_list(
-            'adjusted', flat=True).distinct()
-        missing = [
-            path for path in paths
-            if not default_storage.exists(path)
-        ]
+        if paths is None:
+            paths = AdjustedImage.objects.values_list(
+                'adjusted', flat=True).distinct()
+        missing = self._missing_paths(paths)
         return AdjustedImage.objects.filter(adjusted__in=missing)
 
-    def _duplicate_adjustments(self):
+    def _duplicate_adjustments(self, storage_paths=None):
         """
         Returns a queryset of AdjustedImages which are duplicates - i.e. have
         the same requested adjustment and storage path as another
-        AdjustedImage. This excludes one adjusted image as the canonical
-        version.
+        AdjustedImage. This excludes the oldest adjusted image (the one with
+        the lowest pk) as the canonical version. If ``storage_paths`` is
+        given, only AdjustedImages for those are considered.
 
         """
-        fields = (
-            'storage_path',
-            'requested'
-        )
-        kwargs_list = AdjustedImage.objects.values(
-            *fields).annotate(
-                count=models.Count('id')).filter(
-                    count__gt=1).values(
-                        *fields)
-        duplicate_pks = []
-        for kwargs in kwargs_list:
-            pks = AdjustedImage.objects.filter(
-                **kwargs).values_list('pk', flat=True)
-            duplicate_pks.extend(list(pks)[1:])
-        return AdjustedImage.objects.filter(pk__in=duplicate_pks)
+        queryset = AdjustedImage.objects.all()
+        if storage_paths is not None:
+            queryset = queryset.filter(storage_path__in=storage_paths)
+        canonical = queryset.order_by().values(
+            'storage_path', 'requested').annotate(
+                canonical=models.Min('id')).values('canonical')
+        return queryset.exclude(pk__in=canonical)
 
-    def _orphaned_files(self):
+    def _delete_duplicates(self, queryset):
         """
-        Returns a list of files which aren't referenced by any adjusted images
-        in the database.
+        Deletes the duplicate AdjustedImages in ``queryset``
+        ``self.batch_size`` at a time. Their adjusted image files are
+        deleted by ``delete_adjusted_file`` unless another AdjustedImage
+        still uses them. Returns the number deleted.
+
+        """
+        count = 0
+        while True:
+            pks = list(queryset.order_by('pk').values_list(
+                'pk', flat=True)[:self.batch_size])
+            if not pks:
+                break
+            AdjustedImage.objects.filter(pk__in=pks).delete()
+            count += len(pks)
+        return count
+
+    def _delete_file(self, path):
+        try:
+            default_storage.delete(path)
+        except IOERRORS:
+            pass
+
+    def _delete_files(self, paths):
+        """
+        Deletes ``paths`` from storage, ``self.threads`` at a time.
+
+        """
+        with ThreadPoolExecutor(max(self.threads, 1)) as executor:
+            list(executor.map(self._delete_file, paths))
+
+    def _iter_orphaned_files(self):
+        """
+        Yields lists of files which aren't referenced by any adjusted images
+        in the database, one directory at a time. Only the adjusted images
+        for the files in that directory are looked up, so memory use depends
+        on the size of the directory rather than of the whole table. Starts
+        after the directory the last run got to, and stops early if time
+        runs out.
 
         """
         base_dir = getattr(
             settings, 'DAGUERRE_ADJUSTED_IMAGE_PATH',
             DEFAULT_ADJUSTED_IMAGE_PATH)
 
-        known_paths = set(
-            AdjustedImage.objects.values_list('adjusted', flat=True).distinct()
-        )
-        orphans = []
-        for dirpath, dirnames, filenames in self._walk(
-                base_dir, topdown=False):
-            for filename in filenames:
-                filepath = os.path.join(dirpath, filename)
-                if filepath not in known_paths:
-                    orphans.append(filepath)
-        return orphans
+        kwargs = {'topdown': False}
+        after = (self.cursor or {}).get('orphans')
+        if after is not None:
+            kwargs['after'] = after
+        for dirpath, dirnames, filenames in self._walk(base_dir, **kwargs):
+            if self._out_of_time():
+                break
+            filepaths = [os.path.join(dirpath, filename)
+                         for filename in filenames]
+            known_paths = set()
+            for i in range(0, len(filepaths), self.batch_size):
+                known_paths.update(AdjustedImage.objects.filter(
+                    adjusted__in=filepaths[i:i + self.batch_size]
+                ).values_list('adjusted', flat=True))
+            orphans = [filepath for filepath in filepaths
+                       if filepath not in known_paths]
+            if orphans:
+                yield orphans
+            self._advance('orphans', dirpath)
 
-    def handle(self, **options):
-        # Clear all adjusted images that reference nonexistant
-        # storage paths.
-        self._delete_queryset(self._old_adjustments())
+    def _orphaned_files(self):
+        """
+        Returns a list of files which aren't referenced by any adjusted images
+        in the database.
 
-        # Clear all areas that reference nonexistant storage paths.
-        self._delete_queryset(self._old_areas())
+        """
+        return [filepath
+                for orphans in self._iter_orphaned_files()
+                for filepath in orphans]
 
-        # Clear all adjusted images that reference nonexistant adjustments.
-        self._delete_queryset(self._missing_adjustments(),
-                              'reference missing adjustments')
+    def _run_orphans(self):
+        if self._is_finished('orphans'):
+            return True
+        if self._out_of_time():
+            return False
+        count = 0
+        for orphans in self._iter_orphaned_files():
+            self._delete_files(orphans)
+            count += len(orphans)
+        if not count:
+            self.stdout.write("No orphaned files found.\n")
+        else:
+            self.stdout.write("Deleted {0} orphaned file{1}.\n".format(
+                count,
+                pluralize(count)))
+        if self._out_of_time():
+            return False
+        self._finish('orphans')
+        return True
 
-        # Clear all duplicate adjusted images.
-        self._delete_queryset(self._duplicate_adjustments(),
-                              reason='is a duplicate',
-                              reason_plural='are duplicates')
+    def handle(self, **options):
+        self.threads = options['threads']
+        if options.get('max_seconds') is not None:
+            self.deadline = time.time() + options['max_seconds']
+        self.cursor_file = options.get('cursor_file')
+        self.cursor = self._load_cursor() if self.cursor_file else {}
 
-        # Clean up files that aren't referenced by any adjusted images.
-        orphans = self._orphaned_files()
-        if not orphans:
-            self.stdout.write("No orphaned files found.\n")
+        # Each pass works through the database (or storage) in order, so
+        # that it can stop when time runs out and continue next time.
+        finished = (
+            # Clear all adjusted images that reference nonexistant
+            # storage paths.
+            self._run('old_adjustments', AdjustedImage, 'storage_path',
+                      self._old_adjustments) and
+            # Clear all areas that reference nonexistant storage paths.
+            self._run('old_areas', Area, 'storage_path',
+                      self._old_areas)
+        )
+        # Nothing below needs the storage paths remembered above.
+        self._known_paths = {}
+        finished = finished and (
+            # Clear all adjusted images that reference nonexistant
+            # adjustments.
+            self._run('missing_adjustments', AdjustedImage, 'adjusted',
+                      self._missing_adjustments,
+                      'reference missing adjustments') and
+            # Clear all duplicate adjusted images.
+            self._run('duplicates', AdjustedImage, 'storage_path',
+                      self._duplicate_adjustments,
+                      reason='is a duplicate',
+                      reason_plural='are duplicates',
+                      delete=self._delete_duplicates) and
+            # Clean up files that aren't referenced by any adjusted images,
+            # a directory at a time as they're found.
+            self._run_orphans()
+        )
+
+        if finished:
+            # Start the next sweep from the beginning.
+            self.cursor = {}
+            self._save_cursor()
         else:
-            self.stdout.write(
-                "Deleting {0} orphaned file{1}... ".format(
-                    len(orphans),
-                    pluralize(len(orphans))))
-            self.stdout.flush()
-            for filepath in orphans:
-                try:
-                    default_storage.delete(filepath)
-                except IOERRORS:
-                    pass
-            self.stdout.write("Done.\n")
+            self.stdout.write("Out of time; run again to continue.\n")
 
         self.stdout.write("\n")
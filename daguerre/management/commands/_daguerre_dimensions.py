@@ -0,0 +1,111 @@
+from django.conf import settings
+from django.core.files.base import File
+from django.core.management.base import BaseCommand, CommandError
+from django.template.defaultfilters import pluralize
+
+from daguerre.helpers import (AdjustmentHelper, IOERRORS, get_dimensions_cache,
+                              make_dimensions_key, probe_image)
+from daguerre.management.commands._daguerre_preadjust import (
+    Command as Preadjust)
+from daguerre.models import AdjustedImage, Area
+
+
+NO_CACHE = """The dimensions cache is disabled.
+Set DAGUERRE_DIMENSIONS_CACHE to a cache alias to use this command.
+"""
+
+#: Number of cache keys read or written at a time.
+BATCH_SIZE = 1000
+
+
+class Command(BaseCommand):
+    def add_arguments(self, parser):
+        parser.add_argument(
+            '--refresh',
+            action='store_true',
+            dest='refresh',
+            default=False,
+            help="Re-read dimensions for paths which are already cached.")
+
+    def _get_paths(self):
+        """
+        Returns a sorted list of all original image paths known to
+        daguerre: those with adjusted images or areas, and those which
+        DAGUERRE_PREADJUSTMENTS (if defined) would adjust.
+
+        """
+        paths = set(AdjustedImage.objects.values_list(
+            'storage_path', flat=True).distinct())
+        paths.update(Area.objects.values_list(
+            'storage_path', flat=True).distinct())
+
+        if hasattr(settings, 'DAGUERRE_PREADJUSTMENTS'):
+            preadjustments = Preadjust()._get_preadjustments()
+            for (iterable, adjustments, lookup) in preadjustments:
+                helper = AdjustmentHelper(iterable, lookup=lookup)
+                for item in helper.iterable:
+                    path = helper.lookup_func(item, None)
+                    if isinstance(path, File):
+                        path = path.name
+                    if path and isinstance(path, (str, bytes)):
+                        paths.add(path)
+        return sorted(paths)
+
+    def _uncached(self, cache, paths):
+        uncached = []
+        for i in range(0, len(paths), BATCH_SIZE):
+            keys = dict((make_dimensions_key(path), path)
+                        for path in paths[i:i + BATCH_SIZE])
+            cached = cache.get_many(list(keys))
+            uncached.extend(path for key, path in keys.items()
+                            if key not in cached)
+        return sorted(uncached)
+
+    def handle(self, **options):
+        cache = get_dimensions_cache()
+        if cache is None:
+            raise CommandError(NO_CACHE)
+
+        paths = self._get_paths()
+        if not options['refresh']:
+            remaining = self._uncached(cache, paths)
+            skipped_count = len(paths) - len(remaining)
+            paths = remaining
+            self.stdout.write(
+                "Skipped {0} path{1} which {2} already cached.\n".format(
+                    skipped_count,
+                    pluralize(skipped_count),
+                    pluralize(skipped_count, 'is,are')))
+
+        if not paths:
+            self.stdout.write("No paths remaining to probe.\n")
+        else:
+            self.stdout.write("Caching dimensions for {0} path{1}... ".format(
+                len(paths),
+                pluralize(len(paths))))
+            self.stdout.flush()
+
+            failed_count = 0
+            batch = {}
+            for path in paths:
+                try:
+                    info = probe_image(path)
+                except IOERRORS:
+                    info = (None, None, None)
+                if info[0] is None:
+                    failed_count += 1
+                    continue
+                batch[make_dimensions_key(path)] = info
+                if len(batch) >= BATCH_SIZE:
+                    cache.set_many(batch)
+                    batch = {}
+            if batch:
+                cache.set_many(batch)
+            self.stdout.write("Done.\n")
+            if failed_count:
+                self.stdout.write(
+                    "{0} path{1} couldn't be read.\n".format(
+                        failed_count,
+                        pluralize(failed_count)))
+
+        self.stdout.write("\n")
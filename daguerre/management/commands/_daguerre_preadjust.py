@@ -1,12 +1,25 @@
+import datetime
+import itertools
+import json
+import multiprocessing
+import time
+from collections import OrderedDict, deque
+
+import django
 from django.apps import apps
 from django.conf import settings
+from django.core.files.base import File
 from django.core.management.base import BaseCommand, CommandError
-from django.db.models import Model
+from django.db import connections
+from django.db.models import DateTimeField, Model
 from django.db.models.query import QuerySet
-from django.template.defaultfilters import pluralize
+from django.template.defaultfilters import filesizeformat, pluralize
+from django.utils import timezone
+from django.utils.dateparse import parse_date, parse_datetime
 
-from daguerre.models import AdjustedImage
-from daguerre.helpers import AdjustmentHelper, IOERRORS
+from daguerre.models import AdjustedImage, PreadjustCheckpoint, PreadjustRun
+from daguerre.helpers import AdjustmentHelper, IOERRORS, generate_many
+from daguerre.utils import GenerationStats, make_hash, timed
 
 
 NO_ADJUSTMENTS = """No adjustments were defined.
@@ -25,6 +38,14 @@ See the django-daguerre documentation for more details.
 
 """
 
+BAD_SHARD = """--shard should be given as K/N, where N is the number of shards
+and K (from 1 to N) is the one to work on.
+"""
+
+BAD_SINCE = """--since should be a date or a date and time, such as 2020-01-31
+or "2020-01-31 12:00".
+"""
+
 
 # Store option kwargs as consts so that we can reuse them
 # between compatibility sets
@@ -42,31 +63,138 @@ NOCREATE_OPTION_KWARGS = {
     'help': "Don't create any new adjustments."
 }
 
+RESUME_OPTION_KWARGS = {
+    'action': 'store_true',
+    'dest': 'resume',
+    'default': False,
+    'help': "Continue from where the last run got to.",
+}
+
+REPORT_OPTION_KWARGS = {
+    'choices': ('text', 'json'),
+    'dest': 'report',
+    'default': None,
+    'help': "Show progress and report throughput and time spent per stage, "
+            "as text or as a line of JSON.",
+}
+
+SHARD_OPTION_KWARGS = {
+    'dest': 'shard',
+    'default': None,
+    'metavar': 'K/N',
+    'help': "Only adjust the Kth of N shards of the paths, so that several "
+            "machines can share the work.",
+}
+
+SINCE_OPTION_KWARGS = {
+    'dest': 'since',
+    'default': None,
+    'metavar': 'TIMESTAMP',
+    'help': "Only consider model instances changed since this date or time.",
+}
+
+SINCE_LAST_RUN_OPTION_KWARGS = {
+    'action': 'store_true',
+    'dest': 'since_last_run',
+    'default': False,
+    'help': "Only consider model instances changed since the last run "
+            "which finished.",
+}
+
+WORKERS_OPTION_KWARGS = {
+    'type': int,
+    'dest': 'workers',
+    'default': 1,
+    'help': "Number of processes to adjust images with.",
+}
+
+
+def _adjust_path(args):
+    """
+    Applies each list of adjustments in ``adjustment_lists`` to ``path``,
+    decoding it only once. Runs in worker processes as well as the main
+    one. Returns ``path``, the number of lists which failed, and a
+    :class:`GenerationStats` for each list if ``report`` is True.
+
+    """
+    path, adjustment_lists, report = args
+    helpers = []
+    for adjustments in adjustment_lists:
+        helper = AdjustmentHelper([path], generate=True)
+        if report:
+            helper.stats = GenerationStats()
+        for adjustment in adjustments:
+            helper.adjust(adjustment)
+        helpers.append(helper)
+    try:
+        adjusted_images = generate_many(path, helpers)
+    except IOERRORS:
+        failed_count = len(helpers)
+    else:
+        failed_count = adjusted_images.count(None)
+    return path, failed_count, [helper.stats for helper in helpers]
+
 
 class Command(BaseCommand):
+    #: Number of paths sent to a worker process at a time.
+    chunk_size = 20
+    #: Number of items looked up, adjusted and checkpointed together.
+    batch_size = 1000
+    #: Number of batches looked up ahead of the one being adjusted, so that
+    #: originals which several of them need are only decoded once.
+    lookahead = 4
+    #: Minimum number of seconds between progress updates.
+    progress_interval = 1.0
+    #: Stages in the order they're reported; adjustments come in between.
+    stage_order = ('lookup', 'read', 'decode', 'encode', 'write')
+    report = None
+    shard = None
+    since = None
+
     def add_arguments(self, parser):
         parser.add_argument('--remove', **REMOVE_OPTION_KWARGS)
         parser.add_argument('--nocreate', **NOCREATE_OPTION_KWARGS)
+        parser.add_argument('--workers', **WORKERS_OPTION_KWARGS)
+        parser.add_argument('--resume', **RESUME_OPTION_KWARGS)
+        parser.add_argument('--report', **REPORT_OPTION_KWARGS)
+        parser.add_argument('--shard', **SHARD_OPTION_KWARGS)
+        parser.add_argument('--since', **SINCE_OPTION_KWARGS)
+        parser.add_argument('--since-last-run', **SINCE_LAST_RUN_OPTION_KWARGS)
 
-    def _get_helpers(self):
+    def _get_preadjustments(self):
+        """
+        Returns DAGUERRE_PREADJUSTMENTS as a list of ``(iterable,
+        adjustments, lookup)`` tuples, with model labels and classes
+        resolved to fresh iterables.
+
+        """
         if not hasattr(settings, 'DAGUERRE_PREADJUSTMENTS'):
             raise CommandError(NO_ADJUSTMENTS)
         dp = settings.DAGUERRE_PREADJUSTMENTS
+        preadjustments = []
+        try:
+            for (model_or_iterable, adjustments, lookup) in dp:
+                if isinstance(model_or_iterable, (str, bytes)):
+                    app_label, model_name = model_or_iterable.split('.')
+                    model_or_iterable = apps.get_model(app_label, model_name)
+                if (isinstance(model_or_iterable, type) and
+                        issubclass(model_or_iterable, Model)):
+                    iterable = model_or_iterable.objects.all()
+                elif isinstance(model_or_iterable, QuerySet):
+                    iterable = model_or_iterable._clone()
+                else:
+                    iterable = model_or_iterable
+                preadjustments.append((iterable, adjustments, lookup))
+        except (ValueError, TypeError, LookupError):
+            raise CommandError(BAD_STRUCTURE)
+        return preadjustments
+
+    def _get_helpers(self):
         if not hasattr(self, '_helpers'):
+            preadjustments = self._get_preadjustments()
             self._helpers = []
             try:
-                for (model_or_iterable, adjustments, lookup) in dp:
-                    if isinstance(model_or_iterable, (str, bytes)):
-                        app_label, model_name = model_or_iterable.split('.')
-                        model_or_iterable = apps.get_model(app_label, model_name)
-                    if (isinstance(model_or_iterable, type) and
-                            issubclass(model_or_iterable, Model)):
-                        iterable = model_or_iterable.objects.all()
-                    elif isinstance(model_or_iterable, QuerySet):
-                        iterable = model_or_iterable._clone()
-                    else:
-                        iterable = model_or_iterable
-
+                for (iterable, adjustments, lookup) in preadjustments:
                     helper = AdjustmentHelper(iterable, lookup=lookup, generate=False)
                     for adjustment in adjustments:
                         helper.adjust(adjustment)
@@ -77,17 +205,420 @@ class Command(BaseCommand):
 
         return self._helpers
 
-    def _preadjust(self):
+    def _get_pool(self, workers):
+        # Connections can't be shared with child processes, so close them
+        # first; each worker then opens its own. Processes which are spawned
+        # rather than forked (the default on macOS and Windows) start with
+        # Django unconfigured, so set it up from DJANGO_SETTINGS_MODULE.
+        connections.close_all()
+        return multiprocessing.Pool(workers, initializer=django.setup)
+
+    def _get_checkpoint(self, index, adjustments, lookup, resume=False):
+        """
+        Returns the checkpoint for the ``index``th DAGUERRE_PREADJUSTMENTS
+        entry, reset to the beginning unless ``resume`` is True.
+
+        """
+        key = u"{0}:{1}:{2}".format(
+            index,
+            AdjustmentHelper._serialize_requested(adjustments),
+            lookup or '')
+        if self.shard is not None:
+            # Each shard gets as far as it gets independently.
+            key = u"{0}/{1}:{2}".format(self.shard[0], self.shard[1], key)
+        key = key[:255]
+        checkpoint, created = PreadjustCheckpoint.objects.get_or_create(
+            key=key)
+        if not resume and not created:
+            checkpoint.last_pk = ''
+            checkpoint.offset = 0
+            checkpoint.save()
+        return checkpoint
+
+    def _get_modified_field(self, model):
+        """
+        Returns the name of a field which records when instances of
+        ``model`` were last changed: a DateTimeField with ``auto_now``, or
+        failing that one with ``auto_now_add``. Returns None if there isn't
+        one.
+
+        """
+        fields = [field for field in model._meta.concrete_fields
+                  if isinstance(field, DateTimeField)]
+        for attr in ('auto_now', 'auto_now_add'):
+            for field in fields:
+                if getattr(field, attr):
+                    return field.name
+        return None
+
+    def _filter_since(self, index, iterable):
+        """
+        Limits ``iterable`` to items changed since ``self.since``, if it's
+        a queryset whose model records when instances change.
+
+        """
+        if isinstance(iterable, QuerySet) and not iterable.query.is_sliced:
+            field = self._get_modified_field(iterable.model)
+            if field is not None:
+                return iterable.filter(**{field + '__gte': self.since})
+        self.stdout.write(
+            "Entry {0} has no modification times; considering all of its "
+            "items.\n".format(index))
+        return iterable
+
+    def _iter_batches(self, iterable, checkpoint):
+        """
+        Yields ``(items, position)`` for batches of ``iterable`` following
+        the ``checkpoint``, where ``position`` is a dict of the checkpoint
+        fields to set once the batch is done. Querysets are ordered by primary
+        key; other iterables are assumed to keep their order between runs.
+
+        """
+        if isinstance(iterable, QuerySet) and not iterable.query.is_sliced:
+            queryset = iterable.order_by('pk')
+            last_pk = checkpoint.last_pk or None
+            while True:
+                if last_pk is not None:
+                    batch = queryset.filter(pk__gt=last_pk)
+                else:
+                    batch = queryset
+                items = list(batch[:self.batch_size])
+                if not items:
+                    break
+                last_pk = items[-1].pk
+                yield items, {'last_pk': str(last_pk)}
+        else:
+            offset = checkpoint.offset
+            iterator = itertools.islice(iterable, offset, None)
+            while True:
+                items = list(itertools.islice(iterator, self.batch_size))
+                if not items:
+                    break
+                offset += len(items)
+                yield items, {'offset': offset}
+
+    def _iter_all_batches(self, resume=False):
+        """
+        Yields ``(checkpoint, position, helper)`` tuples, with one finalized
+        helper per batch of each DAGUERRE_PREADJUSTMENTS entry in turn.
+        Batches are only looked up as they're needed.
+
+        """
+        try:
+            preadjustments = self._get_preadjustments()
+            for index, (iterable, adjustments, lookup) in enumerate(
+                    preadjustments):
+                checkpoint = self._get_checkpoint(index, adjustments, lookup,
+                                                  resume=resume)
+                if self.since is not None:
+                    iterable = self._filter_since(index, iterable)
+                for items, position in self._iter_batches(iterable,
+                                                          checkpoint):
+                    helper = AdjustmentHelper(items, lookup=lookup,
+                                              generate=False)
+                    if self.shard is not None:
+                        helper.iterable = [
+                            item for item in helper.iterable
+                            if self._in_shard(helper.lookup_func(item, None))]
+                        self._other_shard_count += (len(items) -
+                                                    len(helper.iterable))
+                    for adjustment in adjustments:
+                        helper.adjust(adjustment)
+                    if self.report:
+                        label = u"{0}: {1}".format(index, helper.requested)
+                        helper.stats = self.stats.setdefault(
+                            label, GenerationStats())
+                    with timed(helper.stats, 'lookup'):
+                        helper._finalize()
+                    yield checkpoint, position, helper
+        except (ValueError, TypeError, LookupError):
+            raise CommandError(BAD_STRUCTURE)
+
+    def _parse_shard(self, shard):
+        """
+        Returns ``(K, N)`` for a ``--shard`` value of ``'K/N'``.
+
+        """
+        try:
+            k, n = [int(bit) for bit in shard.split('/')]
+        except ValueError:
+            raise CommandError(BAD_SHARD)
+        if not 1 <= k <= n:
+            raise CommandError(BAD_SHARD)
+        return k, n
+
+    def _parse_since(self, since):
+        """
+        Returns an aware datetime for a ``--since`` value.
+
+        """
+        try:
+            value = parse_datetime(since)
+            if value is None:
+                date = parse_date(since)
+                if date is not None:
+                    value = datetime.datetime.combine(date, datetime.time())
+        except ValueError:
+            value = None
+        if value is None:
+            raise CommandError(BAD_SINCE)
+        if settings.USE_TZ and timezone.is_naive(value):
+            value = timezone.make_aware(value)
+        return value
+
+    def _get_last_run(self, shard=None):
+        """
+        Returns the most recent PreadjustRun which finished, for the same
+        shard.
+
+        """
+        return PreadjustRun.objects.filter(
+            shard=self._shard_label(shard),
+            finished__isnull=False,
+        ).order_by('-started').first()
+
+    def _get_run_start(self, shard=None, resume=False):
+        """
+        Returns the start time to record for a new run. A run which resumes
+        an interrupted one covers items changed since that one started.
+
+        """
+        if resume:
+            runs = PreadjustRun.objects.filter(shard=self._shard_label(shard),
+                                               finished__isnull=True)
+            last_run = self._get_last_run(shard)
+            if last_run is not None:
+                runs = runs.filter(started__gt=last_run.started)
+            first_run = runs.order_by('started').first()
+            if first_run is not None:
+                return first_run.started
+        return timezone.now()
+
+    def _shard_label(self, shard):
+        if shard is None:
+            return ''
+        return u"{0}/{1}".format(*shard)
+
+    def _in_shard(self, path):
+        """
+        Returns whether ``path`` belongs to the shard being worked on. Paths
+        are assigned to shards by their hash, so every machine agrees on
+        which paths are whose.
+
+        """
+        if isinstance(path, File):
+            path = path.name
+        if not isinstance(path, (str, bytes)):
+            path = ''
+        k, n = self.shard
+        return int(make_hash(path, stop=8), 16) % n == k - 1
+
+    def _get_remaining(self, helper):
+        """
+        Returns a dict mapping the paths which ``helper`` found unadjusted
+        to their items.
+
+        """
+        remaining = {}
+        for item, info_dict in helper.adjusted.items():
+            # Skip if missing
+            if not info_dict:
+                continue
+            # Skip if already adjusted
+            if 'ajax_url' not in info_dict:
+                continue
+
+            path = helper.lookup_func(item, None)
+            if isinstance(path, File):
+                path = path.name
+            remaining.setdefault(path, []).append(item)
+        return remaining
+
+    def _group(self, helper):
+        """
+        Adds the paths which ``helper`` needs adjusted to ``self._groups``,
+        which maps each path to the helpers (from any batch looked ahead
+        to) which need it, so that each original only has to be decoded
+        once. Helpers with the same adjustments as one already listed for a
+        path are left out.
+
+        """
+        for path in self._get_remaining(helper):
+            helpers = self._groups.setdefault(path, [])
+            if helper.requested not in [h.requested for h in helpers]:
+                helpers.append(helper)
+
+    def _generate(self, helper, workers=1):
+        """
+        Generates the adjusted images which ``helper`` found missing, along
+        with those that batches looked ahead to need for the same paths,
+        using a pool of ``workers`` processes if there's more than one.
+        Returns the number of failures.
+
+        """
+        jobs = []
+        job_helpers = {}
+        for path in self._get_remaining(helper):
+            # Paths which an earlier batch also needed are already done.
+            helpers = self._groups.pop(path, None)
+            if helpers is None:
+                continue
+            jobs.append((path, [h.adjustments for h in helpers],
+                         bool(self.report)))
+            job_helpers[path] = helpers
+
+        if workers > 1 and jobs:
+            if self._pool is None:
+                self._pool = self._get_pool(workers)
+            results = self._pool.imap_unordered(_adjust_path, jobs,
+                                                chunksize=self.chunk_size)
+        else:
+            results = map(_adjust_path, jobs)
+
+        failed_count = 0
+        for path, failed, stats_list in results:
+            failed_count += failed
+            helpers = job_helpers[path]
+            for h, stats in zip(helpers, stats_list):
+                if stats is not None:
+                    h.stats.update(stats)
+            self._progress(done=len(helpers))
+        return failed_count
+
+    def _progress(self, done=1, final=False):
+        """
+        Counts ``done`` more adjusted images and, if reporting, shows how
+        many have been done so far (at most every progress_interval
+        seconds).
+
+        """
+        self._done += done
+        if not self.report:
+            return
+        now = time.time()
+        if not final and now - self._shown < self.progress_interval:
+            return
+        self._shown = now
+        elapsed = now - self._start
+        self.stderr.write(
+            "\rAdjusted {0} image{1} ({2:.1f}/s)".format(
+                self._done,
+                pluralize(self._done),
+                self._done / elapsed if elapsed else 0),
+            ending='\n' if final else '')
+        self.stderr.flush()
+
+    def _get_report(self, elapsed):
+        totals = GenerationStats()
+        entries = []
+        for label, stats in self.stats.items():
+            totals.update(stats)
+            entry = stats.as_dict()
+            entry['entry'] = label
+            entries.append(entry)
+        report = totals.as_dict()
+        report.update({
+            'elapsed': elapsed,
+            'rate': totals.count / elapsed if elapsed else 0,
+            'entries': entries,
+        })
+        return report
+
+    def _order_stages(self, stages):
+        first, last = self.stage_order[:3], self.stage_order[3:]
+        names = [name for name in first if name in stages]
+        names += [name for name in stages if name not in self.stage_order]
+        names += [name for name in last if name in stages]
+        return names
+
+    def _write_report(self, report):
+        if self.report == 'json':
+            self.stdout.write(json.dumps(report, sort_keys=True))
+            return
+
+        self.stdout.write(
+            "Generated {0} image{1} in {2:.1f}s ({3:.1f}/s). "
+            "Read {4}, wrote {5}.\n".format(
+                report['count'],
+                pluralize(report['count']),
+                report['elapsed'],
+                report['rate'],
+                filesizeformat(report['bytes_read']),
+                filesizeformat(report['bytes_written'])))
+        for entry in report['entries']:
+            self.stdout.write("{0} ({1} image{2}):\n".format(
+                entry['entry'],
+                entry['count'],
+                pluralize(entry['count'])))
+            total = sum(entry['stages'].values())
+            for name in self._order_stages(entry['stages']):
+                seconds = entry['stages'][name]
+                self.stdout.write("    {0:<12} {1:8.2f}s {2:5.1f}%\n".format(
+                    name,
+                    seconds,
+                    100.0 * seconds / total if total else 0))
+
+    def _preadjust(self, workers=1, resume=False, report=None, shard=None,
+                   since=None):
+        self.report = report
+        self.shard = shard
+        self.since = since
+        if since is not None:
+            self.stdout.write(
+                "Considering items changed since {0}.\n".format(since))
+        self._other_shard_count = 0
+        self.stats = OrderedDict()
+        self._start = self._shown = time.time()
+        self._done = 0
+        self._groups = OrderedDict()
+        self._pool = None
+
         empty_count = 0
         skipped_count = 0
         remaining_count = 0
-        helpers = self._get_helpers()
-        for helper in helpers:
-            empty_count += len([info_dict for info_dict in helper.adjusted.values()
-                                if not info_dict])
-            skipped_count += len([info_dict for info_dict in helper.adjusted.values()
-                                  if info_dict and 'ajax_url' not in info_dict])
-            remaining_count += len(helper.adjusted) - skipped_count - empty_count
+        failed_count = 0
+        # Batches are looked up a little ahead of the one being adjusted,
+        # and its checkpoint is saved as soon as it's done.
+        batches = self._iter_all_batches(resume=resume)
+        window = deque()
+        try:
+            while True:
+                for checkpoint, position, helper in itertools.islice(
+                        batches, self.lookahead + 1 - len(window)):
+                    empty = len([info_dict
+                                 for info_dict in helper.adjusted.values()
+                                 if not info_dict])
+                    skipped = len([info_dict
+                                   for info_dict in helper.adjusted.values()
+                                   if info_dict and
+                                   'ajax_url' not in info_dict])
+                    empty_count += empty
+                    skipped_count += skipped
+                    remaining_count += len(helper.adjusted) - skipped - empty
+                    self._group(helper)
+                    window.append((checkpoint, position, helper))
+                if not window:
+                    break
+                checkpoint, position, helper = window.popleft()
+                failed_count += self._generate(helper, workers=workers)
+                for field, value in position.items():
+                    setattr(checkpoint, field, value)
+                checkpoint.save()
+        finally:
+            if self._pool is not None:
+                self._pool.close()
+                self._pool.join()
+
+        if self.report and remaining_count:
+            self._progress(done=0, final=True)
+
+        if shard is not None:
+            self.stdout.write(
+                "Shard {0} of {1}: skipped {2} path{3} in other shards.\n".format(
+                    shard[0],
+                    shard[1],
+                    self._other_shard_count,
+                    pluralize(self._other_shard_count)))
 
         self.stdout.write(
             "Skipped {0} empty path{1}.\n".format(
@@ -103,36 +634,21 @@ class Command(BaseCommand):
         if remaining_count == 0:
             self.stdout.write("No paths remaining to adjust.\n")
         else:
-            self.stdout.write("Adjusting {0} path{1}... ".format(
+            self.stdout.write("Adjusted {0} path{1}.\n".format(
                 remaining_count,
                 pluralize(remaining_count)))
-            self.stdout.flush()
-
-            failed_count = 0
-            for helper in helpers:
-                remaining = {}
-                for item, info_dict in helper.adjusted.items():
-                    # Skip if missing
-                    if not info_dict:
-                        continue
-                    # Skip if already adjusted
-                    if 'ajax_url' not in info_dict:
-                        continue
-
-                    remaining.setdefault(helper.lookup_func(item, None), []).append(item)
-
-                for path, items in remaining.items():
-                    try:
-                        helper._generate(path)
-                    except IOERRORS:
-                        failed_count += 1
-            self.stdout.write("Done.\n")
             if failed_count:
                 self.stdout.write(
                     "{0} path{1} failed due to I/O errors.".format(
                         failed_count,
                         pluralize(failed_count)))
 
+        if self.report:
+            if failed_count:
+                self.stdout.write("\n")
+            self._write_report(self._get_report(time.time() - self._start))
+        return failed_count
+
     def _prune(self):
         queryset = AdjustedImage.objects.all()
         helpers = self._get_helpers()
@@ -155,8 +671,32 @@ class Command(BaseCommand):
         if options['nocreate'] and not options['remove']:
             self.stdout.write("Doing nothing.\n")
 
+        shard = options['shard']
+        if shard is not None:
+            shard = self._parse_shard(shard)
+
+        since = options['since']
+        if since is not None:
+            since = self._parse_since(since)
+        elif options['since_last_run']:
+            last_run = self._get_last_run(shard)
+            if last_run is not None:
+                since = last_run.started
+
         if not options['nocreate']:
-            self._preadjust()
+            run = PreadjustRun.objects.create(
+                started=self._get_run_start(shard, resume=options['resume']),
+                shard=self._shard_label(shard))
+            failed_count = self._preadjust(workers=options['workers'],
+                                           resume=options['resume'],
+                                           report=options['report'],
+                                           shard=shard,
+                                           since=since)
+            # Only count the run as finished if nothing failed, so that
+            # --since-last-run tries the failed paths again.
+            if not failed_count:
+                run.finished = timezone.now()
+                run.save()
 
         if options['remove']:
             self._prune()
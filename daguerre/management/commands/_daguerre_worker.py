@@ -0,0 +1,96 @@
+import time
+
+from django.core.management.base import BaseCommand
+from django.db import close_old_connections
+from django.template.defaultfilters import pluralize
+
+from daguerre.helpers import AdjustmentHelper, regenerate
+from daguerre.models import (AdjustedImage, AdjustmentJob,
+                             DEFAULT_QUEUE_OPTIONS, get_queue_options)
+
+
+class Command(BaseCommand):
+    def add_arguments(self, parser):
+        parser.add_argument(
+            '--burst',
+            action='store_true',
+            dest='burst',
+            default=False,
+            help="Exit once the queue is empty instead of waiting for more "
+                 "jobs.")
+        parser.add_argument(
+            '--sleep',
+            type=float,
+            dest='sleep',
+            default=1.0,
+            help="Seconds to wait before checking an empty queue again.")
+        parser.add_argument(
+            '--max-jobs',
+            type=int,
+            dest='max_jobs',
+            default=None,
+            help="Exit after this many jobs.")
+
+    def _run(self, job):
+        """
+        Generates the adjusted image for ``job``. Returns True on success.
+        The job is deleted on success (unless it was queued again meanwhile)
+        and otherwise left for a retry. If the adjusted image exists but is
+        stale, it's regenerated.
+
+        """
+        stale = AdjustedImage.objects.filter(
+            storage_path=job.storage_path, requested=job.requested,
+            stale=True).first()
+        if stale is not None:
+            regenerate(stale)
+            AdjustmentJob.objects.finish(job)
+            return True
+
+        helper = AdjustmentHelper([job.storage_path], generate=True)
+        for adjustment in helper._deserialize_requested(job.requested):
+            helper.adjust(adjustment)
+        info_dict = helper[0][1]
+        if not info_dict:
+            return False
+        AdjustmentJob.objects.finish(job)
+        return True
+
+    def handle(self, **options):
+        queue_options = get_queue_options() or DEFAULT_QUEUE_OPTIONS
+        done_count = failed_count = 0
+        while options['max_jobs'] is None or (
+                done_count + failed_count < options['max_jobs']):
+            # Workers run for a long time; drop connections which have
+            # outlived CONN_MAX_AGE or broken, as a request would.
+            close_old_connections()
+            job = AdjustmentJob.objects.claim(
+                timeout=queue_options['CLAIM_TIMEOUT'],
+                max_attempts=queue_options['MAX_ATTEMPTS'])
+            if job is None:
+                if options['burst']:
+                    break
+                time.sleep(options['sleep'])
+                continue
+
+            try:
+                done = self._run(job)
+            except Exception as e:
+                # Keep working through the queue; the job will be retried.
+                self.stderr.write("Error adjusting {0}: {1!r}\n".format(
+                    job, e))
+                done = False
+            if done:
+                done_count += 1
+            else:
+                failed_count += 1
+                self.stdout.write("Failed to adjust {0}.\n".format(job))
+
+        self.stdout.write("Generated {0} adjusted image{1}.\n".format(
+            done_count,
+            pluralize(done_count)))
+        if failed_count:
+            self.stdout.write("{0} job{1} failed.\n".format(
+                failed_count,
+                pluralize(failed_count)))
+        self.stdout.write("\n")
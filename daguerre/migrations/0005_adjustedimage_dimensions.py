@@ -0,0 +1,22 @@
+# -*- coding: utf-8 -*-
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('daguerre', '0004_hash_upload_to_dir'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='adjustedimage',
+            name='width',
+            field=models.PositiveIntegerField(blank=True, null=True),
+        ),
+        migrations.AddField(
+            model_name='adjustedimage',
+            name='height',
+            field=models.PositiveIntegerField(blank=True, null=True),
+        ),
+    ]
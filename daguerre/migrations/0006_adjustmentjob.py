@@ -0,0 +1,26 @@
+# -*- coding: utf-8 -*-
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('daguerre', '0005_adjustedimage_dimensions'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='AdjustmentJob',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('storage_path', models.CharField(max_length=200)),
+                ('requested', models.CharField(max_length=100)),
+                ('created', models.DateTimeField(auto_now_add=True)),
+                ('claimed', models.DateTimeField(blank=True, null=True)),
+                ('attempts', models.PositiveSmallIntegerField(default=0)),
+            ],
+            options={
+                'unique_together': {('requested', 'storage_path')},
+            },
+        ),
+    ]
@@ -0,0 +1,24 @@
+# -*- coding: utf-8 -*-
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('daguerre', '0007_preadjustcheckpoint'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='PreadjustRun',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('started', models.DateTimeField()),
+                ('finished', models.DateTimeField(blank=True, null=True)),
+                ('shard', models.CharField(blank=True, max_length=20)),
+            ],
+            options={
+                'ordering': ('-started',),
+            },
+        ),
+    ]
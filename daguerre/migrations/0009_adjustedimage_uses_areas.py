@@ -0,0 +1,33 @@
+# -*- coding: utf-8 -*-
+from django.db import migrations, models
+
+
+def set_uses_areas(apps, schema_editor):
+    from daguerre.models import requested_uses_areas
+    AdjustedImage = apps.get_model('daguerre', 'AdjustedImage')
+    requested_list = AdjustedImage.objects.order_by().values_list(
+        'requested', flat=True).distinct()
+    for requested in requested_list:
+        if not requested_uses_areas(requested):
+            AdjustedImage.objects.filter(requested=requested).update(
+                uses_areas=False)
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('daguerre', '0008_preadjustrun'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='adjustedimage',
+            name='uses_areas',
+            field=models.BooleanField(default=True),
+        ),
+        migrations.AlterIndexTogether(
+            name='adjustedimage',
+            index_together={('requested', 'storage_path'), ('storage_path', 'uses_areas')},
+        ),
+        migrations.RunPython(set_uses_areas, migrations.RunPython.noop),
+    ]
@@ -0,0 +1,17 @@
+# -*- coding: utf-8 -*-
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('daguerre', '0009_adjustedimage_uses_areas'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='adjustedimage',
+            name='stale',
+            field=models.BooleanField(default=False),
+        ),
+    ]
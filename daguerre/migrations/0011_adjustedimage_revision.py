@@ -0,0 +1,17 @@
+# -*- coding: utf-8 -*-
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('daguerre', '0010_adjustedimage_stale'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='adjustedimage',
+            name='revision',
+            field=models.PositiveIntegerField(default=0),
+        ),
+    ]
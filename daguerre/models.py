@@ -2,19 +2,22 @@
 
 import hashlib
 import operator
+import uuid
 import warnings
-from datetime import datetime
-from functools import reduce
+from datetime import datetime, timedelta
 
 from django.conf import settings
+from django.core.cache import caches
 from django.core.exceptions import ValidationError
 from django.core.validators import MinValueValidator
-from django.db import models
+from django.db import models, transaction
 from django.db.models.signals import post_delete, post_save
 from django.dispatch import receiver
+from django.utils import timezone
 from django.utils.encoding import force_bytes
 
 from daguerre.adjustments import registry
+from daguerre.utils import LRUCache, make_hash
 
 # The default image path where the images will be saved to. Can be overriden by
 # defining the DAGUERRE_ADJUSTED_IMAGE_PATH setting in the project's settings.
@@ -22,6 +25,93 @@ from daguerre.adjustments import registry
 DEFAULT_ADJUSTED_IMAGE_PATH = 'dg'
 
 
+def get_info_cache():
+    """
+    Returns the cache named by the DAGUERRE_INFO_CACHE setting, or None if
+    info dicts aren't cached (the default).
+
+    """
+    alias = getattr(settings, 'DAGUERRE_INFO_CACHE', None)
+    if alias is None:
+        return None
+    return caches[alias]
+
+
+def make_info_version_key(storage_path):
+    # Each storage path has a version which is part of the keys of all its
+    # info dicts, so that they can be invalidated together without knowing
+    # which adjustments were cached.
+    return 'daguerre:info:version:{0}'.format(make_hash(storage_path))
+
+
+def make_info_key(storage_path, requested, version):
+    return 'daguerre:info:{0}:{1}'.format(
+        make_hash(storage_path, requested), version)
+
+
+def get_info_versions(cache, storage_paths):
+    """
+    Returns a dict mapping each of ``storage_paths`` to the current version
+    of its info dicts in ``cache``, starting new versions where needed.
+
+    """
+    keys = dict((make_info_version_key(path), path) for path in storage_paths)
+    versions = dict((keys[key], version) for key, version
+                    in cache.get_many(list(keys)).items())
+    new_versions = dict((key, uuid.uuid4().hex) for key, path in keys.items()
+                        if path not in versions)
+    if new_versions:
+        cache.set_many(new_versions, None)
+        versions.update((keys[key], version)
+                        for key, version in new_versions.items())
+    return versions
+
+
+#: Options for queued generation; see the DAGUERRE_QUEUE setting.
+DEFAULT_QUEUE_OPTIONS = {
+    # Seconds the redirect view waits for a worker before giving up.
+    'WAIT': 0,
+    # Adjustments estimated to touch at most this many pixels are generated
+    # inline rather than queued.
+    'INLINE_COST': 1000000,
+    # Url to redirect to while waiting; None redirects to the original.
+    'PLACEHOLDER': None,
+    # Seconds after which a claimed job is assumed to have been abandoned.
+    'CLAIM_TIMEOUT': 300,
+    # How many times a job is tried before being given up on.
+    'MAX_ATTEMPTS': 3,
+}
+
+
+def get_queue_options():
+    """
+    Returns the options for queued generation from the DAGUERRE_QUEUE
+    setting, or None if adjustments are always generated inline (the
+    default).
+
+    """
+    options = getattr(settings, 'DAGUERRE_QUEUE', None)
+    if options is None:
+        return None
+    return dict(DEFAULT_QUEUE_OPTIONS, **options)
+
+
+def invalidate_info_cache(storage_paths, using=None):
+    """
+    Drops cached info dicts for the given storage paths by starting new
+    versions of them, once the current transaction (if any) is committed.
+    Info dicts being built meanwhile from what was in the database before
+    are then written under the old version, where they won't be found.
+
+    """
+    cache = get_info_cache()
+    if cache is not None:
+        versions = dict((make_info_version_key(path), uuid.uuid4().hex)
+                        for path in storage_paths)
+        transaction.on_commit(lambda: cache.set_many(versions, None),
+                              using=using)
+
+
 class Area(models.Model):
     """
     Represents an area of an image. Can be used to specify a crop. Also used
@@ -76,6 +166,15 @@ class Area(models.Model):
         if errors:
             raise ValidationError(errors)
 
+    @classmethod
+    def from_db(cls, db, field_names, values):
+        instance = super(Area, cls).from_db(db, field_names, values)
+        if len(values) == len(cls._meta.concrete_fields):
+            # Remember the area as loaded, so that adjusted images can be
+            # kept if changing it doesn't affect them.
+            instance._loaded = instance.serialize()
+        return instance
+
     def serialize(self):
         return dict((f.name, getattr(self, f.name))
                     for f in self._meta.fields)
@@ -92,23 +191,159 @@ class Area(models.Model):
         ordering = ('priority',)
 
 
+def requested_uses_areas(requested):
+    """
+    Returns whether any of the adjustments in a serialized ``requested``
+    string (such as ``"crop|50|50>fit|20|"``) uses areas to adjust images.
+    Unknown adjustments are assumed to.
+
+    """
+    # Separators as in AdjustmentHelper.
+    for adj_string in requested.split('>'):
+        adjustment = registry.get(adj_string.split('|')[0])
+        if adjustment is None or getattr(adjustment.adjust, 'uses_areas',
+                                         True):
+            return True
+    return False
+
+
+def on_commit_once(callback_class, using, update):
+    """
+    Calls ``update`` with the ``callback_class`` instance which will be
+    called when the current transaction is committed, registering a new one
+    if there isn't one yet. This lets changes made throughout a transaction
+    be handled together.
+
+    """
+    connection = transaction.get_connection(using)
+    for entry in connection.run_on_commit:
+        if isinstance(entry[1], callback_class):
+            update(entry[1])
+            return
+    # Outside a transaction, on_commit() calls the callback immediately, so
+    # it's updated first. If the transaction is rolled back, the callback
+    # is discarded along with its changes.
+    callback = callback_class()
+    update(callback)
+    transaction.on_commit(callback, using=using)
+
+
+class ChangedAreas(object):
+    """
+    Collects the Areas which change in a transaction, and is called once
+    it's committed to delete the AdjustedImages they affect.
+
+    """
+    def __init__(self):
+        # Maps each storage path to a dict of the Areas changed for it, by
+        # pk, as they were before the transaction (or None for new ones.)
+        # If that isn't known, the dict is None instead.
+        self.originals = {}
+
+    def add(self, storage_path, pk, original):
+        originals = self.originals.setdefault(storage_path, {})
+        if originals is not None and pk not in originals:
+            originals[pk] = original
+
+    def add_unknown(self, storage_path):
+        self.originals[storage_path] = None
+
+    def get_areas(self, storage_paths):
+        """
+        Returns a dict mapping each of ``storage_paths`` to an
+        ``(old_areas, new_areas)`` tuple, or to None if its old areas
+        aren't known.
+
+        """
+        new_areas = dict((path, {}) for path in storage_paths)
+        for area in Area.objects.filter(storage_path__in=storage_paths):
+            new_areas[area.storage_path][area.pk] = area
+        areas = {}
+        for path in storage_paths:
+            originals = self.originals[path]
+            if originals is None:
+                areas[path] = None
+                continue
+            old_areas = dict(new_areas[path])
+            for pk, original in originals.items():
+                if original is None:
+                    old_areas.pop(pk, None)
+                else:
+                    old_areas[pk] = original
+            areas[path] = tuple(
+                sorted(by_pk.values(), key=operator.attrgetter('priority'))
+                for by_pk in (old_areas, new_areas[path]))
+        return areas
+
+    def __call__(self):
+        from daguerre.helpers import AdjustmentHelper, IOERRORS, revalidate
+
+        storage_paths = list(self.originals)
+        adjusted_images = list(AdjustedImage.objects.filter(
+            storage_path__in=storage_paths, uses_areas=True,
+        ).values_list('pk', 'storage_path', 'requested'))
+        if adjusted_images:
+            paths = set(path for _, path, _ in adjusted_images)
+            areas = self.get_areas(paths)
+            helper = AdjustmentHelper(paths)
+            dimensions = {}
+            stale = []
+            for pk, path, requested in adjusted_images:
+                if areas[path] is None:
+                    stale.append(pk)
+                    continue
+                if path not in dimensions:
+                    try:
+                        dimensions[path] = helper.get_dimensions(path)
+                    except IOERRORS:
+                        dimensions[path] = (None, None)
+                if (None in dimensions[path] or
+                        helper.areas_change(requested, dimensions[path],
+                                            *areas[path])):
+                    stale.append(pk)
+            if stale:
+                stale_images = AdjustedImage.objects.filter(pk__in=stale)
+                mode = getattr(settings, 'DAGUERRE_REVALIDATE', None)
+                if mode is None:
+                    stale_images.delete()
+                else:
+                    # Keep serving them until they've been regenerated.
+                    stale_images.update(stale=True,
+                                        revision=models.F('revision') + 1)
+                    revalidate(stale, mode)
+        # Areas can also change the calculated dimensions of adjustments
+        # which haven't been generated yet.
+        invalidate_info_cache(storage_paths)
+
+
 @receiver(post_save, sender=Area)
 @receiver(post_delete, sender=Area)
 def delete_adjusted_images(sender, **kwargs):
     """
-    If an Area is deleted or changed, delete all AdjustedImages for the
-    Area's storage_path which have area-using adjustments.
+    If an Area is deleted or changed, delete the AdjustedImages for the
+    Area's storage_path whose adjustments would now give a different
+    result. This is done when the transaction is committed, once per
+    storage_path however many of its Areas changed.
 
     """
-    storage_path = kwargs['instance'].storage_path
-    qs = AdjustedImage.objects.filter(storage_path=storage_path)
-    slug_qs = [models.Q(requested__contains=slug)
-               for slug, adjustment in registry.items()
-               if getattr(adjustment.adjust, 'uses_areas', True)]
-    if slug_qs:
-        qs = qs.filter(reduce(operator.or_, slug_qs))
+    instance = kwargs['instance']
+
+    def update(changed):
+        loaded = getattr(instance, '_loaded', None)
+        if kwargs.get('created'):
+            changed.add(instance.storage_path, instance.pk, None)
+        elif loaded is None:
+            changed.add_unknown(instance.storage_path)
+        else:
+            original = Area(**loaded)
+            changed.add(original.storage_path, instance.pk, original)
+            if original.storage_path != instance.storage_path:
+                changed.add(instance.storage_path, instance.pk, None)
 
-    qs.delete()
+    on_commit_once(ChangedAreas, kwargs.get('using'), update)
+    if 'created' in kwargs:
+        # Saved; later changes are compared with the area as it is now.
+        instance._loaded = instance.serialize()
 
 
 def upload_to(instance, filename):
@@ -159,9 +394,339 @@ class AdjustedImage(models.Model):
     adjusted = models.ImageField(upload_to=upload_to,
                                  max_length=45)
     requested = models.CharField(max_length=100)
+    # Dimensions of the adjusted image, so that they don't need to be read
+    # back from storage. May be empty for images adjusted before these
+    # fields were added; see ``manage.py daguerre backfill``.
+    width = models.PositiveIntegerField(null=True, blank=True)
+    height = models.PositiveIntegerField(null=True, blank=True)
+    # Whether the adjusted image is out of date and waiting to be
+    # regenerated; see the DAGUERRE_REVALIDATE setting.
+    stale = models.BooleanField(default=False)
+    # Incremented each time the adjusted image is marked stale, so that a
+    # regeneration which started before that doesn't replace it.
+    revision = models.PositiveIntegerField(default=0)
+    # Whether any of the requested adjustments use areas, so that changing
+    # an Area can find the adjusted images it affects with an index. Set
+    # from ``requested`` on save.
+    uses_areas = models.BooleanField(default=True)
 
     class Meta:
-        index_together = [['requested', 'storage_path'], ]
+        index_together = [['requested', 'storage_path'],
+                          ['storage_path', 'uses_areas']]
+
+    def save(self, *args, **kwargs):
+        self.uses_areas = requested_uses_areas(self.requested)
+        super(AdjustedImage, self).save(*args, **kwargs)
 
     def __str__(self):
         return u"{0}: {1}".format(self.storage_path, self.requested)
+
+
+class AdjustmentJobManager(models.Manager):
+    def enqueue(self, storage_path, requested, timeout=300, max_attempts=3,
+                requeue=False):
+        """
+        Queues the generation of ``requested`` for ``storage_path``, unless
+        it's already queued. Returns the job. A job which was given up on
+        after ``max_attempts`` (and whose last claim has timed out) is
+        queued afresh, since whatever made it fail may have gone away. If
+        ``requeue`` is True, so is a job which a worker has already claimed,
+        since it may be working from information which is now out of date.
+
+        """
+        while True:
+            job, created = self.get_or_create(storage_path=storage_path,
+                                              requested=requested)
+            expired = timezone.now() - timedelta(seconds=timeout)
+            if created or not (
+                    (requeue and job.claimed is not None) or
+                    (job.attempts >= max_attempts and
+                     (job.claimed is None or job.claimed < expired))):
+                return job
+            # Only one caller's update can match the old values; if a worker
+            # got there first, look again.
+            if self.filter(pk=job.pk, attempts=job.attempts,
+                           claimed=job.claimed).update(attempts=0,
+                                                       claimed=None):
+                job.attempts, job.claimed = 0, None
+                return job
+
+    def claim(self, timeout=300, max_attempts=3):
+        """
+        Marks the oldest waiting job as taken by the calling worker and
+        returns it, or returns None if there's nothing to do. Jobs claimed
+        more than ``timeout`` seconds ago are assumed to have been abandoned
+        and are handed out again, up to ``max_attempts`` times in all.
+
+        """
+        now = timezone.now()
+        qs = self.filter(
+            models.Q(claimed__isnull=True) |
+            models.Q(claimed__lt=now - timedelta(seconds=timeout)),
+            attempts__lt=max_attempts,
+        ).order_by('created', 'pk')
+        for job in qs[:10]:
+            # Only one worker's update can match the old claimed value.
+            claimed = self.filter(pk=job.pk, claimed=job.claimed).update(
+                claimed=now, attempts=models.F('attempts') + 1)
+            if claimed:
+                job.claimed = now
+                job.attempts += 1
+                return job
+        return None
+
+    def finish(self, job):
+        """
+        Deletes ``job``, which the calling worker has done, unless it was
+        queued again in the meantime.
+
+        """
+        self.filter(pk=job.pk, claimed=job.claimed).delete()
+
+
+class AdjustmentJob(models.Model):
+    """
+    A queued request to generate an :class:`AdjustedImage`, waiting for
+    ``manage.py daguerre worker``.
+
+    """
+    storage_path = models.CharField(max_length=200)
+    requested = models.CharField(max_length=100)
+    created = models.DateTimeField(auto_now_add=True)
+    # When a worker last took this job; empty while it's waiting.
+    claimed = models.DateTimeField(null=True, blank=True)
+    attempts = models.PositiveSmallIntegerField(default=0)
+
+    objects = AdjustmentJobManager()
+
+    class Meta:
+        unique_together = [['requested', 'storage_path'], ]
+
+    def __str__(self):
+        return u"{0}: {1}".format(self.storage_path, self.requested)
+
+
+class PreadjustCheckpoint(models.Model):
+    """
+    Records how far ``manage.py daguerre preadjust`` got through one entry
+    of DAGUERRE_PREADJUSTMENTS, so that ``--resume`` can continue from
+    there.
+
+    """
+    # Identifies the DAGUERRE_PREADJUSTMENTS entry.
+    key = models.CharField(max_length=255, unique=True)
+    # The last primary key done, for querysets (and models).
+    last_pk = models.CharField(max_length=255, blank=True)
+    # The number of items done, for other iterables.
+    offset = models.PositiveIntegerField(default=0)
+    updated = models.DateTimeField(auto_now=True)
+
+    def __str__(self):
+        return self.key
+
+
+class PreadjustRun(models.Model):
+    """
+    Records a run of ``manage.py daguerre preadjust``, so that
+    ``--since-last-run`` knows which items have changed since.
+
+    """
+    # When the run started; items changed after this need adjusting again.
+    started = models.DateTimeField()
+    # When the run finished; empty if it didn't.
+    finished = models.DateTimeField(null=True, blank=True)
+    # The shard (as "K/N") the run worked on, if any.
+    shard = models.CharField(max_length=20, blank=True)
+
+    class Meta:
+        ordering = ('-started',)
+
+    def __str__(self):
+        return u"{0} ({1})".format(self.started, self.shard or 'all')
+
+
+class LookupCache(object):
+    """
+    An opt-in, process-local cache of :class:`AdjustedImage` lookups keyed
+    by ``(requested, storage_path)``. It is configured with the
+    ``DAGUERRE_LOOKUP_CACHE`` setting, a dict with these (optional) keys:
+
+    * ``MAX_ENTRIES``: how many adjusted images to keep. Default: 1000.
+    * ``TIMEOUT``: how many seconds to keep each one. Default: 300.
+    * ``VERSION_CACHE``: alias of a cache shared by all processes, used to
+      tell them when adjusted images have changed. Default: ``'default'``.
+
+    Only existing adjusted images are cached, so creating one never needs to
+    invalidate anything. Changing or deleting one drops it from this
+    process's cache and bumps a version number in the ``VERSION_CACHE``;
+    other processes drop their whole cache when they see a new version.
+
+    """
+    version_key = 'daguerre:lookup:version'
+
+    def __init__(self):
+        self._lru = LRUCache()
+        self._version = None
+
+    @property
+    def options(self):
+        options = getattr(settings, 'DAGUERRE_LOOKUP_CACHE', None)
+        if options is None:
+            return None
+        return dict({
+            'MAX_ENTRIES': 1000,
+            'TIMEOUT': 300,
+            'VERSION_CACHE': 'default',
+        }, **options)
+
+    def _sync(self, options):
+        if options['VERSION_CACHE'] is None:
+            return
+        version = caches[options['VERSION_CACHE']].get(self.version_key)
+        if version != self._version:
+            self._lru.clear()
+            self._version = version
+
+    def get_many(self, requested, storage_paths):
+        """
+        Returns a dict mapping each of ``storage_paths`` which has a cached
+        adjusted image for ``requested`` to that adjusted image.
+
+        """
+        options = self.options
+        if options is None:
+            return {}
+        self._sync(options)
+        found = {}
+        for storage_path in storage_paths:
+            adjusted_image = self._lru.get((requested, storage_path))
+            if adjusted_image is not None:
+                found[storage_path] = adjusted_image
+        return found
+
+    def add(self, requested, adjusted_image):
+        options = self.options
+        if options is None:
+            return
+        self._lru.set((requested, adjusted_image.storage_path),
+                      adjusted_image,
+                      timeout=options['TIMEOUT'],
+                      max_entries=options['MAX_ENTRIES'])
+
+    def invalidate(self, adjusted_image):
+        options = self.options
+        if options is None:
+            return
+        self._lru.delete((adjusted_image.requested,
+                          adjusted_image.storage_path))
+        if options['VERSION_CACHE'] is not None:
+            self._version = uuid.uuid4().hex
+            caches[options['VERSION_CACHE']].set(
+                self.version_key, self._version, None)
+
+    def clear(self):
+        self._lru.clear()
+
+    def stats(self):
+        """
+        Returns a dict of ``hits``, ``misses`` and ``entries`` counts for
+        monitoring.
+
+        """
+        return self._lru.stats()
+
+
+#: The process-wide :class:`LookupCache`.
+lookup_cache = LookupCache()
+
+
+@receiver(post_save, sender=AdjustedImage)
+@receiver(post_delete, sender=AdjustedImage)
+def invalidate_lookup_cache(sender, **kwargs):
+    """
+    Drops changed or deleted AdjustedImages from the lookup cache. Newly
+    created AdjustedImages can't be cached yet, so they're ignored.
+
+    """
+    if kwargs.get('created'):
+        return
+    lookup_cache.invalidate(kwargs['instance'])
+
+
+@receiver(post_save, sender=AdjustedImage)
+@receiver(post_delete, sender=AdjustedImage)
+def invalidate_adjusted_info_cache(sender, **kwargs):
+    """
+    Drops cached info dicts for an AdjustedImage's storage path whenever one
+    is created (replacing info dicts which point at the redirect view),
+    changed or deleted.
+
+    """
+    invalidate_info_cache([kwargs['instance'].storage_path],
+                          kwargs.get('using'))
+
+
+class DeletedAdjustedFiles(object):
+    """
+    Collects the adjusted image files of AdjustedImages deleted in a
+    transaction, and is called once it's committed to delete those which
+    no other AdjustedImage uses from storage, ``batch_size`` at a time.
+
+    """
+    batch_size = 1000
+
+    def __init__(self):
+        self.paths = set()
+
+    def __call__(self):
+        storage = AdjustedImage._meta.get_field('adjusted').storage
+        # Only files which daguerre generated are deleted, never (say) an
+        # original image an AdjustedImage was pointed at.
+        base_dir = getattr(
+            settings, 'DAGUERRE_ADJUSTED_IMAGE_PATH',
+            DEFAULT_ADJUSTED_IMAGE_PATH)
+        paths = sorted(path for path in self.paths
+                       if path.startswith(base_dir + '/'))
+        for i in range(0, len(paths), self.batch_size):
+            batch = paths[i:i + self.batch_size]
+            in_use = set(AdjustedImage.objects.filter(
+                adjusted__in=batch).values_list('adjusted', flat=True))
+            batch = [path for path in batch if path not in in_use]
+            if not batch:
+                continue
+            try:
+                # Storages which can delete many files at once may say so.
+                delete_many = getattr(storage, 'delete_many', None)
+                if delete_many is not None:
+                    delete_many(batch)
+                else:
+                    for path in batch:
+                        storage.delete(path)
+            except (IOError, OSError):
+                # Anything left over is found by ``daguerre clean``.
+                pass
+
+
+def delete_adjusted_files(paths, using=None):
+    """
+    Deletes the given adjusted image files from storage once the
+    transaction is committed, unless DAGUERRE_DELETE_ADJUSTED_FILES is
+    False.
+
+    """
+    if not getattr(settings, 'DAGUERRE_DELETE_ADJUSTED_FILES', True):
+        return
+    paths = [path for path in paths if path]
+    if paths:
+        on_commit_once(DeletedAdjustedFiles, using,
+                       lambda deleted: deleted.paths.update(paths))
+
+
+@receiver(post_delete, sender=AdjustedImage)
+def delete_adjusted_file(sender, **kwargs):
+    """
+    Deletes a deleted AdjustedImage's adjusted image file from storage.
+
+    """
+    delete_adjusted_files([kwargs['instance'].adjusted.name],
+                          using=kwargs.get('using'))
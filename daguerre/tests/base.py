@@ -1,6 +1,7 @@
 import os
 
 from django.contrib.auth.models import User, Permission
+from django.db import connection
 from django.test import TestCase
 from PIL import Image
 from PIL import ImageChops
@@ -28,6 +29,19 @@ class BaseTestCase(TestCase):
         returns an open file."""
         return open(cls._data_path(test_path), mode)
 
+    def run_commit_hooks(self):
+        """
+        Runs the ``transaction.on_commit`` callbacks registered so far,
+        which TestCase's transaction would otherwise discard. Callbacks
+        registered by them are run too, as they would be after a commit.
+
+        """
+        while connection.run_on_commit:
+            callbacks = connection.run_on_commit
+            connection.run_on_commit = []
+            for sids, func in callbacks:
+                func()
+
     def assertImageEqual(self, im1, im2):
         # First check that they're the same size. A difference
         # comparison could pass for images of different sizes.
@@ -1,11 +1,16 @@
+from django.core.cache import caches
 from django.core.files.base import ContentFile
 from django.core.files.storage import default_storage
+from django.db.models import F
+from django.test.utils import override_settings
 from PIL import Image
+import io
 import mock
 import struct
 
 from daguerre.adjustments import Fit, Crop, Fill
-from daguerre.helpers import AdjustmentHelper
+from daguerre.helpers import (AdjustmentHelper, generate_many, make_lock_key,
+                              regenerate)
 from daguerre.models import AdjustedImage, Area
 from daguerre.tests.base import BaseTestCase
 
@@ -83,6 +88,13 @@ class FitTestCase(BaseTestCase):
         expected = Image.open(self._data_path('50x50_fit.png'))
         self.assertImageEqual(adjusted, expected)
 
+    def test_adjust_box(self):
+        im = Image.open(self._data_path('100x100.png'))
+        box = (10, 20, 90, 60)
+        for fit in (Fit(width=20), Fit(height=10), Fit(width=160)):
+            self.assertImageEqual(fit.adjust_box(im, box),
+                                  fit.adjust(im.crop(box)))
+
 
 class CropTestCase(BaseTestCase):
     def test_calculate__both(self):
@@ -130,6 +142,75 @@ class CropTestCase(BaseTestCase):
         expected = Image.open(self._data_path('50x50_crop_area.png'))
         self.assertImageEqual(adjusted, expected)
 
+    @mock.patch('daguerre.adjustments.numpy', None)
+    def test_adjust__area__no_numpy(self):
+        im = Image.open(self._data_path('100x100.png'))
+        crop = Crop(width=50, height=50)
+        areas = [Area(x1=21, y1=46, x2=70, y2=95)]
+        adjusted = crop.adjust(im, areas=areas)
+        self.assertEqual(adjusted.size, (50, 50))
+        expected = Image.open(self._data_path('50x50_crop_area.png'))
+        self.assertImageEqual(adjusted, expected)
+
+    def test_optimal_offset__numpy_matches_python(self):
+        """
+        The numpy offset search should pick exactly the same offset as the
+        pure-python search, including ties and areas which extend past the
+        image or the crop.
+
+        """
+        crop = Crop()
+        # Score a few rows at a time to exercise the chunked search.
+        crop.offset_chunk_size = 7
+        areas_list = [
+            [Area(x1=21, y1=46, x2=70, y2=95)],
+            [Area(x1=0, y1=0, x2=10, y2=10),
+             Area(x1=30, y1=30, x2=40, y2=40)],
+            [Area(x1=5, y1=0, x2=35, y2=40, priority=1),
+             Area(x1=25, y1=10, x2=30, y2=15, priority=5)],
+            [Area(x1=0, y1=0, x2=45, y2=45)],
+            [Area(x1=12, y1=3, x2=13, y2=4, priority=2),
+             Area(x1=2, y1=30, x2=38, y2=33, priority=4),
+             Area(x1=33, y1=1, x2=40, y2=44)],
+        ]
+        for areas in areas_list:
+            for new_dims in ((10, 10), (25, 5), (5, 25), (39, 1), (40, 40)):
+                self.assertEqual(
+                    crop._get_optimal_offset_numpy(areas, (40, 40),
+                                                   new_dims),
+                    crop._get_optimal_offset_python(areas, (40, 40),
+                                                    new_dims))
+
+    def test_optimal_offset__cached(self):
+        caches['default'].clear()
+        crop = Crop()
+        areas = [Area(x1=21, y1=46, x2=70, y2=95)]
+        with mock.patch.object(Crop, '_search_optimal_offset',
+                               return_value=(21, 46)) as search:
+            self.assertEqual(
+                crop._get_optimal_offset(areas, (100, 100), (50, 50)),
+                (21, 46))
+            self.assertEqual(
+                crop._get_optimal_offset(areas, (100, 100), (50, 50)),
+                (21, 46))
+            self.assertEqual(search.call_count, 1)
+
+            # Changing an area's geometry changes the cache key.
+            areas[0].priority = 1
+            crop._get_optimal_offset(areas, (100, 100), (50, 50))
+            self.assertEqual(search.call_count, 2)
+
+    @override_settings(DAGUERRE_OFFSET_CACHE=None)
+    def test_optimal_offset__cache_disabled(self):
+        caches['default'].clear()
+        crop = Crop()
+        areas = [Area(x1=21, y1=46, x2=70, y2=95)]
+        with mock.patch.object(Crop, '_search_optimal_offset',
+                               return_value=(21, 46)) as search:
+            crop._get_optimal_offset(areas, (100, 100), (50, 50))
+            crop._get_optimal_offset(areas, (100, 100), (50, 50))
+            self.assertEqual(search.call_count, 2)
+
 
 class FillTestCase(BaseTestCase):
     def test_calculate__both(self):
@@ -356,6 +437,318 @@ class AdjustmentHelperTestCase(BaseTestCase):
         self.assertIsInstance(crop, Crop)
         self.assertEqual(crop.kwargs, {'width': '25', 'height': None})
 
+    def test_areas_change(self):
+        left = [Area(x1=0, y1=0, x2=20, y2=100, name='left')]
+        right = [Area(x1=80, y1=0, x2=100, y2=100, name='right')]
+        dims = (100, 100)
+        # Areas move the crop.
+        self.assertTrue(AdjustmentHelper.areas_change(
+            'fill|50|100||', dims, left, right))
+        self.assertTrue(AdjustmentHelper.areas_change(
+            'crop|25|>fit|10|', dims, left, right))
+        # Nothing to crop.
+        self.assertFalse(AdjustmentHelper.areas_change(
+            'fill|100|100||', dims, left, right))
+        self.assertFalse(AdjustmentHelper.areas_change(
+            'fit|50|50', dims, left, right))
+        # Named crops only depend on their own area.
+        self.assertFalse(AdjustmentHelper.areas_change(
+            'namedcrop|face', dims, left, right))
+        self.assertTrue(AdjustmentHelper.areas_change(
+            'namedcrop|left', dims, left, right))
+        self.assertTrue(AdjustmentHelper.areas_change(
+            'unknown|50', dims, left, left))
+
+
+class RegenerateTestCase(BaseTestCase):
+    def test_regenerate(self):
+        """
+        Regenerating should switch the AdjustedImage over to a new file and
+        delete the old one.
+
+        """
+        storage_path = self.create_image('100x100.png')
+        helper = AdjustmentHelper([storage_path], generate=True)
+        helper.adjust('fit', width=50)
+        helper._finalize()
+        adjusted = AdjustedImage.objects.get()
+        old_path = adjusted.adjusted.name
+        AdjustedImage.objects.filter(pk=adjusted.pk).update(stale=True)
+
+        regenerate(AdjustedImage.objects.get())
+        self.run_commit_hooks()
+        new = AdjustedImage.objects.get()
+        self.assertEqual(new.pk, adjusted.pk)
+        self.assertFalse(new.stale)
+        self.assertNotEqual(new.adjusted.name, old_path)
+        self.assertTrue(default_storage.exists(new.adjusted.name))
+        self.assertFalse(default_storage.exists(old_path))
+
+    def test_regenerate__areas(self):
+        """
+        Regenerating should take the original's areas into account.
+
+        """
+        storage_path = self.create_image('100x100.png')
+        self.create_area(storage_path=storage_path, x1=21, x2=70, y1=46,
+                         y2=95, name='area')
+        adjusted = AdjustedImage.objects.create(storage_path=storage_path,
+                                                requested='namedcrop|area>fit|25|25',
+                                                adjusted='dg/old.png',
+                                                stale=True)
+        expected = Image.open(self._data_path('25x25_fit_named_crop.png'))
+
+        regenerate(adjusted)
+        adjusted = AdjustedImage.objects.get()
+        self.assertFalse(adjusted.stale)
+        self.assertImageEqual(Image.open(adjusted.adjusted.path), expected)
+
+    def test_regenerate__changed(self):
+        """
+        If the AdjustedImage changed meanwhile, the new file should be
+        thrown away.
+
+        """
+        storage_path = self.create_image('100x100.png')
+        adjusted = AdjustedImage.objects.create(storage_path=storage_path,
+                                                requested='fit|50|',
+                                                adjusted='dg/old.png',
+                                                stale=True)
+        AdjustedImage.objects.filter(pk=adjusted.pk).update(
+            adjusted='dg/other.png')
+        with mock.patch.object(default_storage, 'delete') as delete:
+            regenerate(adjusted)
+        delete.assert_called_once_with(mock.ANY)
+        self.assertEqual(AdjustedImage.objects.get().adjusted.name,
+                         'dg/other.png')
+
+    def test_regenerate__stale_again(self):
+        """
+        If the AdjustedImage was marked stale again meanwhile (because its
+        areas changed again), it should be left stale for the next
+        regeneration rather than switched to a file made with the old areas.
+
+        """
+        storage_path = self.create_image('100x100.png')
+        adjusted = AdjustedImage.objects.create(storage_path=storage_path,
+                                                requested='fit|50|',
+                                                adjusted='dg/old.png',
+                                                stale=True)
+        AdjustedImage.objects.filter(pk=adjusted.pk).update(
+            revision=F('revision') + 1)
+        with mock.patch.object(default_storage, 'delete') as delete:
+            regenerate(adjusted)
+        delete.assert_called_once_with(mock.ANY)
+        adjusted = AdjustedImage.objects.get()
+        self.assertTrue(adjusted.stale)
+        self.assertEqual(adjusted.adjusted.name, 'dg/old.png')
+
+
+@override_settings(DAGUERRE_GENERATION_LOCK={'POLL_INTERVAL': 0})
+class GenerationLockTestCase(BaseTestCase):
+    def setUp(self):
+        self.storage_path = self.create_image('100x100.png')
+        self.helper = AdjustmentHelper([self.storage_path], generate=True)
+        self.helper.adjust('fit', width=50)
+        self.key = make_lock_key(self.storage_path, self.helper.requested)
+        self.cache = caches['default']
+
+    def tearDown(self):
+        self.cache.delete(self.key)
+
+    def test_generate(self):
+        """The lock should be released once the image is generated."""
+        adjusted = self.helper._generate(self.storage_path)
+        self.assertEqual(adjusted, AdjustedImage.objects.get())
+        self.assertIsNone(self.cache.get(self.key))
+
+    def test_generate__wait(self):
+        """
+        While another request holds the lock, its adjusted image should be
+        waited for rather than generated again.
+
+        """
+        self.cache.add(self.key, True)
+        adjusted = AdjustedImage.objects.create(
+            storage_path=self.storage_path,
+            requested=self.helper.requested,
+            adjusted=self.storage_path)
+        with mock.patch.object(self.helper, '_generate_image') as generate:
+            self.assertEqual(self.helper._generate(self.storage_path),
+                             adjusted)
+        self.assertFalse(generate.called)
+
+    @override_settings(DAGUERRE_GENERATION_LOCK={'TIMEOUT': 0})
+    def test_generate__timeout(self):
+        """
+        If the other request takes too long, the image should be generated
+        anyway, leaving the other request's lock alone.
+
+        """
+        self.cache.add(self.key, True)
+        adjusted = self.helper._generate(self.storage_path)
+        self.assertEqual(adjusted, AdjustedImage.objects.get())
+        self.assertTrue(self.cache.get(self.key))
+
+
+class ApplyAdjustmentHelperTestCase(BaseTestCase):
+    def test_apply__crop_fit(self):
+        """
+        A crop followed by a fit should be done without cropping the image
+        first, with the same result.
+
+        """
+        im = Image.open(self._data_path('100x100.png'))
+        adjustments = [Crop(width=60, height=40), Fit(width=15)]
+        expected = adjustments[1].adjust(adjustments[0].adjust(im))
+        helper = AdjustmentHelper([])
+        with mock.patch.object(Crop, 'adjust') as crop_adjust:
+            adjusted = helper._apply(im, adjustments)
+        self.assertFalse(crop_adjust.called)
+        self.assertImageEqual(adjusted, expected)
+
+    def test_apply__unfused(self):
+        im = Image.open(self._data_path('100x100.png'))
+        adjustments = [Fit(width=50), Crop(width=20), Fit(width=10)]
+        expected = im
+        for adjustment in adjustments:
+            expected = adjustment.adjust(expected)
+        helper = AdjustmentHelper([])
+        self.assertImageEqual(helper._apply(im, adjustments), expected)
+
+
+class DraftAdjustmentHelperTestCase(BaseTestCase):
+    def setUp(self):
+        super(DraftAdjustmentHelperTestCase, self).setUp()
+        f = io.BytesIO()
+        Image.new('RGB', (400, 300), (255, 0, 0)).save(f, format='JPEG')
+        self.storage_path = default_storage.save(
+            'daguerre/test/400x300.jpg', ContentFile(f.getvalue()))
+
+    def tearDown(self):
+        default_storage.delete(self.storage_path)
+        super(DraftAdjustmentHelperTestCase, self).tearDown()
+
+    def _open(self):
+        return Image.open(default_storage.open(self.storage_path, 'rb'))
+
+    def test_draft__fit(self):
+        helper = AdjustmentHelper([self.storage_path])
+        helper.adjust('fit', width=40)
+        im = self._open()
+        self.assertEqual(helper._draft(im), (400, 300))
+        # 2x headroom over 40x30 allows decoding at 1/4 scale.
+        self.assertEqual(im.size, (100, 75))
+
+    def test_draft__fill(self):
+        helper = AdjustmentHelper([self.storage_path])
+        helper.adjust('fill', width=30, height=30)
+        im = self._open()
+        self.assertEqual(helper._draft(im), (400, 300))
+        self.assertEqual(im.size, (100, 75))
+
+    def test_draft__crop(self):
+        helper = AdjustmentHelper([self.storage_path])
+        helper.adjust('crop', width=40)
+        im = self._open()
+        self.assertIsNone(helper._draft(im))
+        self.assertEqual(im.size, (400, 300))
+
+    def test_draft__upscale(self):
+        helper = AdjustmentHelper([self.storage_path])
+        helper.adjust('fit', width=800)
+        im = self._open()
+        self.assertIsNone(helper._draft(im))
+        self.assertEqual(im.size, (400, 300))
+
+    def test_generate__drafted(self):
+        """
+        Drafted generation should give the same dimensions as adjusting the
+        full resolution image.
+
+        """
+        for adjustment in (Fit(width=40), Fit(width=37, height=37),
+                           Fill(width=30, height=30),
+                           Fill(width=33, height=17)):
+            helper = AdjustmentHelper([self.storage_path])
+            helper.adjust(adjustment)
+            with mock.patch.object(helper, '_draft',
+                                   wraps=helper._draft) as draft:
+                adjusted = helper._generate(self.storage_path)
+            self.assertEqual(draft.call_count, 1)
+            expected = adjustment.adjust(self._open())
+            self.assertEqual(Image.open(adjusted.adjusted.path).size,
+                             expected.size)
+            default_storage.delete(adjusted.adjusted.name)
+
+    def test_draft__helpers(self):
+        """Several helpers should be drafted for the largest of them."""
+        helpers = []
+        for width in (40, 90):
+            helper = AdjustmentHelper([self.storage_path])
+            helper.adjust('fit', width=width)
+            helpers.append(helper)
+        im = self._open()
+        self.assertEqual(helpers[0]._draft(im, helpers=helpers), (400, 300))
+        # 2x headroom over 90x68 allows decoding at 1/2 scale.
+        self.assertEqual(im.size, (200, 150))
+
+        helper = AdjustmentHelper([self.storage_path])
+        helper.adjust('crop', width=40)
+        im = self._open()
+        self.assertIsNone(helpers[0]._draft(im, helpers=helpers + [helper]))
+
+    def test_generate_many(self):
+        """
+        Generating several adjustments at once should give the same results
+        as generating each of them separately, with a single read.
+
+        """
+        f = io.BytesIO()
+        Image.radial_gradient('L').resize((400, 300)).convert('RGB').save(
+            f, format='JPEG')
+        default_storage.delete(self.storage_path)
+        self.storage_path = default_storage.save(self.storage_path,
+                                                 ContentFile(f.getvalue()))
+        # These are all decoded at the same reduced scale when generated
+        # separately.
+        adjustments = (Fit(width=40), Fill(width=30, height=30),
+                       Fit(width=45, height=30))
+        expected = []
+        for adjustment in adjustments:
+            helper = AdjustmentHelper([self.storage_path])
+            helper.adjust(adjustment)
+            adjusted = helper._generate(self.storage_path)
+            expected.append(Image.open(adjusted.adjusted.path))
+            adjusted.delete()
+
+        helpers = []
+        for adjustment in adjustments:
+            helper = AdjustmentHelper([self.storage_path])
+            helper.adjust(adjustment)
+            helpers.append(helper)
+        with mock.patch.object(helpers[0], '_read',
+                               wraps=helpers[0]._read) as read:
+            adjusted_images = generate_many(self.storage_path, helpers)
+        self.assertEqual(read.call_count, 1)
+
+        for helper, adjusted, im in zip(helpers, adjusted_images, expected):
+            self.assertEqual(adjusted.requested, helper.requested)
+            self.assertImageEqual(Image.open(adjusted.adjusted.path), im)
+
+    def test_generate_many__areas(self):
+        """Area-aware adjustments should take the original's areas into
+        account."""
+        Area.objects.create(storage_path=self.storage_path, x1=300, y1=200,
+                            x2=400, y2=300)
+        helper = AdjustmentHelper([self.storage_path])
+        helper.adjust('crop', width=100, height=100)
+        with mock.patch.object(Crop, 'adjust',
+                               wraps=helper.adjustments[0].adjust) as adjust:
+            adjusted, = generate_many(self.storage_path, [helper])
+        self.assertEqual(len(adjust.call_args[1]['areas']), 1)
+        default_storage.delete(adjusted.adjusted.name)
+
 
 class BrokenImageAdjustmentHelperTestCase(BaseTestCase):
 
@@ -492,6 +885,68 @@ class BulkAdjustmentHelperTestCase(BaseTestCase):
         with self.assertNumQueries(1):
             helper._finalize()
 
+    def test_info_dicts__stored_dimensions(self):
+        """
+        Info dicts for existing adjusted images should use the stored
+        dimensions without reading the adjusted file.
+
+        """
+        image = self.create_image('100x100.png')
+        helper = AdjustmentHelper([image], generate=True)
+        helper.adjust('crop', width=50, height=40)
+        helper._finalize()
+        adjusted = AdjustedImage.objects.get()
+        self.assertEqual((adjusted.width, adjusted.height), (50, 40))
+
+        helper = AdjustmentHelper([image], generate=False)
+        helper.adjust('crop', width=50, height=40)
+        with mock.patch('django.db.models.fields.files.ImageFieldFile.'
+                        '_get_image_dimensions') as get_dimensions:
+            with self.assertNumQueries(1):
+                helper._finalize()
+        self.assertFalse(get_dimensions.called)
+        self.assertEqual(helper[0][1]['width'], 50)
+        self.assertEqual(helper[0][1]['height'], 40)
+
+    @override_settings(DAGUERRE_DIMENSIONS_CACHE='default')
+    def test_info_dicts__cached_dimensions(self):
+        """
+        Original image dimensions should only be read from storage once.
+
+        """
+        caches['default'].clear()
+        images = [
+            self.create_image('100x100.png'),
+            self.create_image('100x50_crop.png'),
+        ]
+        adj = Crop(width=50, height=50)
+
+        helper = AdjustmentHelper(images, generate=False)
+        helper.adjust(adj)
+        helper._finalize()
+
+        helper = AdjustmentHelper(images, generate=False)
+        helper.adjust(adj)
+        with mock.patch('daguerre.helpers.probe_image') as probe_image:
+            helper._finalize()
+        self.assertFalse(probe_image.called)
+        self.assertEqual(helper[1][1]['width'], 50)
+        self.assertEqual(helper[1][1]['height'], 50)
+
+    @override_settings(DAGUERRE_DIMENSIONS_CACHE=None)
+    def test_info_dicts__dimensions_cache_disabled(self):
+        image = self.create_image('100x100.png')
+        for i in range(2):
+            helper = AdjustmentHelper([image], generate=False)
+            helper.adjust('crop', width=50, height=50)
+            helper._finalize()
+        with mock.patch('daguerre.helpers.probe_image',
+                        return_value=(100, 100, None)) as probe_image:
+            helper = AdjustmentHelper([image], generate=False)
+            helper.adjust('crop', width=50, height=50)
+            helper._finalize()
+        self.assertTrue(probe_image.called)
+
     def test_lookup(self):
         storage_path = 'path/to/somewhe.re'
         iterable = [
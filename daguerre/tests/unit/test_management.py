@@ -1,18 +1,37 @@
+import json
+import os
+import shutil
+import tempfile
+
+import django
 from django.conf import settings
+from django.core.cache import caches
 from django.core.files.storage import default_storage
 from django.core.management.base import CommandError
 from django.test.utils import override_settings
+from django.utils import timezone
 import mock
 
 from daguerre.adjustments import Fit
+from daguerre.helpers import generate_many, make_dimensions_key
+from daguerre.management.commands._daguerre_backfill import (
+    Command as Backfill)
 from daguerre.management.commands._daguerre_clean import Command as Clean
+from daguerre.management.commands._daguerre_dimensions import (
+    NO_CACHE,
+    Command as Dimensions,
+)
 from daguerre.management.commands._daguerre_preadjust import (
     NO_ADJUSTMENTS,
+    BAD_SHARD,
+    BAD_SINCE,
     BAD_STRUCTURE,
     Command as Preadjust,
 )
+from daguerre.management.commands._daguerre_worker import Command as Worker
 from daguerre.management.commands.daguerre import Command as Daguerre
-from daguerre.models import AdjustedImage, Area
+from daguerre.models import (AdjustedImage, AdjustmentJob, Area,
+                             PreadjustCheckpoint, PreadjustRun)
 from daguerre.tests.base import BaseTestCase
 
 
@@ -62,6 +81,32 @@ class CleanTestCase(BaseTestCase):
         self.assertEqual(list(clean._old_areas()), [area1])
         default_storage.delete(storage_path)
 
+    @override_settings(DAGUERRE_DIMENSIONS_CACHE='default')
+    def test_old_areas__dimensions(self):
+        """
+        Cached dimensions of originals which no longer exist should be
+        dropped, so that they aren't used for a new file with that name.
+
+        """
+        nonexistant = 'daguerre/test/nonexistant.png'
+        if default_storage.exists(nonexistant):
+            default_storage.delete(nonexistant)
+
+        storage_path = self.create_image('100x100.png')
+        cache = caches['default']
+        cache.set(make_dimensions_key(nonexistant), (100, 100, None))
+        cache.set(make_dimensions_key(storage_path), (100, 100, None))
+        Area.objects.create(storage_path=nonexistant,
+                            x1=0, x2=10, y1=0, y2=10)
+        Area.objects.create(storage_path=storage_path,
+                            x1=0, x2=10, y1=0, y2=10)
+        clean = Clean()
+        list(clean._old_areas())
+        self.assertIsNone(cache.get(make_dimensions_key(nonexistant)))
+        self.assertEqual(cache.get(make_dimensions_key(storage_path)),
+                         (100, 100, None))
+        default_storage.delete(storage_path)
+
     def test_missing_adjustments(self):
         """
         _missing_adjustments should return AdjustedImages whose adjusted
@@ -83,6 +128,64 @@ class CleanTestCase(BaseTestCase):
         self.assertEqual(list(clean._missing_adjustments()), [adjusted1])
         default_storage.delete(storage_path)
 
+    def test_missing_paths__shared(self):
+        """
+        Storage paths checked by one pass shouldn't be checked again by
+        another.
+
+        """
+        storage_path = self.create_image('100x100.png')
+        AdjustedImage.objects.create(requested='fit|50|50',
+                                     storage_path=storage_path,
+                                     adjusted=storage_path)
+        Area.objects.create(storage_path=storage_path,
+                            x1=0, x2=10, y1=0, y2=10)
+        clean = Clean()
+        with mock.patch.object(clean, '_check',
+                               wraps=clean._check) as check:
+            self.assertEqual(list(clean._old_adjustments()), [])
+            self.assertEqual(list(clean._old_areas()), [])
+        check.assert_called_once_with((None, [storage_path]))
+        # The old areas pass is done with them.
+        self.assertEqual(clean._known_paths, {})
+        default_storage.delete(storage_path)
+
+    def test_missing_paths__bounded(self):
+        """
+        Only known_paths_size storage paths should be remembered, and
+        adjusted image files should never be.
+
+        """
+        paths = ['daguerre/test/nonexistant{0}.png'.format(i)
+                 for i in range(3)]
+        for path in paths:
+            AdjustedImage.objects.create(requested='fit|50|50',
+                                         storage_path=path,
+                                         adjusted=path)
+        clean = Clean()
+        clean.known_paths_size = 2
+        self.assertEqual(len(clean._old_adjustments()), 3)
+        self.assertEqual(clean._known_paths,
+                         dict((path, False) for path in paths[:2]))
+        self.assertEqual(len(clean._missing_adjustments()), 3)
+        self.assertEqual(len(clean._known_paths), 2)
+
+    def test_missing_paths__listdir(self):
+        """
+        Directories with many paths to check should be listed once instead.
+
+        """
+        paths = ['dir/{0}.png'.format(i) for i in range(10)]
+        clean = Clean()
+        storage = 'daguerre.management.commands._daguerre_clean.default_storage'
+        with mock.patch(storage) as default_storage:
+            default_storage.listdir.return_value = ([], ['1.png', '3.png'])
+            missing = clean._missing_paths(paths + ['other/1.png'])
+            default_storage.listdir.assert_called_once_with('dir')
+            default_storage.exists.assert_called_once_with('other/1.png')
+        self.assertEqual(missing, [path for path in paths
+                                   if path not in ('dir/1.png', 'dir/3.png')])
+
     def test_duplicate_adjustments(self):
         path1 = self.create_image('100x100.png')
         path2 = self.create_image('100x100.png')
@@ -101,6 +204,52 @@ class CleanTestCase(BaseTestCase):
         self.assertTrue(list(duplicates) == [adjusted1] or
                         list(duplicates) == [adjusted2])
 
+    def test_duplicate_adjustments__one_query(self):
+        for i in range(3):
+            for j in range(3):
+                AdjustedImage.objects.create(
+                    requested='fit|50|50',
+                    storage_path='{0}.png'.format(i),
+                    adjusted='dg/{0}.png'.format(j))
+        clean = Clean()
+        with self.assertNumQueries(1):
+            duplicates = list(clean._duplicate_adjustments())
+        self.assertEqual(len(duplicates), 6)
+
+    def test_delete_duplicates(self):
+        """
+        Duplicate AdjustedImages should be deleted, and once committed so
+        should any adjusted files that aren't used by the canonical
+        AdjustedImage.
+
+        """
+        storage_path = self.create_image('100x100.png')
+        with self._data_file('100x100.png', 'rb') as f:
+            path1 = default_storage.save('dg/test/dup1.png', f)
+            f.seek(0)
+            path2 = default_storage.save('dg/test/dup2.png', f)
+        adjusted1 = AdjustedImage.objects.create(requested='fit|50|50',
+                                                 storage_path=storage_path,
+                                                 adjusted=path1)
+        AdjustedImage.objects.create(requested='fit|50|50',
+                                     storage_path=storage_path,
+                                     adjusted=path1)
+        AdjustedImage.objects.create(requested='fit|50|50',
+                                     storage_path=storage_path,
+                                     adjusted=path2)
+        clean = Clean()
+        clean.batch_size = 1
+        with mock.patch.object(clean, '_delete_files') as delete_files:
+            self.assertEqual(
+                clean._delete_duplicates(clean._duplicate_adjustments()), 2)
+        self.assertFalse(delete_files.called)
+        self.assertEqual(list(AdjustedImage.objects.all()), [adjusted1])
+        self.assertTrue(default_storage.exists(path2))
+        self.run_commit_hooks()
+        self.assertTrue(default_storage.exists(path1))
+        self.assertFalse(default_storage.exists(path2))
+        default_storage.delete(path1)
+
     def test_orphaned_files__default_path(self):
         clean = Clean()
         walk_ret = (
@@ -132,6 +281,114 @@ class CleanTestCase(BaseTestCase):
                               'img/test/fake3.png'])
             walk.assert_called_once_with('img', topdown=False)
 
+    def test_iter_orphaned_files(self):
+        """
+        Orphaned files should be found a directory at a time, looking up
+        only that directory's files.
+
+        """
+        clean = Clean()
+        walk_ret = (
+            ('dg/aa/bb', [], ['fake1.png', 'fake2.png']),
+            ('dg/aa/cc', [], ['fake3.png']),
+            ('dg/aa', ['bb', 'cc'], []),
+            ('dg', ['aa'], []),
+        )
+        AdjustedImage.objects.create(requested='fit|50|50',
+                                     storage_path='whatever.png',
+                                     adjusted='dg/aa/bb/fake2.png')
+        with mock.patch.object(clean, '_walk', return_value=walk_ret):
+            with self.assertNumQueries(2):
+                self.assertEqual(list(clean._iter_orphaned_files()),
+                                 [['dg/aa/bb/fake1.png'],
+                                  ['dg/aa/cc/fake3.png']])
+
+    def test_handle__orphaned_files(self):
+        clean = Clean()
+        orphans = [['dg/aa/bb/fake1.png'], ['dg/aa/cc/fake3.png']]
+        with mock.patch.object(clean, '_iter_orphaned_files',
+                               return_value=iter(orphans)):
+            with mock.patch.object(clean, '_delete_files') as delete_files:
+                with mock.patch.object(clean, 'stdout') as stdout:
+                    clean.handle(threads=1)
+        delete_files.assert_has_calls([mock.call(orphans[0]),
+                                       mock.call(orphans[1])])
+        stdout.write.assert_has_calls([
+            mock.call("Deleted 2 orphaned files.\n"),
+            mock.call("\n"),
+        ])
+
+    def test_walk__after(self):
+        """
+        A bottom-up walk continuing after a directory shouldn't list
+        directories which were already walked.
+
+        """
+        tree = {
+            'dg': (['aa', 'bb'], []),
+            'dg/aa': (['cc', 'dd'], []),
+            'dg/aa/cc': ([], ['1.png']),
+            'dg/aa/dd': ([], ['2.png']),
+            'dg/bb': ([], ['3.png']),
+        }
+        clean = Clean()
+        storage = 'daguerre.management.commands._daguerre_clean.default_storage'
+        with mock.patch(storage) as default_storage:
+            default_storage.listdir.side_effect = tree.get
+            self.assertEqual(
+                [dirpath for dirpath, _, _ in clean._walk('dg', False)],
+                ['dg/aa/cc', 'dg/aa/dd', 'dg/aa', 'dg/bb', 'dg'])
+            default_storage.listdir.reset_mock()
+            self.assertEqual(
+                [dirpath for dirpath, _, _ in clean._walk(
+                    'dg', False, after='dg/aa/cc')],
+                ['dg/aa/dd', 'dg/aa', 'dg/bb', 'dg'])
+            self.assertNotIn(mock.call('dg/aa/cc'),
+                             default_storage.listdir.call_args_list)
+
+    def test_handle__cursor_file(self):
+        """
+        When time runs out, clean should record where it got to and
+        continue from there next time.
+
+        """
+        for path in ('a.png', 'b.png', 'c.png'):
+            AdjustedImage.objects.create(requested='fit|50|50',
+                                         storage_path=path,
+                                         adjusted=path)
+        tempdir = tempfile.mkdtemp()
+        cursor_file = os.path.join(tempdir, 'cursor.json')
+        clean = Clean()
+        clean.batch_size = 1
+        # Run out of time after the first deletion.
+        with mock.patch.object(
+                clean, '_out_of_time',
+                side_effect=lambda: AdjustedImage.objects.count() < 3):
+            with mock.patch.object(clean, 'stdout') as stdout:
+                clean.handle(threads=1, cursor_file=cursor_file)
+        stdout.write.assert_has_calls([
+            mock.call("Deleted 1 adjusted image which reference nonexistant "
+                      "paths.\n"),
+            mock.call("Out of time; run again to continue.\n"),
+        ])
+        self.assertEqual(
+            list(AdjustedImage.objects.values_list('storage_path', flat=True)
+                 .order_by('storage_path')),
+            ['b.png', 'c.png'])
+        with open(cursor_file) as f:
+            self.assertEqual(json.load(f), {'old_adjustments': 'a.png'})
+
+        clean = Clean()
+        with mock.patch.object(clean, '_old_adjustments',
+                               wraps=clean._old_adjustments) as old:
+            with mock.patch.object(clean, 'stdout'):
+                clean.handle(threads=1, cursor_file=cursor_file)
+        old.assert_called_once_with(['b.png', 'c.png'])
+        self.assertFalse(AdjustedImage.objects.exists())
+        with open(cursor_file) as f:
+            self.assertEqual(json.load(f), {})
+        shutil.rmtree(tempdir)
+
 
 class PreadjustTestCase(BaseTestCase):
     @override_settings()
@@ -266,8 +523,7 @@ class PreadjustTestCase(BaseTestCase):
         preadjust.stdout.write.assert_has_calls([
             mock.call('Skipped 0 empty paths.\n'),
             mock.call('Skipped 0 paths which have already been adjusted.\n'),
-            mock.call('Adjusting 1 path... '),
-            mock.call('Done.\n'),
+            mock.call('Adjusted 1 path.\n'),
         ])
 
         self.assertEqual(AdjustedImage.objects.count(), 1)
@@ -286,18 +542,509 @@ class PreadjustTestCase(BaseTestCase):
         preadjust.stdout.write.assert_has_calls([
             mock.call('Skipped 0 empty paths.\n'),
             mock.call('Skipped 0 paths which have already been adjusted.\n'),
-            mock.call('Adjusting 1 path... '),
-            mock.call('Done.\n'),
+            mock.call('Adjusted 1 path.\n'),
             mock.call('1 path failed due to I/O errors.')
         ])
 
         self.assertEqual(AdjustedImage.objects.count(), 0)
 
+    def test_preadjust__workers(self):
+        preadjust = Preadjust()
+        storage_path = self.create_image('100x100.png')
+        preadjust.stdout = mock.MagicMock()
+        # Run the jobs in this process, where the test database is visible.
+        pool = mock.MagicMock()
+        pool.imap_unordered.side_effect = (
+            lambda func, jobs, chunksize: map(func, jobs))
+
+        dp = (([storage_path, 'nonexistant.png'], [Fit(width=50)], None),)
+        with override_settings(DAGUERRE_PREADJUSTMENTS=dp):
+            with mock.patch.object(preadjust, '_get_pool',
+                                   return_value=pool) as get_pool:
+                preadjust._preadjust(workers=4)
+        get_pool.assert_called_once_with(4)
+        preadjust.stdout.write.assert_has_calls([
+            mock.call('Skipped 1 empty path.\n'),
+            mock.call('Skipped 0 paths which have already been adjusted.\n'),
+            mock.call('Adjusted 1 path.\n'),
+        ])
+        pool.close.assert_called_once_with()
+        pool.join.assert_called_once_with()
+
+        self.assertEqual(AdjustedImage.objects.count(), 1)
+
+    def test_get_pool(self):
+        """
+        Worker processes should set Django up, since spawned ones don't
+        inherit it.
+
+        """
+        with mock.patch('multiprocessing.Pool') as Pool:
+            Preadjust()._get_pool(2)
+        Pool.assert_called_once_with(2, initializer=django.setup)
+
+    def test_preadjust__workers__failed(self):
+        preadjust = Preadjust()
+        storage_path = self.create_image('100x100.png')
+        preadjust.stdout = mock.MagicMock()
+        pool = mock.MagicMock()
+        pool.imap_unordered.side_effect = (
+            lambda func, jobs, chunksize: map(func, jobs))
+
+        dp = (([storage_path], [Fit(width=50)], None),)
+        with override_settings(DAGUERRE_PREADJUSTMENTS=dp):
+            with mock.patch.object(preadjust, '_get_pool', return_value=pool):
+                with mock.patch('daguerre.helpers.save_image',
+                                side_effect=IOError):
+                    preadjust._preadjust(workers=2)
+        preadjust.stdout.write.assert_has_calls([
+            mock.call('Adjusted 1 path.\n'),
+            mock.call('1 path failed due to I/O errors.')
+        ])
+
+        self.assertEqual(AdjustedImage.objects.count(), 0)
+
+    def test_preadjust__report(self):
+        preadjust = Preadjust()
+        storage_path = self.create_image('100x100.png')
+        preadjust.stdout = mock.MagicMock()
+        preadjust.stderr = mock.MagicMock()
+
+        dp = (([storage_path], [Fit(width=50)], None),)
+        with override_settings(DAGUERRE_PREADJUSTMENTS=dp):
+            preadjust._preadjust(report='json')
+        report = json.loads(preadjust.stdout.write.call_args[0][0])
+        self.assertEqual(report['count'], 1)
+        self.assertEqual(report['bytes_read'],
+                         default_storage.size(storage_path))
+        entry, = report['entries']
+        self.assertEqual(entry['entry'], '0: fit|50|')
+        self.assertEqual(
+            set(entry['stages']),
+            {'lookup', 'read', 'decode', 'fit', 'encode', 'write'})
+        args, kwargs = preadjust.stderr.write.call_args
+        self.assertTrue(args[0].startswith('\rAdjusted 1 image ('))
+        self.assertEqual(kwargs, {'ending': '\n'})
+
+    def test_preadjust__grouped(self):
+        """
+        Entries which adjust the same path should share a single decode of
+        the original, and duplicates should only be generated once.
+
+        """
+        preadjust = Preadjust()
+        storage_path = self.create_image('100x100.png')
+        preadjust.stdout = mock.MagicMock()
+
+        dp = (([storage_path], [Fit(width=50)], None),
+              ([storage_path], [Fit(width=25)], None),
+              ([storage_path], [Fit(width=50)], None))
+        with override_settings(DAGUERRE_PREADJUSTMENTS=dp):
+            with mock.patch(
+                    'daguerre.management.commands._daguerre_preadjust.'
+                    'generate_many', wraps=generate_many) as generate:
+                preadjust._preadjust()
+        self.assertEqual(generate.call_count, 1)
+        self.assertEqual(
+            sorted(AdjustedImage.objects.values_list('requested', flat=True)),
+            ['fit|25|', 'fit|50|'])
+
+    def test_preadjust__streamed(self):
+        """
+        Batches should only be looked up a little ahead of the one being
+        adjusted, which is checkpointed as soon as it's done.
+
+        """
+        preadjust = Preadjust()
+        preadjust.stdout = mock.MagicMock()
+        preadjust.batch_size = 1
+        preadjust.lookahead = 1
+        storage_paths = [self.create_image(name) for name in
+                         ('100x100.png', '50x100_crop.png', '50x50_fit.png')]
+        generate = preadjust._generate
+        finalized = []
+        offsets = []
+
+        def _generate(helper, workers=1):
+            finalized.append(len(preadjust._groups))
+            offsets.append(PreadjustCheckpoint.objects.get().offset)
+            return generate(helper, workers=workers)
+
+        dp = ((storage_paths, [Fit(width=25)], None),)
+        with override_settings(DAGUERRE_PREADJUSTMENTS=dp):
+            with mock.patch.object(preadjust, '_generate', _generate):
+                preadjust._preadjust()
+        self.assertEqual(finalized, [2, 2, 1])
+        self.assertEqual(offsets, [0, 1, 2])
+        self.assertEqual(AdjustedImage.objects.count(), 3)
+
+    def test_preadjust__shard(self):
+        storage_paths = [self.create_image(name) for name in
+                         ('100x100.png', '50x100_crop.png', '50x50_fit.png',
+                          '50x50_crop.png')]
+        dp = ((storage_paths, [Fit(width=25)], None),)
+        adjusted = []
+        for k in (1, 2):
+            preadjust = Preadjust()
+            preadjust.stdout = mock.MagicMock()
+            with override_settings(DAGUERRE_PREADJUSTMENTS=dp):
+                preadjust._preadjust(shard=(k, 2))
+            shard_paths = set(AdjustedImage.objects.values_list(
+                'storage_path', flat=True)) - set(adjusted)
+            self.assertEqual(
+                shard_paths,
+                set(path for path in storage_paths
+                    if preadjust._in_shard(path)))
+            preadjust.stdout.write.assert_has_calls([
+                mock.call('Shard {0} of 2: skipped {1} path{2} in other '
+                          'shards.\n'.format(
+                              k,
+                              4 - len(shard_paths),
+                              '' if len(shard_paths) == 3 else 's')),
+            ])
+            adjusted.extend(shard_paths)
+        self.assertEqual(sorted(adjusted), sorted(storage_paths))
+        # Each shard keeps its own checkpoint.
+        self.assertEqual(PreadjustCheckpoint.objects.count(), 2)
+
+    def test_parse_shard(self):
+        preadjust = Preadjust()
+        self.assertEqual(preadjust._parse_shard('2/3'), (2, 3))
+        for shard in ('0/3', '4/3', '1', 'a/b', '1/2/3'):
+            self.assertRaisesMessage(CommandError, BAD_SHARD,
+                                     preadjust._parse_shard, shard)
+
+    def test_get_modified_field(self):
+        preadjust = Preadjust()
+        self.assertEqual(preadjust._get_modified_field(PreadjustCheckpoint),
+                         'updated')
+        self.assertEqual(preadjust._get_modified_field(AdjustmentJob),
+                         'created')
+        self.assertIsNone(preadjust._get_modified_field(Area))
+
+    @override_settings(DAGUERRE_PREADJUSTMENTS=(
+        (AdjustmentJob, [Fit(width=50)], 'storage_path'),
+        (AdjustedImage, [Fit(width=50)], 'storage_path')))
+    def test_preadjust__since(self):
+        """
+        Only instances changed since the given time should be considered,
+        for models which record that.
+
+        """
+        old_path = self.create_image('100x100.png')
+        new_path = self.create_image('50x100_crop.png')
+        since = timezone.now() - timezone.timedelta(days=1)
+        AdjustmentJob.objects.create(storage_path=old_path)
+        AdjustmentJob.objects.filter(storage_path=old_path).update(
+            created=since - timezone.timedelta(days=1))
+        AdjustmentJob.objects.create(storage_path=new_path)
+
+        preadjust = Preadjust()
+        preadjust.stdout = mock.MagicMock()
+        preadjust._preadjust(since=since)
+        preadjust.stdout.write.assert_has_calls([
+            mock.call('Considering items changed since {0}.\n'.format(since)),
+            mock.call('Entry 1 has no modification times; considering all '
+                      'of its items.\n'),
+        ])
+        self.assertEqual(
+            list(AdjustedImage.objects.values_list('storage_path', flat=True)),
+            [new_path])
+
+    def test_handle__since_last_run(self):
+        preadjust = Preadjust()
+        preadjust.stdout = mock.MagicMock()
+        options = {'nocreate': False, 'remove': False, 'workers': 1,
+                   'resume': False, 'report': None, 'shard': None,
+                   'since': None, 'since_last_run': True}
+        dp = (([], [Fit(width=50)], None),)
+        with override_settings(DAGUERRE_PREADJUSTMENTS=dp):
+            with mock.patch.object(preadjust, '_preadjust',
+                                   return_value=0) as _preadjust:
+                preadjust.handle(**options)
+                first_run = PreadjustRun.objects.get()
+                self.assertIsNotNone(first_run.finished)
+                self.assertIsNone(_preadjust.call_args[1]['since'])
+
+                preadjust.handle(**options)
+                self.assertEqual(_preadjust.call_args[1]['since'],
+                                 first_run.started)
+
+                # Other shards have their own runs.
+                preadjust.handle(**dict(options, shard='1/2'))
+                self.assertIsNone(_preadjust.call_args[1]['since'])
+        self.assertEqual(PreadjustRun.objects.filter(shard='1/2').count(), 1)
+
+    def test_handle__since_last_run__failed(self):
+        """
+        Runs in which paths failed shouldn't count as finished, so that the
+        next run tries them again.
+
+        """
+        preadjust = Preadjust()
+        preadjust.stdout = mock.MagicMock()
+        options = {'nocreate': False, 'remove': False, 'workers': 1,
+                   'resume': False, 'report': None, 'shard': None,
+                   'since': None, 'since_last_run': True}
+        dp = (([], [Fit(width=50)], None),)
+        with override_settings(DAGUERRE_PREADJUSTMENTS=dp):
+            with mock.patch.object(preadjust, '_preadjust',
+                                   return_value=1) as _preadjust:
+                preadjust.handle(**options)
+                self.assertIsNone(PreadjustRun.objects.get().finished)
+
+                preadjust.handle(**options)
+                self.assertIsNone(_preadjust.call_args[1]['since'])
+
+    def test_handle__resume_run_start(self):
+        """
+        A run which resumes an interrupted one should be recorded as having
+        started when the interrupted one did.
+
+        """
+        preadjust = Preadjust()
+        started = timezone.now() - timezone.timedelta(hours=1)
+        PreadjustRun.objects.create(started=started)
+        self.assertEqual(preadjust._get_run_start(resume=True), started)
+        self.assertGreater(preadjust._get_run_start(), started)
+
+    def test_parse_since(self):
+        preadjust = Preadjust()
+        self.assertEqual(
+            preadjust._parse_since('2020-01-31 12:30'),
+            timezone.make_aware(timezone.datetime(2020, 1, 31, 12, 30)))
+        self.assertEqual(
+            preadjust._parse_since('2020-01-31'),
+            timezone.make_aware(timezone.datetime(2020, 1, 31)))
+        for since in ('yesterday', '2020-13-45'):
+            self.assertRaisesMessage(CommandError, BAD_SINCE,
+                                     preadjust._parse_since, since)
+
+    def _interrupted(self, preadjust):
+        """
+        Runs preadjust with a batch size of one, stopping it after the
+        first batch.
+
+        """
+        generate = preadjust._generate
+        calls = []
+
+        def _generate(helper, workers=1):
+            if calls:
+                raise KeyboardInterrupt
+            calls.append(helper)
+            return generate(helper, workers=workers)
+
+        preadjust.batch_size = 1
+        preadjust.stdout = mock.MagicMock()
+        with mock.patch.object(preadjust, '_generate', _generate):
+            self.assertRaises(KeyboardInterrupt, preadjust._preadjust)
+
+    def test_preadjust__resume(self):
+        preadjust = Preadjust()
+        storage_path1 = self.create_image('100x100.png')
+        storage_path2 = self.create_image('50x100_crop.png')
+
+        dp = (([storage_path1, storage_path2], [Fit(width=50)], None),)
+        with override_settings(DAGUERRE_PREADJUSTMENTS=dp):
+            self._interrupted(preadjust)
+            self.assertEqual(PreadjustCheckpoint.objects.get().offset, 1)
+            self.assertEqual(AdjustedImage.objects.count(), 1)
+
+            preadjust.stdout = mock.MagicMock()
+            preadjust._preadjust(resume=True)
+        preadjust.stdout.write.assert_has_calls([
+            mock.call('Skipped 0 empty paths.\n'),
+            mock.call('Skipped 0 paths which have already been adjusted.\n'),
+            mock.call('Adjusted 1 path.\n'),
+        ])
+        self.assertEqual(PreadjustCheckpoint.objects.get().offset, 2)
+        self.assertEqual(
+            set(AdjustedImage.objects.values_list('storage_path', flat=True)),
+            {storage_path1, storage_path2})
+
+    @override_settings(DAGUERRE_PREADJUSTMENTS=(
+        (Area, [Fit(width=50)], 'storage_path'),))
+    def test_preadjust__resume__queryset(self):
+        preadjust = Preadjust()
+        area1 = self.create_area('100x100.png')
+        area2 = self.create_area('50x100_crop.png', x2=50)
+
+        self._interrupted(preadjust)
+        self.assertEqual(PreadjustCheckpoint.objects.get().last_pk,
+                         str(area1.pk))
+        self.assertEqual(AdjustedImage.objects.get().storage_path,
+                         area1.storage_path)
+
+        preadjust.stdout = mock.MagicMock()
+        preadjust._preadjust(resume=True)
+        preadjust.stdout.write.assert_has_calls([
+            mock.call('Adjusted 1 path.\n'),
+        ])
+        self.assertEqual(PreadjustCheckpoint.objects.get().last_pk,
+                         str(area2.pk))
+
+        # Without --resume, everything is looked at again.
+        preadjust.stdout = mock.MagicMock()
+        preadjust._preadjust()
+        preadjust.stdout.write.assert_has_calls([
+            mock.call('Skipped 2 paths which have already been adjusted.\n'),
+        ])
+
+
+class BackfillTestCase(BaseTestCase):
+    def test_handle(self):
+        path = self.create_image('100x50_crop.png')
+        missing = AdjustedImage.objects.create(requested='fit|100|',
+                                               storage_path=path,
+                                               adjusted=path)
+        broken = AdjustedImage.objects.create(requested='fit|50|',
+                                              storage_path=path,
+                                              adjusted='does_not_exist.png')
+        stored = AdjustedImage.objects.create(requested='fit|10|',
+                                              storage_path=path,
+                                              adjusted=path,
+                                              width=10, height=5)
+
+        backfill = Backfill()
+        backfill.stdout = mock.MagicMock()
+        backfill.handle()
+        backfill.stdout.write.assert_has_calls([
+            mock.call('Storing dimensions for 2 adjusted images... '),
+            mock.call('Done.\n'),
+            mock.call("1 adjusted image couldn't be read.\n"),
+        ])
+
+        missing.refresh_from_db()
+        self.assertEqual((missing.width, missing.height), (100, 50))
+        broken.refresh_from_db()
+        self.assertEqual((broken.width, broken.height), (None, None))
+        stored.refresh_from_db()
+        self.assertEqual((stored.width, stored.height), (10, 5))
+
+
+@override_settings(DAGUERRE_DIMENSIONS_CACHE='default')
+class DimensionsTestCase(BaseTestCase):
+    def setUp(self):
+        super(DimensionsTestCase, self).setUp()
+        caches['default'].clear()
+
+    def test_handle(self):
+        storage_path = self.create_image('100x50_crop.png')
+        missing_path = 'does_not_exist.png'
+        AdjustedImage.objects.create(storage_path=storage_path,
+                                     adjusted=storage_path)
+        Area.objects.create(storage_path=missing_path,
+                            x1=0, y1=0, x2=10, y2=10)
+
+        dimensions = Dimensions()
+        dimensions.stdout = mock.MagicMock()
+        dimensions.handle(refresh=False)
+        dimensions.stdout.write.assert_has_calls([
+            mock.call('Skipped 0 paths which are already cached.\n'),
+            mock.call('Caching dimensions for 2 paths... '),
+            mock.call('Done.\n'),
+            mock.call("1 path couldn't be read.\n"),
+        ])
+        self.assertEqual(
+            caches['default'].get(make_dimensions_key(storage_path)),
+            (100, 50, None))
+
+        dimensions.stdout = mock.MagicMock()
+        dimensions.handle(refresh=False)
+        dimensions.stdout.write.assert_has_calls([
+            mock.call('Skipped 1 path which is already cached.\n'),
+            mock.call('Caching dimensions for 1 path... '),
+        ])
+
+    def test_handle__preadjustments(self):
+        storage_path = self.create_image('100x100.png')
+        dimensions = Dimensions()
+        dimensions.stdout = mock.MagicMock()
+        dp = (([storage_path], [Fit(width=50)], None),)
+        with override_settings(DAGUERRE_PREADJUSTMENTS=dp):
+            dimensions.handle(refresh=False)
+        self.assertEqual(
+            caches['default'].get(make_dimensions_key(storage_path)),
+            (100, 100, None))
+
+    @override_settings(DAGUERRE_DIMENSIONS_CACHE=None)
+    def test_handle__no_cache(self):
+        dimensions = Dimensions()
+        self.assertRaisesMessage(CommandError, NO_CACHE,
+                                 dimensions.handle, refresh=False)
+
+
+class WorkerTestCase(BaseTestCase):
+    def test_handle(self):
+        storage_path = self.create_image('100x100.png')
+        AdjustmentJob.objects.enqueue(storage_path, 'fit|50|')
+        AdjustmentJob.objects.enqueue('nonexistant.png', 'fit|50|')
+        worker = Worker()
+        worker.stdout = mock.MagicMock()
+        worker.handle(burst=True, sleep=0, max_jobs=None)
+        worker.stdout.write.assert_has_calls([
+            mock.call('Failed to adjust nonexistant.png: fit|50|.\n'),
+            mock.call('Generated 1 adjusted image.\n'),
+            mock.call('1 job failed.\n'),
+        ])
+        adjusted = AdjustedImage.objects.get()
+        self.assertEqual(adjusted.storage_path, storage_path)
+        self.assertEqual(adjusted.requested, 'fit|50|')
+        # The failed job is kept to be retried.
+        self.assertEqual(
+            list(AdjustmentJob.objects.values_list('storage_path', flat=True)),
+            ['nonexistant.png'])
+
+    def test_handle__max_jobs(self):
+        storage_path = self.create_image('100x100.png')
+        AdjustmentJob.objects.enqueue(storage_path, 'fit|50|')
+        AdjustmentJob.objects.enqueue(storage_path, 'fit|25|')
+        worker = Worker()
+        worker.stdout = mock.MagicMock()
+        worker.handle(burst=False, sleep=0, max_jobs=1)
+        self.assertEqual(AdjustmentJob.objects.count(), 1)
+        self.assertEqual(AdjustedImage.objects.count(), 1)
+
+    def test_handle__close_old_connections(self):
+        """Old connections should be closed before each job."""
+        storage_path = self.create_image('100x100.png')
+        AdjustmentJob.objects.enqueue(storage_path, 'fit|50|')
+        AdjustmentJob.objects.enqueue(storage_path, 'fit|25|')
+        worker = Worker()
+        worker.stdout = mock.MagicMock()
+        with mock.patch('daguerre.management.commands._daguerre_worker.'
+                        'close_old_connections') as close_old_connections:
+            worker.handle(burst=True, sleep=0, max_jobs=None)
+        # Once for each job, and once more to find the queue empty.
+        self.assertEqual(close_old_connections.call_count, 3)
+
+    def test_handle__stale(self):
+        """Stale adjusted images should be regenerated in place."""
+        storage_path = self.create_image('100x100.png')
+        stale = AdjustedImage.objects.create(storage_path=storage_path,
+                                             requested='fit|50|',
+                                             adjusted='dg/old.png',
+                                             stale=True)
+        AdjustmentJob.objects.enqueue(storage_path, 'fit|50|')
+        worker = Worker()
+        worker.stdout = mock.MagicMock()
+        worker.handle(burst=True, sleep=0, max_jobs=None)
+        adjusted = AdjustedImage.objects.get()
+        self.assertEqual(adjusted.pk, stale.pk)
+        self.assertFalse(adjusted.stale)
+        self.assertNotEqual(adjusted.adjusted.name, 'dg/old.png')
+        self.assertEqual((adjusted.width, adjusted.height), (50, 50))
+        self.assertFalse(AdjustmentJob.objects.exists())
+
 
 class DaguerreTestCase(BaseTestCase):
     def test_find_commands(self):
         daguerre_command = Daguerre()
         self.assertEqual(daguerre_command._find_commands(), {
+            'backfill': '_daguerre_backfill',
             'clean': '_daguerre_clean',
-            'preadjust': '_daguerre_preadjust'
+            'dimensions': '_daguerre_dimensions',
+            'preadjust': '_daguerre_preadjust',
+            'worker': '_daguerre_worker',
         })
@@ -1,9 +1,17 @@
 import warnings
 
-from daguerre.models import AdjustedImage, upload_to
+from daguerre.helpers import AdjustmentHelper
+from daguerre.models import (AdjustedImage, AdjustmentJob, Area, LookupCache,
+                             get_info_versions, invalidate_info_cache,
+                             lookup_cache, upload_to)
 from daguerre.tests.base import BaseTestCase
 
+from django.core.cache import caches
+from django.core.files.base import ContentFile
+from django.core.files.storage import default_storage
+from django.utils import timezone
 from django.test.utils import override_settings
+import mock
 
 
 class AreaTestCase(BaseTestCase):
@@ -18,13 +26,17 @@ class AreaTestCase(BaseTestCase):
             'storage_path': storage_path,
             'adjusted': storage_path,
         }
-        area = self.create_area(storage_path=storage_path)
+        area = self.create_area(storage_path=storage_path, x2=20, y2=20)
+        self.run_commit_hooks()
         adjusted1 = AdjustedImage.objects.create(requested='fit|50|50',
                                                  **kwargs)
         adjusted2 = AdjustedImage.objects.create(requested='crop|50|50',
                                                  **kwargs)
 
+        area.x1 = area.y1 = 80
+        area.x2 = area.y2 = 100
         area.save()
+        self.run_commit_hooks()
 
         self.assertRaises(AdjustedImage.DoesNotExist,
                           AdjustedImage.objects.get,
@@ -42,19 +54,173 @@ class AreaTestCase(BaseTestCase):
             'storage_path': storage_path,
             'adjusted': storage_path,
         }
-        area = self.create_area(storage_path=storage_path)
+        area = self.create_area(storage_path=storage_path, x2=20, y2=20)
+        self.run_commit_hooks()
         adjusted1 = AdjustedImage.objects.create(requested='fit|50|50',
                                                  **kwargs)
         adjusted2 = AdjustedImage.objects.create(requested='crop|50|50',
                                                  **kwargs)
 
         area.delete()
+        self.run_commit_hooks()
 
         self.assertRaises(AdjustedImage.DoesNotExist,
                           AdjustedImage.objects.get,
                           pk=adjusted2.pk)
         AdjustedImage.objects.get(pk=adjusted1.pk)
 
+    def test_delete_adjusted_images__unaffected(self):
+        """
+        Adjusted images which would come out the same with the changed
+        areas should be kept.
+
+        """
+        storage_path = self.create_image('100x100.png')
+        kwargs = {
+            'storage_path': storage_path,
+            'adjusted': storage_path,
+        }
+        face = self.create_area(storage_path=storage_path, name='face',
+                                x2=20, y2=20)
+        self.create_area(storage_path=storage_path, name='tail',
+                         x1=80, y1=80)
+        self.run_commit_hooks()
+        face = Area.objects.get(pk=face.pk)
+        face_crop = AdjustedImage.objects.create(requested='namedcrop|face',
+                                                 **kwargs)
+        tail_crop = AdjustedImage.objects.create(requested='namedcrop|tail',
+                                                 **kwargs)
+        # The whole image is kept either way.
+        crop = AdjustedImage.objects.create(requested='crop|100|100',
+                                            **kwargs)
+
+        face.x2 = 30
+        face.save()
+        self.run_commit_hooks()
+
+        self.assertEqual(set(AdjustedImage.objects.all()),
+                         set([tail_crop, crop]))
+        self.assertRaises(AdjustedImage.DoesNotExist,
+                          AdjustedImage.objects.get,
+                          pk=face_crop.pk)
+
+    def _change_area(self):
+        storage_path = self.create_image('100x100.png')
+        area = self.create_area(storage_path=storage_path, x2=20, y2=20)
+        self.run_commit_hooks()
+        adjusted = AdjustedImage.objects.create(requested='crop|50|50',
+                                                storage_path=storage_path,
+                                                adjusted=storage_path)
+        area.x1 = area.y1 = 80
+        area.x2 = area.y2 = 100
+        area.save()
+        return adjusted
+
+    @override_settings(DAGUERRE_REVALIDATE='queue')
+    def test_delete_adjusted_images__revalidate_queue(self):
+        """
+        Affected adjusted images should be kept (but marked stale) and
+        queued to be regenerated.
+
+        """
+        adjusted = self._change_area()
+        self.run_commit_hooks()
+        stale = AdjustedImage.objects.get(pk=adjusted.pk)
+        self.assertTrue(stale.stale)
+        self.assertEqual(stale.revision, adjusted.revision + 1)
+        job = AdjustmentJob.objects.get()
+        self.assertEqual((job.storage_path, job.requested),
+                         (adjusted.storage_path, adjusted.requested))
+
+    @override_settings(DAGUERRE_REVALIDATE='thread')
+    def test_delete_adjusted_images__revalidate_thread(self):
+        adjusted = self._change_area()
+        with mock.patch('daguerre.helpers.threading.Thread') as thread:
+            self.run_commit_hooks()
+        self.assertTrue(AdjustedImage.objects.get(pk=adjusted.pk).stale)
+        thread.assert_called_once_with(target=mock.ANY,
+                                       args=([adjusted.pk],))
+        thread.return_value.start.assert_called_once_with()
+
+    def test_delete_adjusted_images__coalesced(self):
+        """
+        Changing several Areas in a transaction should invalidate each
+        storage path once, when the transaction is committed.
+
+        """
+        storage_path = self.create_image('100x100.png')
+        AdjustedImage.objects.create(requested='crop|50|50',
+                                     storage_path=storage_path,
+                                     adjusted=storage_path)
+        for i in range(3):
+            self.create_area(storage_path=storage_path, x2=20, y2=20)
+        self.assertEqual(AdjustedImage.objects.count(), 1)
+        with mock.patch('daguerre.models.invalidate_info_cache') as invalidate:
+            # Find the adjusted images and areas, then delete.
+            with self.assertNumQueries(4):
+                self.run_commit_hooks()
+        invalidate.assert_any_call([storage_path])
+        self.assertEqual(AdjustedImage.objects.count(), 0)
+
+    def test_uses_areas(self):
+        kwargs = {'storage_path': 'path.png', 'adjusted': 'path.png'}
+        self.assertFalse(AdjustedImage.objects.create(
+            requested='fit|50|50', **kwargs).uses_areas)
+        self.assertTrue(AdjustedImage.objects.create(
+            requested='fit|50|50>crop|20|20', **kwargs).uses_areas)
+        self.assertTrue(AdjustedImage.objects.create(
+            requested='unknown|50', **kwargs).uses_areas)
+
+
+class DeleteAdjustedFileTestCase(BaseTestCase):
+    def _create(self, adjusted, requested='fit|50|50'):
+        return AdjustedImage.objects.create(requested=requested,
+                                            storage_path='path.png',
+                                            adjusted=adjusted)
+
+    def test_delete(self):
+        """
+        Adjusted image files should be deleted after commit, unless another
+        AdjustedImage still uses them or daguerre didn't generate them.
+
+        """
+        path1 = default_storage.save('dg/test/1.png', ContentFile(b'1'))
+        path2 = default_storage.save('dg/test/2.png', ContentFile(b'2'))
+        original = default_storage.save('daguerre/test/3.png',
+                                        ContentFile(b'3'))
+        self._create(path1).delete()
+        adjusted = self._create(path2)
+        self._create(path2, 'fit|20|20')
+        AdjustedImage.objects.filter(pk=adjusted.pk).delete()
+        self._create(original).delete()
+        self.assertTrue(default_storage.exists(path1))
+
+        self.run_commit_hooks()
+        self.assertFalse(default_storage.exists(path1))
+        self.assertTrue(default_storage.exists(path2))
+        self.assertTrue(default_storage.exists(original))
+        default_storage.delete(path2)
+        default_storage.delete(original)
+
+    def test_delete__many(self):
+        """Storages with a delete_many method should be asked to use it."""
+        storage = AdjustedImage._meta.get_field('adjusted').storage
+        for i in range(3):
+            self._create('dg/test/{0}.png'.format(i))
+        with mock.patch.object(storage, 'delete_many', create=True) as many:
+            AdjustedImage.objects.all().delete()
+            self.run_commit_hooks()
+        many.assert_called_once_with(
+            ['dg/test/0.png', 'dg/test/1.png', 'dg/test/2.png'])
+
+    @override_settings(DAGUERRE_DELETE_ADJUSTED_FILES=False)
+    def test_delete__disabled(self):
+        path = default_storage.save('dg/test/1.png', ContentFile(b'1'))
+        self._create(path).delete()
+        self.run_commit_hooks()
+        self.assertTrue(default_storage.exists(path))
+        default_storage.delete(path)
+
 
 class AdjustedImageUploadToTestCase(BaseTestCase):
 
@@ -114,3 +280,248 @@ class AdjustedImageUploadToTestCase(BaseTestCase):
             user_warning = w[0]
             self.assertEqual(user_warning.category, UserWarning)
             self.assertEqual(user_warning.message.__str__(), warning_message)
+
+
+@override_settings(DAGUERRE_LOOKUP_CACHE={'MAX_ENTRIES': 2})
+class LookupCacheTestCase(BaseTestCase):
+    def setUp(self):
+        super(LookupCacheTestCase, self).setUp()
+        caches['default'].clear()
+        lookup_cache.clear()
+        self.storage_path = self.create_image('100x100.png')
+
+    def tearDown(self):
+        lookup_cache.clear()
+        super(LookupCacheTestCase, self).tearDown()
+
+    def _finalize(self):
+        helper = AdjustmentHelper([self.storage_path])
+        helper.adjust('fit', width=50)
+        helper._finalize()
+        return helper
+
+    def test_finalize__cached(self):
+        AdjustedImage.objects.create(requested='fit|50|',
+                                     storage_path=self.storage_path,
+                                     adjusted=self.storage_path,
+                                     width=50, height=50)
+        self._finalize()
+        with self.assertNumQueries(0):
+            helper = self._finalize()
+        self.assertEqual(helper[0][1]['width'], 50)
+
+    @override_settings(DAGUERRE_LOOKUP_CACHE=None)
+    def test_finalize__disabled(self):
+        AdjustedImage.objects.create(requested='fit|50|',
+                                     storage_path=self.storage_path,
+                                     adjusted=self.storage_path,
+                                     width=50, height=50)
+        self._finalize()
+        with self.assertNumQueries(1):
+            self._finalize()
+
+    def test_invalidate__delete(self):
+        adjusted = AdjustedImage.objects.create(
+            requested='fit|50|', storage_path=self.storage_path,
+            adjusted=self.storage_path, width=50, height=50)
+        self._finalize()
+        adjusted.delete()
+        with self.assertNumQueries(1):
+            helper = self._finalize()
+        self.assertIn('ajax_url', helper[0][1])
+
+    def test_invalidate__other_process(self):
+        """
+        Another process' cache should be cleared when the shared version
+        changes.
+
+        """
+        other = LookupCache()
+        adjusted = AdjustedImage.objects.create(
+            requested='fit|50|', storage_path=self.storage_path,
+            adjusted=self.storage_path, width=50, height=50)
+        other.get_many('fit|50|', [self.storage_path])
+        other.add('fit|50|', adjusted)
+        self.assertEqual(other.get_many('fit|50|', [self.storage_path]),
+                         {self.storage_path: adjusted})
+        adjusted.save()
+        self.assertEqual(other.get_many('fit|50|', [self.storage_path]), {})
+
+    def test_max_entries(self):
+        cache = LookupCache()
+        adjusted_images = [AdjustedImage(storage_path=str(i))
+                           for i in range(3)]
+        for adjusted in adjusted_images:
+            cache.add('fit|50|', adjusted)
+        self.assertEqual(cache.get_many('fit|50|', ['0', '1', '2']),
+                         {'1': adjusted_images[1], '2': adjusted_images[2]})
+        self.assertEqual(cache.stats(),
+                         {'hits': 2, 'misses': 1, 'entries': 2})
+
+
+@override_settings(DAGUERRE_INFO_CACHE='default')
+class InfoCacheTestCase(BaseTestCase):
+    def setUp(self):
+        super(InfoCacheTestCase, self).setUp()
+        caches['default'].clear()
+        self.storage_path = self.create_image('100x100.png')
+
+    def _finalize(self, adjustment='fit', generate=False, **kwargs):
+        helper = AdjustmentHelper([self.storage_path], generate=generate)
+        helper.adjust(adjustment, **(kwargs or {'width': 50}))
+        helper._finalize()
+        return helper.adjusted[self.storage_path]
+
+    def test_finalize__cached(self):
+        info_dict = self._finalize(generate=True)
+        with self.assertNumQueries(0):
+            self.assertEqual(self._finalize(), info_dict)
+        # Other adjustments for the same path are cached alongside.
+        other_info_dict = self._finalize(generate=True, width=20)
+        with self.assertNumQueries(0):
+            self.assertEqual(self._finalize(), info_dict)
+            self.assertEqual(self._finalize(width=20), other_info_dict)
+
+    def test_finalize__not_generated(self):
+        info_dict = self._finalize()
+        self.assertIn('ajax_url', info_dict)
+        with self.assertNumQueries(0):
+            self.assertEqual(self._finalize(), info_dict)
+
+    def test_invalidate__during_finalize(self):
+        """
+        Info dicts built while the cache is invalidated shouldn't be found
+        afterwards, since they may be out of date.
+
+        """
+        def get_versions(cache, storage_paths):
+            versions = get_info_versions(cache, storage_paths)
+            # Say an AdjustedImage is generated before the database is read.
+            invalidate_info_cache(storage_paths)
+            self.run_commit_hooks()
+            return versions
+
+        with mock.patch('daguerre.helpers.get_info_versions',
+                        side_effect=get_versions):
+            self._finalize()
+        with self.assertNumQueries(1):
+            self._finalize()
+
+    def test_invalidate__committed(self):
+        """
+        The cache should only be invalidated once the transaction is
+        committed.
+
+        """
+        self._finalize()
+        AdjustedImage.objects.create(storage_path=self.storage_path,
+                                     requested='fit|50|',
+                                     adjusted=self.storage_path)
+        with self.assertNumQueries(0):
+            self.assertIn('ajax_url', self._finalize())
+        self.run_commit_hooks()
+        self.assertNotIn('ajax_url', self._finalize())
+
+    def test_invalidate__generate(self):
+        self.assertIn('ajax_url', self._finalize())
+        self._finalize(generate=True)
+        info_dict = self._finalize()
+        self.assertNotIn('ajax_url', info_dict)
+        self.assertEqual(info_dict['url'],
+                         AdjustedImage.objects.get().adjusted.url)
+
+    def test_invalidate__area(self):
+        self._finalize('namedcrop', name='face')
+        self.create_area(storage_path=self.storage_path, name='face',
+                         x1=10, x2=30, y1=10, y2=20)
+        self.run_commit_hooks()
+        info_dict = self._finalize('namedcrop', name='face')
+        self.assertEqual((info_dict['width'], info_dict['height']), (20, 10))
+
+    @override_settings(DAGUERRE_INFO_CACHE=None)
+    def test_disabled(self):
+        self._finalize()
+        with self.assertNumQueries(1):
+            self._finalize()
+
+
+class AdjustmentJobTestCase(BaseTestCase):
+    def test_enqueue(self):
+        """Queueing the same adjustment twice should make a single job."""
+        job = AdjustmentJob.objects.enqueue('path.png', 'fit|50|')
+        self.assertEqual(AdjustmentJob.objects.enqueue('path.png', 'fit|50|'),
+                         job)
+        self.assertEqual(AdjustmentJob.objects.count(), 1)
+
+    def test_enqueue__requeue(self):
+        """
+        Jobs which a worker has claimed should only be queued again if
+        asked to.
+
+        """
+        AdjustmentJob.objects.enqueue('path.png', 'fit|50|')
+        job = AdjustmentJob.objects.claim()
+        self.assertEqual(AdjustmentJob.objects.enqueue('path.png', 'fit|50|'),
+                         job)
+        self.assertIsNone(AdjustmentJob.objects.claim())
+
+        AdjustmentJob.objects.enqueue('path.png', 'fit|50|', requeue=True)
+        self.assertEqual(AdjustmentJob.objects.claim(), job)
+
+    def test_finish(self):
+        """
+        Finishing a job should delete it, unless it was queued again after
+        being claimed.
+
+        """
+        AdjustmentJob.objects.enqueue('path.png', 'fit|50|')
+        job = AdjustmentJob.objects.claim()
+        AdjustmentJob.objects.enqueue('path.png', 'fit|50|', requeue=True)
+        AdjustmentJob.objects.finish(job)
+        self.assertTrue(AdjustmentJob.objects.exists())
+
+        AdjustmentJob.objects.finish(AdjustmentJob.objects.claim())
+        self.assertFalse(AdjustmentJob.objects.exists())
+
+    def test_claim(self):
+        """Claimed jobs shouldn't be handed out again until they time out."""
+        job = AdjustmentJob.objects.enqueue('path.png', 'fit|50|')
+        claimed = AdjustmentJob.objects.claim()
+        self.assertEqual(claimed, job)
+        self.assertEqual(claimed.attempts, 1)
+        self.assertIsNone(AdjustmentJob.objects.claim())
+
+        AdjustmentJob.objects.update(
+            claimed=timezone.now() - timezone.timedelta(seconds=10))
+        claimed = AdjustmentJob.objects.claim(timeout=5)
+        self.assertEqual(claimed, job)
+        self.assertEqual(claimed.attempts, 2)
+
+    def test_claim__max_attempts(self):
+        """Jobs which have failed too often shouldn't be handed out."""
+        AdjustmentJob.objects.create(storage_path='path.png',
+                                     requested='fit|50|', attempts=3)
+        self.assertIsNone(AdjustmentJob.objects.claim(max_attempts=3))
+
+    def test_enqueue__max_attempts(self):
+        """
+        Queueing a job which was given up on should make it available
+        again, but not while its last attempt may still be running.
+
+        """
+        job = AdjustmentJob.objects.create(storage_path='path.png',
+                                           requested='fit|50|', attempts=3,
+                                           claimed=timezone.now())
+        AdjustmentJob.objects.enqueue('path.png', 'fit|50|', timeout=5,
+                                      max_attempts=3)
+        self.assertIsNone(AdjustmentJob.objects.claim(max_attempts=3))
+
+        AdjustmentJob.objects.update(
+            claimed=timezone.now() - timezone.timedelta(seconds=10))
+        requeued = AdjustmentJob.objects.enqueue('path.png', 'fit|50|',
+                                                 timeout=5, max_attempts=3)
+        self.assertEqual(requeued, job)
+        self.assertEqual(requeued.attempts, 0)
+        claimed = AdjustmentJob.objects.claim(max_attempts=3)
+        self.assertEqual(claimed, job)
+        self.assertEqual(claimed.attempts, 1)
@@ -1,12 +1,14 @@
 from django.test import TestCase
 from django.core.files.storage import default_storage
 from PIL import Image
+import mock
 
 from daguerre.tests.base import BaseTestCase
 from daguerre.utils import (
     make_hash, save_image, get_exif_orientation,
-    get_image_dimensions, apply_exif_orientation,
-    exif_aware_size, DEFAULT_FORMAT, KEEP_FORMATS
+    get_image_dimensions, get_image_info, apply_exif_orientation,
+    exif_aware_size, resize, GenerationStats, LRUCache, DEFAULT_FORMAT,
+    KEEP_FORMATS
 )
 
 
@@ -53,6 +55,65 @@ class SaveImageTestCase(BaseTestCase):
         self.assertEqual(new_image.format, DEFAULT_FORMAT)
 
 
+class GenerationStatsTestCase(BaseTestCase):
+    def test_save_image(self):
+        """save_image should time encoding and writing separately."""
+        stats = GenerationStats()
+        image = Image.open(self._data_path('100x100.png'))
+        storage_path = save_image(image, 'daguerre/test/stats.png',
+                                  stats=stats)
+        self.assertEqual(list(stats.stages), ['encode', 'write'])
+        self.assertEqual(stats.bytes_written,
+                         default_storage.size(storage_path))
+        default_storage.delete(storage_path)
+
+    def test_update(self):
+        stats = GenerationStats()
+        with stats.stage('decode'):
+            pass
+        other = GenerationStats()
+        other.count = 2
+        other.bytes_read = 10
+        other.stages['decode'] = 1.0
+        other.stages['fit'] = 0.5
+        stats.update(other)
+        self.assertEqual(stats.count, 2)
+        self.assertEqual(stats.bytes_read, 10)
+        self.assertGreaterEqual(stats.stages['decode'], 1.0)
+        self.assertEqual(stats.stages['fit'], 0.5)
+
+
+class LRUCacheTestCase(TestCase):
+    def test_get_set(self):
+        cache = LRUCache()
+        cache.set('a', 1)
+        self.assertEqual(cache.get('a'), 1)
+        self.assertIsNone(cache.get('b'))
+        self.assertEqual(cache.stats(),
+                         {'hits': 1, 'misses': 1, 'entries': 1})
+
+    def test_max_entries(self):
+        cache = LRUCache()
+        cache.set('a', 1, max_entries=2)
+        cache.set('b', 2, max_entries=2)
+        # Using 'a' makes 'b' the least recently used entry.
+        cache.get('a')
+        cache.set('c', 3, max_entries=2)
+        self.assertEqual(cache.get('a'), 1)
+        self.assertIsNone(cache.get('b'))
+        self.assertEqual(cache.get('c'), 3)
+
+    def test_timeout(self):
+        cache = LRUCache()
+        with mock.patch('daguerre.utils.time.time', return_value=100):
+            cache.set('a', 1, timeout=10)
+        with mock.patch('daguerre.utils.time.time', return_value=109):
+            self.assertEqual(cache.get('a'), 1)
+        with mock.patch('daguerre.utils.time.time', return_value=110):
+            self.assertIsNone(cache.get('a'))
+        self.assertEqual(len(cache), 0)
+
+
 class GetExifOrientationTestCase(BaseTestCase):
     def test_exif(self):
         image = Image.open(self._data_path('20x7_exif_rotated.jpg'))
@@ -128,3 +189,68 @@ class GetImageDimensionsTestCase(BaseTestCase):
     def test_non_exif(self):
         dim = get_image_dimensions(self._data_path('20x7_no_exif.jpg'))
         self.assertEqual(dim, self.ORIGINAL_ORIENTATION)
+
+
+class GetImageInfoTestCase(BaseTestCase):
+    def test_exif_rotated(self):
+        info = get_image_info(self._data_path('20x7_exif_rotated.jpg'))
+        self.assertEqual(info, (7, 20, 6))
+
+    def test_png_ignored(self):
+        info = get_image_info(self._data_path('20x7_no_exif.png'))
+        self.assertEqual(info, (20, 7, None))
+
+
+class ResizeTestCase(BaseTestCase):
+    def setUp(self):
+        self.image = Image.effect_mandelbrot((400, 300),
+                                             (-2.0, -1.2, 1.0, 1.2), 64)
+
+    def test_no_gap(self):
+        resized = resize(self.image, (40, 30), Image.ANTIALIAS)
+        self.assertImageEqual(resized,
+                              self.image.resize((40, 30), Image.ANTIALIAS))
+
+    def test_gap(self):
+        resized = resize(self.image, (40, 30), Image.ANTIALIAS,
+                         reducing_gap=2.0)
+        self.assertEqual(resized.size, (40, 30))
+        if hasattr(Image.Image, 'reduce'):
+            self.assertImageEqual(
+                resized,
+                self.image.resize((40, 30), Image.ANTIALIAS,
+                                  reducing_gap=2.0))
+
+    def test_gap__without_reduce(self):
+        """
+        Pillow < 7 can't reduce natively, so the reduction is done with a
+        box resample first.
+
+        """
+        with mock.patch('daguerre.utils.hasattr', return_value=False,
+                        create=True):
+            with mock.patch.object(Image.Image, 'resize',
+                                   autospec=True,
+                                   side_effect=Image.Image.resize) as r:
+                resized = resize(self.image, (40, 30), Image.ANTIALIAS,
+                                 reducing_gap=2.0)
+        self.assertEqual(resized.size, (40, 30))
+        self.assertEqual([c[0][1:] for c in r.call_args_list],
+                         [((80, 60), Image.BOX),
+                          ((40, 30), Image.ANTIALIAS)])
+
+    def test_box(self):
+        """
+        Resizing a box should give exactly the same result as cropping it
+        first, with or without a reduction.
+
+        """
+        box = (100, 20, 300, 290)
+        cropped = self.image.crop(box)
+        for size, gap in (((20, 27), None), ((20, 27), 2.0),
+                          ((150, 200), 2.0), ((400, 540), 2.0)):
+            resized = resize(self.image, size, Image.ANTIALIAS, box=box,
+                             reducing_gap=gap)
+            self.assertImageEqual(
+                resized,
+                resize(cropped, size, Image.ANTIALIAS, reducing_gap=gap))
@@ -1,12 +1,15 @@
 import json
 
 from django.contrib.auth.models import AnonymousUser
+from django.core.files.storage import default_storage
 from django.http import Http404
 from django.test import RequestFactory
+from django.test.utils import override_settings
 from django.utils.encoding import force_text
+import mock
 
-from daguerre.helpers import AdjustmentHelper
-from daguerre.models import Area
+from daguerre.helpers import AdjustmentHelper, probe_image
+from daguerre.models import AdjustedImage, AdjustmentJob, Area
 from daguerre.tests.base import BaseTestCase
 from daguerre.views import (AdjustedImageRedirectView, AjaxAdjustmentInfoView,
                             AjaxUpdateAreaView)
@@ -53,6 +56,78 @@ class AdjustedImageRedirectViewTestCase(BaseTestCase):
         self.view.request = factory.get('/', helper.to_querydict(secure=True))
         self.assertRaises(Http404, self.view.get, self.view.request)
 
+    def _get(self, storage_path, **kwargs):
+        helper = AdjustmentHelper([storage_path])
+        helper.adjust('fit', **kwargs)
+        self.view.kwargs = {'storage_path': storage_path}
+        self.view.request = RequestFactory().get(
+            '/', helper.to_querydict(secure=True))
+        return self.view.get(self.view.request)
+
+    @override_settings(DAGUERRE_QUEUE={'INLINE_COST': 0})
+    def test_queue(self):
+        """
+        Costly adjustments should be queued, redirecting to the original
+        image meanwhile.
+
+        """
+        storage_path = self.create_image('100x100.png')
+        response = self._get(storage_path, width=50)
+        self.assertEqual(response.url, default_storage.url(storage_path))
+        self.assertFalse(AdjustedImage.objects.exists())
+        job = AdjustmentJob.objects.get()
+        self.assertEqual(job.storage_path, storage_path)
+        self.assertEqual(job.requested, 'fit|50|')
+
+        with override_settings(DAGUERRE_QUEUE={'INLINE_COST': 0,
+                                               'PLACEHOLDER': '/wait.png'}):
+            response = self._get(storage_path, width=50)
+        self.assertEqual(response.url, '/wait.png')
+        self.assertEqual(AdjustmentJob.objects.count(), 1)
+
+    @override_settings(DAGUERRE_QUEUE={'INLINE_COST': 100 * 100 + 50 * 50})
+    def test_queue__inline(self):
+        """Cheap adjustments should still be generated inline."""
+        storage_path = self.create_image('100x100.png')
+        response = self._get(storage_path, width=50)
+        adjusted = AdjustedImage.objects.get()
+        self.assertEqual(response.url, adjusted.adjusted.url)
+        self.assertFalse(AdjustmentJob.objects.exists())
+
+    @override_settings(DAGUERRE_QUEUE={'INLINE_COST': 0})
+    def test_queue__generated(self):
+        """Adjustments which already exist shouldn't be queued."""
+        storage_path = self.create_image('100x100.png')
+        helper = AdjustmentHelper([storage_path], generate=True)
+        helper.adjust('fit', width=50)
+        url = helper[0][1]['url']
+        response = self._get(storage_path, width=50)
+        self.assertEqual(response.url, url)
+        self.assertFalse(AdjustmentJob.objects.exists())
+
+    @override_settings(DAGUERRE_QUEUE={'INLINE_COST': 0, 'WAIT': 1})
+    def test_queue__wait(self):
+        """
+        While waiting for a worker, the view should look for the adjusted
+        image without reading the original again.
+
+        """
+        storage_path = self.create_image('100x100.png')
+        self.view.poll_interval = 0
+
+        def sleep(seconds):
+            AdjustedImage.objects.create(storage_path=storage_path,
+                                         requested='fit|50|',
+                                         adjusted=storage_path)
+
+        with mock.patch('daguerre.helpers.probe_image',
+                        wraps=probe_image) as probe:
+            with mock.patch('daguerre.views.time.sleep', side_effect=sleep):
+                response = self._get(storage_path, width=50)
+        self.assertEqual(probe.call_count, 1)
+        self.assertEqual(response.url,
+                         AdjustedImage.objects.get().adjusted.url)
+
 
 class AjaxAdjustmentInfoViewTestCase(BaseTestCase):
     def setUp(self):
@@ -193,9 +268,12 @@ class AjaxUpdateAreaViewTestCase(BaseTestCase):
         self.assertTrue(request.user.has_perm('daguerre.change_area'))
         # SB: Used to assert 4 - don't remember why.
         # Three queries expected: get the area, update the area,
-        # and clear the adjustment cache.
-        with self.assertNumQueries(3):
+        # and (on commit) clear the adjustment cache.
+        with self.assertNumQueries(2):
             response = view.post(request)
+        # Related adjusted images are cleared on commit.
+        with self.assertNumQueries(1):
+            self.run_commit_hooks()
 
         self.assertEqual(response.status_code, 200)
         self.assertEqual(response['Content-Type'], "application/json")
@@ -260,8 +338,11 @@ class AjaxUpdateAreaViewTestCase(BaseTestCase):
                                                      'daguerre.add_area'])
         self.assertTrue(request.user.has_perm('daguerre.change_area'))
         self.assertTrue(request.user.has_perm('daguerre.add_area'))
-        with self.assertNumQueries(3):
+        with self.assertNumQueries(2):
             response = view.post(request)
+        # Related adjusted images are cleared on commit.
+        with self.assertNumQueries(1):
+            self.run_commit_hooks()
 
         self.assertEqual(response.status_code, 200)
         self.assertEqual(response['Content-Type'], "application/json")
@@ -352,8 +433,11 @@ class AjaxUpdateAreaViewTestCase(BaseTestCase):
                                       HTTP_X_REQUESTED_WITH='XMLHttpRequest')
         request.user = self.create_user(permissions=['daguerre.delete_area'])
         self.assertTrue(request.user.has_perm('daguerre.delete_area'))
-        with self.assertNumQueries(3):
+        with self.assertNumQueries(2):
             response = view.delete(request)
+        # Related adjusted images are cleared on commit.
+        with self.assertNumQueries(1):
+            self.run_commit_hooks()
 
         self.assertEqual(response.status_code, 200)
         self.assertEqual(force_text(response.content), '')
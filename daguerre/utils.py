@@ -1,6 +1,11 @@
+import math
 import struct
+import threading
+import time
 import zlib
 
+from collections import OrderedDict
+from contextlib import contextmanager
 from hashlib import sha1
 
 from django.core.files.base import File
@@ -41,6 +46,112 @@ def make_hash(*args, **kwargs):
     )).hexdigest()[start:stop:step]
 
 
+class LRUCache(object):
+    """
+    A small thread-safe, process-local least-recently-used cache. Entries
+    can be given a timeout (in seconds) after which they are ignored. Hit and
+    miss counts are kept for monitoring.
+
+    """
+    def __init__(self):
+        self._data = OrderedDict()
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+
+    def __len__(self):
+        return len(self._data)
+
+    def get(self, key, default=None):
+        now = time.time()
+        with self._lock:
+            try:
+                expires, value = self._data[key]
+            except KeyError:
+                self.misses += 1
+                return default
+            if expires is not None and expires <= now:
+                del self._data[key]
+                self.misses += 1
+                return default
+            self._data.move_to_end(key)
+            self.hits += 1
+            return value
+
+    def set(self, key, value, timeout=None, max_entries=None):
+        expires = None if timeout is None else time.time() + timeout
+        with self._lock:
+            self._data[key] = (expires, value)
+            self._data.move_to_end(key)
+            if max_entries is not None:
+                while len(self._data) > max_entries:
+                    self._data.popitem(last=False)
+
+    def delete(self, key):
+        with self._lock:
+            self._data.pop(key, None)
+
+    def clear(self):
+        with self._lock:
+            self._data.clear()
+
+    def stats(self):
+        return {
+            'hits': self.hits,
+            'misses': self.misses,
+            'entries': len(self._data),
+        }
+
+
+class GenerationStats(object):
+    """
+    Accumulates the number of images generated, the bytes read and written
+    and the time spent in each stage of generating them. Instances can be
+    pickled, so that worker processes can send theirs back to be merged.
+
+    """
+    def __init__(self):
+        self.count = 0
+        self.bytes_read = 0
+        self.bytes_written = 0
+        self.stages = OrderedDict()
+
+    @contextmanager
+    def stage(self, name):
+        start = time.time()
+        try:
+            yield
+        finally:
+            self.stages[name] = (self.stages.get(name, 0) +
+                                 time.time() - start)
+
+    def update(self, other):
+        """Adds ``other``'s counts and times to this instance's."""
+        self.count += other.count
+        self.bytes_read += other.bytes_read
+        self.bytes_written += other.bytes_written
+        for name, seconds in other.stages.items():
+            self.stages[name] = self.stages.get(name, 0) + seconds
+
+    def as_dict(self):
+        return {
+            'count': self.count,
+            'bytes_read': self.bytes_read,
+            'bytes_written': self.bytes_written,
+            'stages': dict(self.stages),
+        }
+
+
+@contextmanager
+def timed(stats, name):
+    """Times the block as stage ``name`` of ``stats``, unless it's None."""
+    if stats is None:
+        yield
+    else:
+        with stats.stage(name):
+            yield
+
+
 def get_exif_orientation(image):
     # Extract the orientation tag
     try:
@@ -98,7 +209,7 @@ def exif_aware_size(image):
 def exif_aware_resize(image, *args, **kwargs):
     """
     Intelligently resize an image, taking Exif orientation into account. Takes
-    the same arguments as the PIL Image ``.resize()`` method.
+    the same arguments as :func:`resize`.
 
     :param image: A PIL Image.
 
@@ -107,7 +218,59 @@ def exif_aware_resize(image, *args, **kwargs):
     """
 
     image = apply_exif_orientation(image)
-    return image.resize(*args, **kwargs)
+    return resize(image, *args, **kwargs)
+
+
+def resize(image, size, resample, reducing_gap=None, box=None):
+    """
+    Resizes an image like the PIL Image ``.resize()`` method. If
+    ``reducing_gap`` is given, the image is first shrunk by an integer factor
+    with a fast box reduction, leaving it at least ``reducing_gap`` times
+    larger than ``size``, and then resampled to the final size. The larger
+    the gap, the closer the result is to a single resample.
+
+    :param image: A PIL Image.
+    :param size: ``(width, height)`` tuple of the requested size.
+    :param resample: A PIL resampling filter.
+    :param reducing_gap: ``None`` or a number greater than or equal to 1.
+    :param box: ``None`` or an ``(x1, y1, x2, y2)`` tuple. If given, the
+                result is the same as resizing ``image.crop(box)``, but the
+                region is reduced in place rather than copied out first
+                whenever a reduction is done.
+
+    :returns: An PIL Image object.
+
+    """
+    if box is not None and tuple(box) == (0, 0) + image.size:
+        box = None
+    if box is None:
+        width, height = image.size
+    else:
+        width, height = box[2] - box[0], box[3] - box[1]
+
+    factor_x = factor_y = 1
+    if reducing_gap is not None and resample != Image.NEAREST:
+        factor_x = int(width / size[0] / reducing_gap) or 1
+        factor_y = int(height / size[1] / reducing_gap) or 1
+
+    if factor_x > 1 or factor_y > 1:
+        if hasattr(image, 'reduce'):
+            # Pillow >= 7.0. This matches what .resize() does with a
+            # reducing_gap, except that the reduction is limited to the box.
+            image = image.reduce((factor_x, factor_y), box=box)
+            return image.resize(size, resample, box=(
+                0, 0, float(width) / factor_x, float(height) / factor_y))
+
+        if box is not None:
+            image = image.crop(box)
+        reduced_size = (int(math.ceil(float(width) / factor_x)),
+                        int(math.ceil(float(height) / factor_y)))
+        image = image.resize(reduced_size, Image.BOX)
+        return image.resize(size, resample)
+
+    if box is not None:
+        image = image.crop(box)
+    return image.resize(size, resample)
 
 
 def get_image_dimensions(file_or_path, close=False):
@@ -115,6 +278,16 @@ def get_image_dimensions(file_or_path, close=False):
     A modified version of ``django.core.files.images.get_image_dimensions``
     which accounts for Exif orientation.
 
+    """
+    return get_image_info(file_or_path, close=close)[:2]
+
+
+def get_image_info(file_or_path, close=False):
+    """
+    Like :func:`get_image_dimensions`, but returns a 3-tuple
+    ``(width, height, orientation)``, where ``orientation`` is the Exif
+    orientation tag (or None).
+
     """
 
     p = ImageFile.Parser()
@@ -153,9 +326,14 @@ def get_image_dimensions(file_or_path, close=False):
                 # WebP files. A different chunk_size may work.
                 pass
             if p.image:
-                return exif_aware_size(p.image)
+                width, height = exif_aware_size(p.image)
+                orientation = None
+                # As in exif_aware_size, PNG Exif data is ignored.
+                if p.image.format != 'PNG':
+                    orientation = get_exif_orientation(p.image)
+                return width, height, orientation
             chunk_size *= 2
-        return (None, None)
+        return (None, None, None)
     finally:
         if close:
             file.close()
@@ -167,15 +345,21 @@ def save_image(
         image,
         storage_path,
         format=DEFAULT_FORMAT,
-        storage=default_storage):
+        storage=default_storage,
+        stats=None):
     """
     Saves a PIL image file to the given storage_path using the given storage.
-    Returns the final storage path of the saved file.
+    Returns the final storage path of the saved file. If ``stats`` (a
+    :class:`GenerationStats`) is given, encoding and writing are timed.
 
     """
     if format not in KEEP_FORMATS:
         format = DEFAULT_FORMAT
 
     with NamedTemporaryFile() as temp:
-        image.save(temp, format=format)
-        return storage.save(storage_path, File(temp))
+        with timed(stats, 'encode'):
+            image.save(temp, format=format)
+        if stats is not None:
+            stats.bytes_written += temp.tell()
+        with timed(stats, 'write'):
+            return storage.save(storage_path, File(temp))
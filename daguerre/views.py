@@ -1,13 +1,16 @@
 import json
+import time
 
 from django.contrib.auth import get_permission_codename
 from django.core.exceptions import ValidationError
 from django.http import (HttpResponse, Http404, HttpResponseRedirect,
                          HttpResponseForbidden)
+from django.core.files.storage import default_storage
 from django.views.generic import View
 
-from daguerre.helpers import AdjustmentHelper
-from daguerre.models import Area
+from daguerre.helpers import AdjustmentHelper, IOERRORS
+from daguerre.models import (AdjustedImage, AdjustmentJob, Area,
+                             get_queue_options)
 
 
 class AdjustedImageRedirectView(View):
@@ -17,8 +20,14 @@ class AdjustedImageRedirectView(View):
 
     :param storage_path: The path to the original image file,
     relative to the default storage.
+
+    If the DAGUERRE_QUEUE setting is defined, adjustments which are too
+    costly to generate inline are queued for ``manage.py daguerre worker``
+    instead, and the view redirects to a placeholder in the meantime.
     """
     secure = True
+    # How often (in seconds) to check whether a queued adjustment is done.
+    poll_interval = 0.1
 
     def get_helper(self, generate=False):
         try:
@@ -30,7 +39,81 @@ class AdjustedImageRedirectView(View):
         except ValueError as e:
             raise Http404(str(e))
 
+    def get_generated_url(self, helper):
+        """
+        Returns the url of the adjusted image which the finalized
+        ``helper`` found, or None if it hasn't been generated yet.
+
+        """
+        info_dict = helper[0][1]
+        if not info_dict:
+            raise Http404("Adjustment failed.")
+        if 'ajax_url' in info_dict:
+            return None
+        return info_dict['url']
+
+    def get_placeholder_url(self, options):
+        """
+        Returns the url to redirect to while a queued adjustment is being
+        generated: the PLACEHOLDER option if set, or the original image.
+
+        """
+        if options['PLACEHOLDER'] is not None:
+            return options['PLACEHOLDER']
+        return default_storage.url(self.kwargs['storage_path'])
+
+    def wait(self, helper, options):
+        """
+        Waits up to WAIT seconds for a worker to generate the adjusted image
+        and returns its url, or returns None if it isn't done by then.
+
+        """
+        adjusted_images = AdjustedImage.objects.filter(
+            storage_path=self.kwargs['storage_path'],
+            requested=helper.requested,
+        ).only('adjusted')
+        deadline = time.time() + options['WAIT']
+        while time.time() < deadline:
+            time.sleep(self.poll_interval)
+            adjusted = adjusted_images.first()
+            if adjusted is not None:
+                return adjusted.adjusted.url
+        return None
+
+    def enqueue(self, helper, options):
+        """
+        Generates the adjustment inline if it's cheap enough; otherwise
+        queues it and waits up to WAIT seconds for a worker to finish it.
+        Returns the url to redirect to.
+
+        """
+        storage_path = self.kwargs['storage_path']
+        try:
+            cost = helper.estimate_cost(storage_path)
+            if cost is not None and cost <= options['INLINE_COST']:
+                return helper._generate(storage_path).adjusted.url
+        except IOERRORS:
+            cost = None
+        if cost is None:
+            raise Http404("Adjustment failed.")
+
+        AdjustmentJob.objects.enqueue(
+            storage_path, helper.requested,
+            timeout=options['CLAIM_TIMEOUT'],
+            max_attempts=options['MAX_ATTEMPTS'])
+        return self.wait(helper, options) or self.get_placeholder_url(options)
+
     def get(self, request, *args, **kwargs):
+        options = get_queue_options()
+        if options is not None:
+            # The same helper is used throughout, so that the original's
+            # dimensions and areas are only looked up once.
+            helper = self.get_helper(generate=False)
+            url = self.get_generated_url(helper)
+            if url is None:
+                url = self.enqueue(helper, options)
+            return HttpResponseRedirect(url)
+
         helper = self.get_helper(generate=True)
         try:
             adjusted = helper[0][1]
@@ -25,6 +25,7 @@ setup(
     ],
     extras_require={
         'docs': ["sphinx-rtd-theme>=0.1.5"],
+        'numpy': ["numpy"],
     },
     classifiers=[
         'Development Status :: 5 - Production/Stable',